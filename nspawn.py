@@ -1,19 +1,180 @@
 #!/usr/bin/env python
-from collections import Counter
+from collections import Counter, deque
+from array import array
 
 import os
+import re
+import math
 import sys
 import json
+import lzma
 import time
+import calendar
+import zlib
 import shlex
+import fcntl
+import select
+import selectors
+import queue
+import heapq
+import base64
 import random
+import fnmatch
 import hashlib
+import ipaddress
+import socket
 import argparse
 import threading
+import contextlib
+import concurrent.futures
 
 import paramiko
 
 
+LEASE_TTL = 30
+LEASE_WAIT = 120
+CONSENSUS_RETRIES = 5
+DEFAULT_PORT_RANGES = [(10000, 65535)]
+CONFIG_MAGIC = b'NSPAWN2 '
+CONFIG_CHUNK_SIZE = 64 * 1024
+STREAM_CHUNK_SIZE = 32 * 1024
+STREAM_LINE_MAX = 64 * 1024
+CONNECT_TIMEOUT = 10
+AUTH_TIMEOUT = 15
+COMMAND_TIMEOUT = 60
+CONNECT_RETRIES = 3
+CLUSTER_DEADLINE = 90
+BREAKER_THRESHOLD = 3
+BREAKER_COOLDOWN = 300
+BREAKER_PROBE_INTERVAL = 15
+BASE_DIR = '/var/lib/machines/.base'
+LAYERS_DIR = '/var/lib/machines/.layers'
+BASE_WAIT = 1800
+NETWORK_MODES = ('veth', 'bridge', 'macvlan', 'ipvlan', 'host')
+PLACEMENT_STRATEGIES = ('least-loaded', 'hash')
+PLACEMENT_KEYS = ('max_per_machine', 'spread', 'anti_affinity', 'affinity', 'strategy', 'max_load')
+STATS_SAMPLES = 720
+STATS_WINDOW = 300
+STATS_MAX_AGE = 600
+RESOURCE_LIMITS = (
+    # container record key, cgroup property, value pattern
+    ('cpu_quota', 'CPUQuota', r'\d+%'),
+    ('cpu_weight', 'CPUWeight', r'\d+|idle'),
+    ('memory_max', 'MemoryMax', r'\d+[KMGT]?|\d+%|infinity'),
+    ('memory_high', 'MemoryHigh', r'\d+[KMGT]?|\d+%|infinity'),
+    ('io_weight', 'IOWeight', r'\d+'),
+    ('io_read_bandwidth', 'IOReadBandwidthMax', r'/\S+ \d+[KMGT]?'),
+    ('io_write_bandwidth', 'IOWriteBandwidthMax', r'/\S+ \d+[KMGT]?'),
+    ('tasks_max', 'TasksMax', r'\d+%?|infinity'),
+    ('cpus', 'AllowedCPUs', r'\d+(-\d+)?(,\d+(-\d+)?)*'),
+    ('numa_nodes', 'AllowedMemoryNodes', r'\d+(-\d+)?(,\d+(-\d+)?)*'),
+)
+WATCH_KEEPALIVE = 30
+WATCH_RECONNECT_MAX = 60
+WATCH_SEEN = 4096
+TOP_INTERVAL = 2.0
+TOP_SORT = {
+    'cpu': lambda n: n['cpu'],
+    'memory': lambda n: n['memory'],
+    'pids': lambda n: n['pids'],
+    'io': lambda n: None if n['read'] is None else n['read'] + n['write'],
+}
+UNIT_EVENTS = {
+    # systemd catalog message ids of pid1 unit messages
+    '7d4958e842da4a758f6c1cdc7b36dcc5': 'starting',
+    '39f53479d3a045ac8e11786248231fbf': 'started',
+    'de5b426a63be47a7b6ac3eaac82e2f6f': 'stopping',
+    '9d1aaa27d60140bd96365438aad20286': 'stopped',
+    '98e322203f7a4ed290d09fe03c09fe15': 'exited',
+    'd9b373ed55a64feb8242e02dbe79a49c': 'failed',
+    'be02cf6855d2428ba40df7e9d022f03d': 'failed',
+    '5eb03494b6584870a536b337290809b3': 'restarting',
+}
+JOURNAL_FIELDS = (
+    'MESSAGE_ID', 'UNIT', 'JOB_RESULT', 'UNIT_RESULT', 'EXIT_CODE', 'EXIT_STATUS', 'N_RESTARTS',
+)
+LOG_FIELDS = (
+    'MESSAGE', 'PRIORITY', 'SYSLOG_IDENTIFIER', '_COMM', '_PID', '_SYSTEMD_UNIT',
+)
+LOG_LINES = 100
+PROVISION_TIMEOUT = 1800
+PROVISION_STEPS = (
+    # name, postcondition probe, idempotent apply; run as root
+    (
+        'keyring',
+        'test -s /etc/pacman.d/gnupg/pubring.gpg',
+        'pacman-key --init && pacman-key --populate archlinux',
+    ),
+    (
+        'packages',
+        'pacman -Q arch-install-scripts',
+        'pacman -Syu --noconfirm --needed arch-install-scripts',
+    ),
+    (
+        'machines',
+        'systemctl is-enabled --quiet machines.target && systemctl is-active --quiet machines.target',
+        'systemctl enable --now machines.target',
+    ),
+    (
+        'user',
+        'id -u {user}',
+        'useradd -m {user}',
+    ),
+    (
+        'ssh',
+        'test -s ~{user}/.ssh/authorized_keys',
+        'install -d -m 700 -o {user} -g {user} ~{user}/.ssh && '
+        'install -m 600 -o {user} -g {user} ~{admin}/.ssh/authorized_keys ~{user}/.ssh/authorized_keys',
+    ),
+    (
+        'sudo',
+        'test {user} = root || test -f /etc/sudoers.d/nspawn-{user}',
+        'echo "{user} ALL=(ALL) NOPASSWD: ALL" > /etc/sudoers.d/.nspawn-{user} && '
+        'chmod 440 /etc/sudoers.d/.nspawn-{user} && visudo -cqf /etc/sudoers.d/.nspawn-{user} && '
+        'mv /etc/sudoers.d/.nspawn-{user} /etc/sudoers.d/nspawn-{user}',
+    ),
+)
+CACHE_PORT = 9129
+CACHE_UPSTREAM = 'https://geo.mirror.pkgbuild.com'
+CACHE_DIR = '/var/cache/nspawn-pkg'
+CACHE_CONF_DIR = '/etc/nspawn/cache'
+CACHE_LOG = '/var/log/nspawn-cache.log'
+CACHE_MAX_SIZE = '50g'
+PACMAN_CONF = '/etc/nspawn/pacman.conf'
+BACKUP_DIR = '/var/lib/nspawn-backup'
+BACKUP_KEEP = 7
+SNAPSHOTS_DIR = '/var/lib/machines/.snapshots'
+STATS_FIELDS = (
+    'time', 'cpus', 'load1', 'load5', 'load15', 'cpu_busy', 'cpu_total',
+    'mem_total', 'mem_available', 'disk_total', 'disk_free', 'net_rx', 'net_tx',
+)
+
+
+class ConfigConflictError(IOError):
+    pass
+
+
+class LeaseError(IOError):
+    pass
+
+
+class HostUnavailableError(IOError):
+    pass
+
+
+class PortAllocationError(ValueError):
+    pass
+
+
+class ClusterError(IOError):
+    pass
+
+
+class PlacementError(PortAllocationError):
+    # no machine satisfies constraints, handled like running out of ports
+    pass
+
+
 #
 # util
 #
@@ -54,1236 +215,8492 @@ def parse_ports(ports_str):
     return ports
 
 
-#
-# local
-#
-def load_local_config():
-    filename = 'nspawn.local.conf'
+def parse_limits(values):
+    # "none" clears a limit, bandwidth caps are lists of "DEVICE RATE"
+    limits = {}
 
-    if os.path.exists(filename):
-        with open(filename, 'r') as f:
-            config = json.load(f)
-    else:
-        config = {}
+    for key, property_, pattern in RESOURCE_LIMITS:
+        value = values.get(key)
 
-    return config
+        if value is None:
+            continue
 
+        if value == 'none' or value == ['none']:
+            limits[key] = None
+            continue
 
-def save_local_config(config):
-    filename = 'nspawn.local.conf'
+        if key == 'cpu_quota' and value.isdigit():
+            value = '{}%'.format(value)
 
-    with open(filename, 'w') as f:
-        json.dump(config, f, indent=True)
+        for n in (value if isinstance(value, list) else [value]):
+            if not re.fullmatch(pattern, n):
+                raise ValueError('Invalid {} value {!r}'.format(property_, n))
 
+        if key in ('cpu_weight', 'io_weight') and value != 'idle' and not 1 <= int(value) <= 10000:
+            raise ValueError('Invalid {} value {!r}, expected 1-10000'.format(property_, value))
 
-#
-# remote
-#
-def ssh_client(uri):
-    # FIXME: unused port
-    user, host, port = parse_uri(uri)
-    client = paramiko.client.SSHClient()
-    client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-    known_hosts_path = os.path.expanduser('~/.ssh/known_hosts')
-    client.load_host_keys(known_hosts_path)
-    client.connect(host, username=user)
-    return client
+        limits[key] = value
 
+    return limits
 
-def create_container_arch_install(uri, container, start=False, verbose=False):
-    # ssh client
-    client = ssh_client(uri)
 
-    # create machine dir
-    command = 'mkdir -p "/var/lib/machines/{id}"'.format(**container)
-    if verbose: print('{!r}'.format(command))
-    stdin, stdout, stderr = client.exec_command(command)
-    out = stdout.read()
-    err = stderr.read()
-    stdin.close()
-    
-    if err:
-        raise IOError(err)
+def parse_labels(values):
+    labels = {}
 
-    # wait until other pacman instances finish install
-    while True:
-        command = 'ls /var/lib/pacman/db.lck'
-        if verbose: print('{!r}'.format(command))
-        stdin, stdout, stderr = client.exec_command(command)
-        out = stdout.read()
-        err = stderr.read()
-        stdin.close()
+    for n in values or []:
+        key, sep, value = n.partition('=')
 
-        if out != '/var/lib/pacman/db.lck':
-            break
+        if not sep or not re.fullmatch(r'[A-Za-z0-9_.-]+', key) or not value:
+            raise ValueError('Invalid label {!r}, expected KEY=VALUE'.format(n))
 
-        print('Machine already using pacman, waiting 5 seconds...')
-        time.sleep(5.0)
+        labels[key] = value
 
-    # boostrap container
-    machine_dir = '/var/lib/machines/{id}'.format(**container)
-    command = 'pacstrap -c -d "{}" base --ignore linux vim openssh'.format(machine_dir)
-    if verbose: print('{!r}'.format(command))
-    stdin, stdout, stderr = client.exec_command(command)
-    out = stdout.read()
-    err = stderr.read()
-    stdin.close()
-    
-    if verbose:
-        for line in iter(lambda: stdout.readline(2048), ""):
-            print(line, end="")
-    else:
-        out = stdout.read()
+    return labels
 
-    # resolv.conf
-    command = ''.join([
-        'echo "nameserver 8.8.8.8" > ',
-        '{}/etc/resolv.conf'.format(machine_dir),
-    ])
-    if verbose: print('{!r}'.format(command))
-    stdin, stdout, stderr = client.exec_command(command)
-    out = stdout.read()
-    err = stderr.read()
-    stdin.close()
 
-    # enable systemd-network.service
-    s = '/usr/lib/systemd/system/systemd-networkd.service'
-    d = '/etc/systemd/system/multi-user.target.wants/systemd-networkd.service'
-    command = 'ln -s "{}{}" "{}{}"'.format(machine_dir, s, machine_dir, d)
-    if verbose: print('{!r}'.format(command))
-    stdin, stdout, stderr = client.exec_command(command)
-    out = stdout.read()
-    err = stderr.read()
-    stdin.close()
+def parse_placement(max_per_machine=None, spread=None, anti_affinity=None, affinity=None, strategy=None, max_load=None):
+    # constraints kept in record only when given
+    placement = {}
 
-    # enable systemd-networkd.socket
-    s = '/usr/lib/systemd/system/systemd-networkd.socket'
-    d = '/etc/systemd/system/sockets.target.wants/systemd-networkd.socket'
-    command = 'ln -s "{}{}" "{}{}"'.format(machine_dir, s, machine_dir, d)
-    if verbose: print('{!r}'.format(command))
-    stdin, stdout, stderr = client.exec_command(command)
-    out = stdout.read()
-    err = stderr.read()
-    stdin.close()
+    if strategy is not None:
+        if strategy not in PLACEMENT_STRATEGIES:
+            raise ValueError('Invalid placement strategy {}'.format(strategy))
 
-    # enable systemd-resolved.service
-    s = '/usr/lib/systemd/system/systemd-resolved.service'
-    d = '/etc/systemd/system/sockets.target.wants/systemd-resolved.service'
-    command = 'ln -s "{}{}" "{}{}"'.format(machine_dir, s, machine_dir, d)
-    if verbose: print('{!r}'.format(command))
-    stdin, stdout, stderr = client.exec_command(command)
-    out = stdout.read()
-    err = stderr.read()
-    stdin.close()
+        placement['strategy'] = strategy
 
-    # enable sshd
-    s = '/usr/lib/systemd/system/sshd.service'
-    d = '/etc/systemd/system/multi-user.target.wants/sshd.service'
-    command = 'ln -s "{}{}" "{}{}"'.format(machine_dir, s, machine_dir, d)
-    if verbose: print('{!r}'.format(command))
-    stdin, stdout, stderr = client.exec_command(command)
-    out = stdout.read()
-    err = stderr.read()
-    stdin.close()
-    
-    # set locale to utf8
-    f = '#en_US.UTF-8 UTF-8'
-    t = 'en_US.UTF-8 UTF-8'
-    p = '{}/etc/locale.gen'.format(machine_dir)
-    command = 'sed -i \'s/{}/{}/g\' "{}"'.format(f, t, p)
-    if verbose: print('{!r}'.format(command))
-    stdin, stdout, stderr = client.exec_command(command)
-    out = stdout.read()
-    err = stderr.read()
-    stdin.close()
+    if max_load is not None:
+        if max_load < 1.0:
+            raise ValueError('Invalid max load {}, must be at least 1.0'.format(max_load))
 
-    f = '#en_US ISO-8859-1'
-    t = 'en_US ISO-8859-1'
-    p = '{}/etc/locale.gen'.format(machine_dir)
-    command = 'sed -i \'s/{}/{}/g\' "{}"'.format(f, t, p)
-    if verbose: print('{!r}'.format(command))
-    stdin, stdout, stderr = client.exec_command(command)
-    out = stdout.read()
-    err = stderr.read()
-    stdin.close()
+        placement['max_load'] = float(max_load)
 
-    command = 'localectl set-locale LANG=en_US.UTF-8'
-    if verbose: print('{!r}'.format(command))
-    stdin, stdout, stderr = client.exec_command(command)
-    out = stdout.read()
-    err = stderr.read()
-    stdin.close()
+    if max_per_machine is not None:
+        if max_per_machine < 1:
+            raise ValueError('Invalid max per machine {}'.format(max_per_machine))
 
-    command = 'locale-gen'
-    if verbose: print('{!r}'.format(command))
-    stdin, stdout, stderr = client.exec_command(command)
-    out = stdout.read()
-    err = stderr.read()
-    stdin.close()
-    
-    # patch sshd
-    f = '#PermitRootLogin prohibit-password'
-    t = 'PermitRootLogin yes'
-    p = '{}/etc/ssh/sshd_config'.format(machine_dir)
-    command = 'sed -i \'s/{}/{}/g\' "{}"'.format(f, t, p)
-    if verbose: print('{!r}'.format(command))
-    stdin, stdout, stderr = client.exec_command(command)
-    out = stdout.read()
-    err = stderr.read()
-    stdin.close()
+        placement['max_per_machine'] = max_per_machine
 
-    # patch sshd
-    f = '#PermitEmptyPasswords no'
-    t = 'PermitEmptyPasswords yes'
-    p = '{}/etc/ssh/sshd_config'.format(machine_dir)
-    command = 'sed -i \'s/{}/{}/g\' "{}"'.format(f, t, p)
-    if verbose: print('{!r}'.format(command))
-    stdin, stdout, stderr = client.exec_command(command)
-    out = stdout.read()
-    err = stderr.read()
-    stdin.close()
+    for n in spread or []:
+        label, sep, max_skew = n.partition(':')
 
-    # remove /etc/securetty
-    # to allow 'machinectl login ....'
-    s = '/etc/securetty'
-    d = '/etc/securetty.0'
-    command = 'mv "{}{}" "{}{}"'.format(machine_dir, s, machine_dir, d)
-    if verbose: print('{!r}'.format(command))
-    stdin, stdout, stderr = client.exec_command(command)
-    out = stdout.read()
-    err = stderr.read()
-    stdin.close()
+        if not label or (sep and not max_skew.isdigit()):
+            raise ValueError('Invalid spread {!r}, expected LABEL[:MAX_SKEW]'.format(n))
 
-    # override service
-    command = 'mkdir -p "/etc/systemd/system/systemd-nspawn@{}.service.d"'.format(container['id'])
-    if verbose: print('{!r}'.format(command))
-    stdin, stdout, stderr = client.exec_command(command)
-    out = stdout.read()
-    err = stderr.read()
-    stdin.close()
+        placement.setdefault('spread', []).append({'label': label, 'max_skew': int(max_skew or 1)})
 
-    # override service
-    command = 'printf "[Service]\\nExecStart=\\nExecStart={}" >{}'.format(
-        '/usr/bin/systemd-nspawn --quiet --keep-unit --boot --network-veth {} --machine={}'.format(
-            ' '.join('--port={}:{}'.format(k, v) for k, v in container['ports'].items()),
-            container['id'],
-        ),
-        '/etc/systemd/system/systemd-nspawn\@{}.service.d/override.conf'.format(container['id'])
-    )
+    if anti_affinity:
+        placement['anti_affinity'] = sorted(set(anti_affinity))
 
-    if verbose: print('{!r}'.format(command))
-    stdin, stdout, stderr = client.exec_command(command)
-    out = stdout.read()
-    err = stderr.read()
-    stdin.close()
+    if affinity:
+        placement['affinity'] = sorted(set(affinity))
 
-    # demon-reload
-    command = 'systemctl daemon-reload'
-    if verbose: print('{!r}'.format(command))
-    stdin, stdout, stderr = client.exec_command(command)
-    out = stdout.read()
-    err = stderr.read()
-    stdin.close()
+    return placement
 
-    # possibly run container
-    if start:
-        # start service
-        command = 'systemctl start systemd-nspawn@{}.service'.format(container['id'])
-        if verbose: print('{!r}'.format(command))
-        stdin, stdout, stderr = client.exec_command(command)
-        out = stdout.read()
-        err = stderr.read()
-        stdin.close()
 
-        # enable service
-        command = 'systemctl enable systemd-nspawn@{}.service'.format(container['id'])
-        if verbose: print('{!r}'.format(command))
-        stdin, stdout, stderr = client.exec_command(command)
-        out = stdout.read()
-        err = stderr.read()
-        stdin.close()
+def parse_network(mode, interface=None, address=None, gateway=None):
+    # veth is default and leaves no network key in record
+    if mode not in NETWORK_MODES:
+        raise ValueError('Invalid network mode {}'.format(mode))
 
-    # sync
-    command = 'sync'
-    if verbose: print('{!r}'.format(command))
-    stdin, stdout, stderr = client.exec_command(command)
-    out = stdout.read()
-    err = stderr.read()
-    stdin.close()
+    if mode == 'veth' and not (interface or address or gateway):
+        return None
 
-    # close ssh client
-    client.close()
+    if mode in ('bridge', 'macvlan', 'ipvlan') and not interface:
+        raise ValueError('Network mode {} needs host interface'.format(mode))
 
+    if mode in ('veth', 'host') and (interface or address or gateway):
+        raise ValueError('Network mode {} does not take interface or address'.format(mode))
 
-def destroy_container_arch(uri, container, verbose=False):
-    # ssh client
-    client = ssh_client(uri)
+    network = {'mode': mode}
 
-    # stop service
-    command = 'systemctl stop systemd-nspawn@{}.service'.format(container['id'])
-    if verbose: print('{!r}'.format(command))
-    stdin, stdout, stderr = client.exec_command(command)
-    out = stdout.read()
-    err = stderr.read()
-    stdin.close()
+    if interface:
+        network['interface'] = interface
 
-    # disable service
-    command = 'systemctl disable systemd-nspawn@{}.service'.format(container['id'])
-    if verbose: print('{!r}'.format(command))
-    stdin, stdout, stderr = client.exec_command(command)
-    out = stdout.read()
-    err = stderr.read()
-    stdin.close()
+    if address:
+        network['address'] = str(ipaddress.ip_interface(address))
 
-    # rm service
-    command = 'rm -r /etc/systemd/system/systemd-nspawn@{}.service.d'.format(container['id'])
-    if verbose: print('{!r}'.format(command))
-    stdin, stdout, stderr = client.exec_command(command)
-    out = stdout.read()
-    err = stderr.read()
-    stdin.close()
+    if gateway:
+        network['gateway'] = str(ipaddress.ip_address(gateway))
 
-    # rm dir
-    command = 'rm -r /var/lib/machines/{}'.format(container['id'])
-    if verbose: print('{!r}'.format(command))
-    stdin, stdout, stderr = client.exec_command(command)
-    out = stdout.read()
-    err = stderr.read()
-    stdin.close()
+    return network
 
-    # sync
-    command = 'sync'
-    if verbose: print('{!r}'.format(command))
-    stdin, stdout, stderr = client.exec_command(command)
-    out = stdout.read()
-    err = stderr.read()
-    stdin.close()
 
-    # close ssh client
-    client.close()
+def network_arguments(container):
+    # systemd-nspawn options, only veth forwards host ports
+    network = container.get('network') or {'mode': 'veth'}
+    mode = network['mode']
 
+    if mode == 'veth':
+        return ['--network-veth'] + ['--port={}:{}'.format(k, v) for k, v in container['ports'].items()]
+    elif mode == 'bridge':
+        return ['--network-bridge={}'.format(network['interface'])]
+    elif mode == 'macvlan':
+        return ['--network-macvlan={}'.format(network['interface'])]
+    elif mode == 'ipvlan':
+        return ['--network-ipvlan={}'.format(network['interface'])]
 
-def start_container_arch(uri, container, verbose=False):
-    if verbose:
-        print('start_container_arch: {}'.format(uri))
+    # host network namespace
+    return []
 
-    # ssh client
-    client = ssh_client(uri)
 
-    # override service
-    command = 'mkdir -p "/etc/systemd/system/systemd-nspawn@{}.service.d"'.format(container['id'])
-    if verbose: print('{!r}'.format(command))
-    stdin, stdout, stderr = client.exec_command(command)
+def container_address(container):
+    # where container is reached, host itself for forwarded ports
+    network = container.get('network') or {}
+    address = network.get('address')
+
+    if address:
+        return address.split('/')[0]
+
+    if network.get('mode', 'veth') in ('veth', 'host'):
+        return container['host']
+
+    return '-'
+
+
+def limit_properties(limits):
+    # cgroup property assignments in RESOURCE_LIMITS order
+    properties = []
+
+    for key, property_, pattern in RESOURCE_LIMITS:
+        value = limits.get(key)
+
+        if value is None:
+            continue
+
+        for n in (value if isinstance(value, list) else [value]):
+            properties.append('{}={}'.format(property_, n))
+
+    return properties
+
+
+def join_threads(threads, timeout=CLUSTER_DEADLINE):
+    # bounded wait, returns threads still running after deadline
+    deadline = time.time() + timeout
+
+    for t in threads:
+        t.join(max(0.0, deadline - time.time()))
+
+    return [t for t in threads if t.is_alive()]
+
+
+def parse_port_ranges(ranges_str):
+    ranges = []
+
+    for n in ranges_str.split(','):
+        if '-' in n:
+            start, end = n.split('-')
+            start, end = int(start), int(end)
+        else:
+            start = end = int(n)
+
+        if not 0 < start <= end <= 65535:
+            raise ValueError('Invalid port range {}'.format(n))
+
+        ranges.append((start, end))
+
+    return ranges
+
+
+#
+# port
+#
+class PortAllocator(object):
+    # one bit per host port over span of configured ranges
+    def __init__(self, ranges=DEFAULT_PORT_RANGES):
+        self.ranges = sorted((int(a), int(b)) for a, b in ranges)
+        self.start = self.ranges[0][0]
+        self.end = max(b for a, b in self.ranges)
+        size = (self.end - self.start) // 8 + 1
+        self.used = bytearray(size)
+        self.blocked = bytearray(size)
+        self.reservations = {}
+        self.cursors = {}
+
+        # ports in gaps between ranges are never handed out
+        prev_end = self.start - 1
+
+        for a, b in self.ranges:
+            for port in range(prev_end + 1, a):
+                self._set(self.blocked, port)
+
+            prev_end = max(prev_end, b)
+
+    def _set(self, bitmap, port):
+        i = port - self.start
+        bitmap[i >> 3] |= 1 << (i & 7)
+
+    def _clear(self, bitmap, port):
+        i = port - self.start
+        bitmap[i >> 3] &= ~(1 << (i & 7)) & 0xff
+
+    def _test(self, bitmap, port):
+        i = port - self.start
+        return bool(bitmap[i >> 3] & (1 << (i & 7)))
+
+    def contains(self, port):
+        return self.start <= port <= self.end
+
+    def is_used(self, port):
+        return self.contains(port) and self._test(self.used, port)
+
+    def mark(self, port):
+        if self.contains(port):
+            self._set(self.used, port)
+
+    def free(self, port):
+        if not self.contains(port):
+            return
+
+        self._clear(self.used, port)
+
+        # rewind cursors so freed ports are reused first
+        for key, cursor in self.cursors.items():
+            a, b = key
+
+            if a <= port < cursor:
+                self.cursors[key] = port
+
+    def reserve(self, start, end, owner):
+        # range is taken out of common pool, only owner allocates from it
+        start, end = max(start, self.start), min(end, self.end)
+        self.reservations.setdefault(owner, []).append((start, end))
+
+        for port in range(start, end + 1):
+            self._set(self.blocked, port)
+
+    def _is_free(self, port, owner_range):
+        if self._test(self.used, port):
+            return False
+
+        if owner_range:
+            return True
+
+        return not self._test(self.blocked, port)
+
+    def _scan(self, a, b, owner_range):
+        key = (a, b)
+        cursor = self.cursors.get(key, a)
+
+        for lo, hi in ((cursor, b), (a, cursor - 1)):
+            port = lo
+
+            while port <= hi:
+                i = port - self.start
+
+                # skip whole bytes which are fully taken
+                if i & 7 == 0 and port + 7 <= hi:
+                    taken = self.used[i >> 3]
+
+                    if not owner_range:
+                        taken |= self.blocked[i >> 3]
+
+                    if taken == 0xff:
+                        port += 8
+                        continue
+
+                if self._is_free(port, owner_range):
+                    self.cursors[key] = port + 1
+                    return port
+
+                port += 1
+
+        return None
+
+    def allocate(self, owner=None, hint=None):
+        reserved = self.reservations.get(owner, []) if owner else []
+
+        # preferred port is a single O(1) probe
+        if hint is not None and self.contains(hint):
+            in_reserved = any(a <= hint <= b for a, b in reserved)
+
+            if (not reserved or in_reserved) and self._is_free(hint, in_reserved):
+                self.mark(hint)
+                return hint
+
+        if reserved:
+            candidates = [(a, b, True) for a, b in reserved]
+        else:
+            candidates = [(a, b, False) for a, b in self.ranges]
+
+        for a, b, owner_range in candidates:
+            port = self._scan(a, b, owner_range)
+
+            if port is not None:
+                self.mark(port)
+                return port
+
+        raise PortAllocationError('No available port left')
+
+
+#
+# format
+#
+def _compressor(codec):
+    if codec == 'zlib':
+        return zlib.compressobj(9)
+    elif codec == 'lzma':
+        return lzma.LZMACompressor()
+    else:
+        raise ValueError('Unknown config codec {}'.format(codec))
+
+
+def _decompressor(codec):
+    if codec == 'zlib':
+        return zlib.decompressobj()
+    elif codec == 'lzma':
+        return lzma.LZMADecompressor()
+    else:
+        raise ValueError('Unknown config codec {}'.format(codec))
+
+
+def dump_config(config, format_='v2', codec='zlib'):
+    if format_ == 'json':
+        return json.dumps(config, indent=True).encode()
+
+    # head line holds everything but containers
+    containers = config.get('containers', {})
+    fields = sorted(set(k for c in containers.values() for k in c))
+    codes = {f: format(i, 'x') for i, f in enumerate(fields)}
+    head = {k: v for k, v in config.items() if k != 'containers'}
+    head['fields'] = fields
+
+    # one line per container with short field codes
+    compressor = _compressor(codec)
+    m = hashlib.sha256()
+    chunks = []
+
+    def write(line):
+        line = line.encode() + b'\n'
+        m.update(line)
+        chunks.append(compressor.compress(line))
+
+    write(json.dumps(head, separators=(',', ':')))
+
+    for container_id, container in containers.items():
+        record = {codes[k]: v for k, v in container.items()}
+        write(json.dumps(record, separators=(',', ':')))
+
+    chunks.append(compressor.flush())
+
+    header = {
+        'version': 2,
+        'codec': codec,
+        'generation': config.get('generation', 0),
+        'containers': len(containers),
+        'sha256': m.hexdigest(),
+    }
+
+    header = CONFIG_MAGIC + json.dumps(header, separators=(',', ':')).encode() + b'\n'
+    return header + b''.join(chunks)
+
+
+def iter_config(chunks):
+    # yields ('head', dict) once, then ('container', id, dict) per record
+    chunks = iter(chunks)
+    buf = b''
+
+    for chunk in chunks:
+        buf += chunk
+
+        if len(buf) >= len(CONFIG_MAGIC) or not buf.startswith(CONFIG_MAGIC[:len(buf)]):
+            break
+
+    if not buf.startswith(CONFIG_MAGIC):
+        # v1, plain json
+        data = buf + b''.join(chunks)
+        config = json.loads(data.decode()) if data.strip() else {}
+        containers = config.pop('containers', {})
+        yield ('head', config)
+
+        for container_id, container in containers.items():
+            yield ('container', container_id, container)
+
+        return
+
+    # v2 header line
+    while b'\n' not in buf:
+        chunk = next(chunks, None)
+
+        if chunk is None:
+            raise IOError('Truncated config header')
+
+        buf += chunk
+
+    header, buf = buf.split(b'\n', 1)
+    header = json.loads(header[len(CONFIG_MAGIC):].decode())
+    decompressor = _decompressor(header['codec'])
+    m = hashlib.sha256()
+    fields = None
+    pending = b''
+
+    for chunk in _chain_chunks(buf, chunks):
+        try:
+            if chunk is None:
+                # zlib may hold back tail until flushed
+                data = decompressor.flush() if hasattr(decompressor, 'flush') else b''
+            else:
+                data = decompressor.decompress(chunk)
+        except (zlib.error, lzma.LZMAError) as e:
+            raise IOError('Corrupted config: {}'.format(e))
+
+        m.update(data)
+        *complete, pending = (pending + data).split(b'\n')
+
+        for line in complete:
+            item = json.loads(line.decode())
+
+            if fields is None:
+                fields = item.pop('fields', [])
+                item['generation'] = header.get('generation', item.get('generation', 0))
+                yield ('head', item)
+            else:
+                record = {fields[int(k, 16)]: v for k, v in item.items()}
+                yield ('container', record['id'], record)
+
+    if pending or m.hexdigest() != header['sha256']:
+        raise IOError('Config checksum mismatch')
+
+
+def _chain_chunks(first, chunks):
+    if first:
+        yield first
+
+    for chunk in chunks:
+        yield chunk
+
+    yield None
+
+
+def fold_config(merged, generations, events, lock=None, cancel=None):
+    # newer generation wins per item, so each node can be folded as it arrives
+    lock = lock or contextlib.nullcontext()
+    generation = 0
+
+    for event in events:
+        if event[0] == 'head':
+            head = event[1]
+            generation = head.get('generation', 0)
+            items = [
+                (section, key, value)
+                for section, values in head.items()
+                if isinstance(values, dict)
+                for key, value in values.items()
+            ]
+        else:
+            items = [('containers', event[1], event[2])]
+
+        with lock:
+            # caller gave up waiting on this node
+            if cancel is not None and cancel.is_set():
+                return merged
+
+            merged['generation'] = max(merged.get('generation', 0), generation)
+
+            for section, key, value in items:
+                if generations.get((section, key), -1) > generation:
+                    continue
+
+                merged.setdefault(section, {})[key] = value
+                generations[(section, key)] = generation
+
+    return merged
+
+
+def load_config(data):
+    merged = {'generation': 0, 'machines': {}, 'projects': {}, 'containers': {}}
+    return fold_config(merged, {}, iter_config([data]))
+
+
+#
+# local
+#
+def load_local_config():
+    filename = 'nspawn.local.conf'
+
+    if os.path.exists(filename):
+        with open(filename, 'r') as f:
+            config = json.load(f)
+    else:
+        config = {}
+
+    return config
+
+
+def save_local_config(config):
+    filename = 'nspawn.local.conf'
+
+    with open(filename, 'w') as f:
+        json.dump(config, f, indent=True)
+
+
+def config_format():
+    # remote config format, "v2" (compressed) or "json"
+    main = load_local_config().get('main', {})
+    return main.get('config_format', 'v2'), main.get('config_codec', 'zlib')
+
+
+#
+# breaker
+#
+_breakers = None
+_breakers_lock = threading.Lock()
+
+
+def _load_breakers():
+    global _breakers
+    filename = 'nspawn.local.breakers'
+
+    if _breakers is None:
+        _breakers = {}
+
+        if os.path.exists(filename):
+            try:
+                with open(filename, 'r') as f:
+                    _breakers = json.load(f)
+            except ValueError:
+                _breakers = {}
+
+    return _breakers
+
+
+def _save_breakers(update):
+    # remembered across invocations, re-read under lock so concurrent
+    # invocations do not lose each other's updates
+    filename = 'nspawn.local.breakers'
+
+    with open(filename + '.lock', 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        breakers = {}
+
+        if os.path.exists(filename):
+            try:
+                with open(filename, 'r') as f:
+                    breakers = json.load(f)
+            except ValueError:
+                breakers = {}
+
+        update(breakers)
+
+        with open(filename + '.tmp', 'w') as f:
+            json.dump(breakers, f, indent=True)
+
+        os.rename(filename + '.tmp', filename)
+
+    # trial and probe time are never saved, kept while host stays open
+    local = _load_breakers()
+
+    for key, breaker in breakers.items():
+        if key in local and local[key]['opened'] == breaker['opened'] and breaker['state'] == 'open':
+            breaker['state'] = local[key]['state']
+
+            if 'probed' in local[key]:
+                breaker['probed'] = local[key]['probed']
+
+    local.clear()
+    local.update(breakers)
+
+
+def _probe_host(key):
+    host, port = key.rsplit(':', 1)
+
+    try:
+        sock = socket.create_connection((host, int(port)), timeout=CONNECT_TIMEOUT)
+        sock.close()
+    except (socket.error, socket.timeout):
+        return False
+
+    return True
+
+
+def breaker_allow(key):
+    with _breakers_lock:
+        breaker = _load_breakers().get(key)
+
+        if not breaker or breaker['state'] == 'closed':
+            return True
+
+        now = time.time()
+
+        if now - breaker['opened'] > BREAKER_COOLDOWN:
+            breaker['state'] = 'trial'
+            return True
+
+        # single trial connection, further ones wait for its outcome
+        if breaker['state'] == 'trial' or now - breaker.get('probed', 0) < BREAKER_PROBE_INTERVAL:
+            return False
+
+        breaker['probed'] = now
+
+    # cheap tcp probe of open host, recovered one gets a trial connection
+    if not _probe_host(key):
+        return False
+
+    with _breakers_lock:
+        breaker = _load_breakers().get(key)
+
+        if breaker and breaker['state'] == 'trial':
+            return False
+
+        if breaker:
+            breaker['state'] = 'trial'
+
+    return True
+
+
+def breaker_success(key):
+    with _breakers_lock:
+        if key in _load_breakers():
+            _save_breakers(lambda breakers: breakers.pop(key, None))
+
+
+def breaker_failure(key):
+    with _breakers_lock:
+        trial = _load_breakers().get(key, {}).get('state') == 'trial'
+
+        def update(breakers):
+            breaker = breakers.setdefault(key, {'state': 'closed', 'failures': 0, 'opened': 0})
+            breaker['failures'] += 1
+
+            if trial or breaker['failures'] >= BREAKER_THRESHOLD:
+                breaker['state'] = 'open'
+                breaker['opened'] = time.time()
+
+        _save_breakers(update)
+
+
+#
+# remote
+#
+def ssh_client(uri, retries=CONNECT_RETRIES, timeout=CONNECT_TIMEOUT):
+    user, host, port = parse_uri(uri)
+    key = '{}:{}'.format(host, port)
+
+    # fail fast on hosts known to be dead
+    if not breaker_allow(key):
+        raise HostUnavailableError('Machine {} is unreachable, skipping'.format(key))
+
+    for attempt in range(retries):
+        client = paramiko.client.SSHClient()
+        client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        known_hosts_path = os.path.expanduser('~/.ssh/known_hosts')
+        client.load_host_keys(known_hosts_path)
+
+        try:
+            client.connect(
+                host,
+                port=port,
+                username=user,
+                timeout=timeout,
+                auth_timeout=AUTH_TIMEOUT,
+                banner_timeout=timeout,
+            )
+        except paramiko.AuthenticationException as e:
+            # not transient, retrying will not help
+            client.close()
+            raise IOError('Could not authenticate to {}: {}'.format(key, e))
+        except (socket.error, socket.timeout, paramiko.SSHException, EOFError) as e:
+            client.close()
+            err = e
+
+            # jittered exponential backoff
+            if attempt < retries - 1:
+                time.sleep(random.uniform(0, 0.5 * 2 ** attempt))
+
+            continue
+
+        breaker_success(key)
+        return client
+
+    breaker_failure(key)
+    raise HostUnavailableError('Could not connect to {}: {}'.format(key, err))
+
+
+def exec_command(client, command, input_data=None, timeout=COMMAND_TIMEOUT, verbose=False):
+    if verbose: print('{!r}'.format(command))
+    stdin, stdout, stderr = client.exec_command(command, timeout=timeout)
+
+    # feed data through stdin instead of command line
+    if input_data is not None:
+        stdin.write(input_data)
+        stdin.channel.shutdown_write()
+
     out = stdout.read()
     err = stderr.read()
+    status = stdout.channel.recv_exit_status()
     stdin.close()
+    return status, out, err
+
+
+def line_writer(prefix, lock, out=sys.stdout, err=sys.stderr):
+    # split stream chunks into prefixed lines, partial line kept bounded
+    buffers = {'stdout': b'', 'stderr': b''}
+
+    def write(stream, data):
+        if data is None:
+            lines = [buffers[stream]] if buffers[stream] else []
+            buffers[stream] = b''
+        else:
+            *lines, buffers[stream] = (buffers[stream] + data).split(b'\n')
+
+            if len(buffers[stream]) > STREAM_LINE_MAX:
+                lines.append(buffers[stream])
+                buffers[stream] = b''
+
+        if not lines:
+            return
+
+        f = out if stream == 'stdout' else err
+        text = ''.join('{}{}\n'.format(prefix, line.decode(errors='replace')) for line in lines)
+
+        with lock:
+            f.write(text)
+            f.flush()
+
+    return write
+
+
+class OutputMux(object):
+    # many remote streams into one prefixed output, or a periodic progress view
+    def __init__(self, progress=False, interval=2.0, out=sys.stdout):
+        self.progress = progress
+        self.interval = interval
+        self.out = out
+        self.lock = threading.Lock()
+        self.stats = {}
+        self._stop = threading.Event()
+        self._thread = None
+
+    def stream(self, name, prefix=None, echo=True):
+        stats = {'bytes': 0, 'lines': 0, 'last': '', 'status': None, 'start': time.time(), 'end': None}
+        self.stats[name] = stats
+        prefix = '[{}] '.format(name) if prefix is None else prefix
+        writer = line_writer(prefix, self.lock, self.out, self.out) if echo and not self.progress else None
+        tails = {'stdout': b'', 'stderr': b''}
+
+        def write(stream, data):
+            if data is not None:
+                stats['bytes'] += len(data)
+                stats['lines'] += data.count(b'\n')
+
+                # last complete line for progress view, bounded
+                *lines, tails[stream] = (tails[stream] + data).split(b'\n')
+                tails[stream] = tails[stream][-STREAM_LINE_MAX:]
+                lines = [n for n in lines if n.strip()]
+
+                if lines:
+                    stats['last'] = lines[-1].decode(errors='replace')[-60:]
+
+            if writer:
+                writer(stream, data)
+
+        return write
+
+    def done(self, name, status):
+        stats = self.stats[name]
+        stats['status'] = status
+        stats['end'] = time.time()
+
+    def report(self):
+        lines = []
+
+        for name, stats in sorted(self.stats.items()):
+            if stats['end'] is None:
+                state = 'running'
+            elif stats['status'] == 0:
+                state = 'done'
+            else:
+                state = 'failed'
+
+            lines.append('{a: <24} {b: <8} {c: >10} {d: >7} {e: >7.1f}s {f}'.format(
+                a=name,
+                b=state,
+                c=stats['bytes'],
+                d=stats['lines'],
+                e=(stats['end'] or time.time()) - stats['start'],
+                f=stats['last'],
+            ))
+
+        with self.lock:
+            print('{a: <24} {b: <8} {c: >10} {d: >7} {e: >8} {f}'.format(
+                a='NAME',
+                b='STATE',
+                c='BYTES',
+                d='LINES',
+                e='TIME',
+                f='LAST',
+            ), file=sys.stderr)
+
+            for line in lines:
+                print(line, file=sys.stderr)
+
+            sys.stderr.flush()
+
+    def _progress_thread(self):
+        while not self._stop.wait(self.interval):
+            self.report()
+
+    def start(self):
+        if self.progress:
+            self._thread = threading.Thread(target=self._progress_thread)
+            self._thread.daemon = True
+            self._thread.start()
+
+    def stop(self):
+        if self._thread:
+            self._stop.set()
+            self._thread.join()
+            self.report()
+
+
+def stream_channel(chan, on_data, timeout=None):
+    # read stdout and stderr as they arrive, returns exit status or None on timeout
+    deadline = time.time() + timeout if timeout else None
+
+    while True:
+        wait = 1.0 if deadline is None else max(0.0, min(1.0, deadline - time.time()))
+        select.select([chan], [], [], wait)
+
+        while chan.recv_ready():
+            on_data('stdout', chan.recv(STREAM_CHUNK_SIZE))
+
+        while chan.recv_stderr_ready():
+            on_data('stderr', chan.recv_stderr(STREAM_CHUNK_SIZE))
+
+        if chan.exit_status_ready() and not chan.recv_ready() and not chan.recv_stderr_ready():
+            break
+
+        if deadline is not None and time.time() > deadline:
+            chan.close()
+            on_data('stdout', None)
+            on_data('stderr', None)
+            return None
+
+    on_data('stdout', None)
+    on_data('stderr', None)
+    return chan.recv_exit_status()
+
+
+#
+# lease
+#
+def lease_owner():
+    m = hashlib.sha1()
+    m.update('{}'.format(random.randint(0, 2 ** 128)).encode())
+    return '{}-{}-{}'.format(socket.gethostname(), os.getpid(), m.hexdigest()[-8:])
+
+
+LEASE_OWNER = lease_owner()
+
+
+def acquire_lease(uri, resource, owner=LEASE_OWNER, ttl=LEASE_TTL, wait=LEASE_WAIT, verbose=False):
+    # lease file holds "<owner> <expires>", guarded by flock on the machine
+    f = 'nspawn.leases/{}'.format(resource)
+    command = ''.join([
+        'mkdir -p nspawn.leases; ',
+        'exec 9>>nspawn.leases/.lock && flock -w 10 9 || exit 75; ',
+        'now=$(date +%s); ',
+        'if [ -f "{f}" ]; then read o e < "{f}"; ',
+        'if [ "$o" != "{owner}" ] && [ "$e" -gt "$now" ]; then echo "$o"; exit 3; fi; fi; ',
+        'echo "{owner} $((now + {ttl}))" > "{f}"',
+    ]).format(f=f, owner=owner, ttl=int(ttl))
+
+    deadline = time.time() + wait
+    client = ssh_client(uri)
+
+    try:
+        while True:
+            status, out, err = exec_command(client, command, verbose=verbose)
+
+            if status == 0:
+                return
+
+            if status != 3:
+                raise LeaseError(err or 'Could not acquire lease {}'.format(resource))
+
+            if time.time() > deadline:
+                msg = 'Lease {} on {} is held by {}'.format(resource, uri, out.decode().strip())
+                raise LeaseError(msg)
+
+            if verbose:
+                print('Lease {} is held by {}, waiting...'.format(resource, out.decode().strip()))
+
+            time.sleep(2.0)
+    finally:
+        client.close()
+
+
+def release_lease(uri, resource, owner=LEASE_OWNER, verbose=False):
+    f = 'nspawn.leases/{}'.format(resource)
+    command = ''.join([
+        'exec 9>>nspawn.leases/.lock && flock -w 10 9 || exit 75; ',
+        'if [ -f "{f}" ] && read o e < "{f}" && [ "$o" = "{owner}" ]; then rm -f "{f}"; fi',
+    ]).format(f=f, owner=owner)
+
+    client = ssh_client(uri)
+
+    try:
+        exec_command(client, command, verbose=verbose)
+    finally:
+        client.close()
+
+
+def _renew_lease_thread(stop, uri, resource, owner, ttl, verbose=False):
+    while not stop.wait(ttl / 3.0):
+        try:
+            acquire_lease(uri, resource, owner, ttl, wait=0, verbose=verbose)
+        except (IOError, paramiko.SSHException) as e:
+            print('WARNING: Could not renew lease {}: {}'.format(resource, e), file=sys.stderr)
+
+
+@contextlib.contextmanager
+def lease(uri, resource, owner=LEASE_OWNER, ttl=LEASE_TTL, wait=LEASE_WAIT, verbose=False):
+    # short lease on a single resource, renewed while the operation runs
+    acquire_lease(uri, resource, owner, ttl, wait, verbose=verbose)
+    stop = threading.Event()
+
+    t = threading.Thread(
+        target=_renew_lease_thread,
+        args=(stop, uri, resource, owner, ttl),
+        kwargs={'verbose': verbose},
+    )
+
+    t.daemon = True
+    t.start()
+
+    try:
+        yield
+    finally:
+        stop.set()
+        t.join()
+        release_lease(uri, resource, owner, verbose=verbose)
+
+
+def storage_mode(container):
+    # "copy" is a full rootfs, "overlay" a writable layer over machine's base
+    return (container.get('storage') or {}).get('mode', 'copy')
+
+
+def overlay_mount_command(container_id):
+    layer_dir = '{}/{}'.format(LAYERS_DIR, container_id)
+
+    return 'mountpoint -q {d} || mount -t overlay overlay -o {o} {d}'.format(
+        d='/var/lib/machines/{}'.format(container_id),
+        o='lowerdir={l}/lower,upperdir={l}/upper,workdir={l}/work'.format(l=layer_dir),
+    )
+
+
+def render_override(container, restart=False):
+    # systemd-nspawn@ drop-in, ExecStart plus resource controls
+    lines = [
+        '[Service]',
+        'ExecStart=',
+        'ExecStart={}'.format(' '.join(
+            ['/usr/bin/systemd-nspawn', '--quiet', '--keep-unit', '--boot'] +
+            network_arguments(container) +
+            ['--machine={}'.format(container['id'])]
+        )),
+    ]
+
+    if restart:
+        lines.append('Restart=on-failure')
+
+    # rootfs is assembled from base and container layer on start
+    if storage_mode(container) == 'overlay':
+        lines.append("ExecStartPre=/bin/sh -c '{}'".format(overlay_mount_command(container['id'])))
+        lines.append('ExecStopPost=-/usr/bin/umount /var/lib/machines/{}'.format(container['id']))
+
+    lines.extend(limit_properties(container.get('limits', {})))
+    return '\n'.join(lines) + '\n'
+
+
+def write_container_override(client, container, restart=False, verbose=False):
+    unit_dir = '/etc/systemd/system/systemd-nspawn@{}.service.d'.format(container['id'])
+
+    command = 'mkdir -p {d} && cat >{d}/override.conf.tmp && mv {d}/override.conf.tmp {d}/override.conf'.format(
+        d=shlex.quote(unit_dir),
+    )
+
+    status, out, err = exec_command(
+        client,
+        command,
+        input_data=render_override(container, restart).encode(),
+        verbose=verbose,
+    )
+
+    if status != 0:
+        raise IOError(err.decode() or 'Could not write override of {}'.format(container['id']))
+
+
+def pacstrap_command(target):
+    # packages through cluster cache when machine is pointed at one
+    return 'pacstrap $(test -f {c} && echo "-C {c}") -c -d "{t}" base --ignore linux vim openssh'.format(c=PACMAN_CONF, t=target)
+
+
+def ensure_base_arch(client, uri, output, verbose=False):
+    # current base is pointed to by BASE_DIR/arch, bootstrapped once per machine
+    command = 'test -d {b}/arch && readlink -f {b}/arch'.format(b=BASE_DIR)
+    status, out, err = exec_command(client, command, verbose=verbose)
+
+    if status == 0 and out.strip():
+        return out.decode().strip()
+
+    base_dir = '{}/arch-{}'.format(BASE_DIR, time.strftime('%Y%m%d%H%M%S'))
+    command = 'mkdir -p "{d}.tmp" && {p}'.format(d=base_dir, p=pacstrap_command(base_dir + '.tmp'))
+    if verbose: print('{!r}'.format(command))
+
+    chan = client.get_transport().open_session()
+    chan.exec_command(command)
+    status = stream_channel(chan, output)
+    chan.close()
+
+    if status != 0:
+        raise IOError('pacstrap of base failed on {} with exit status {}'.format(uri, status))
+
+    command = 'mv "{d}.tmp" "{d}" && ln -sfn "$(basename {d})" {b}/arch'.format(d=base_dir, b=BASE_DIR)
+    status, out, err = exec_command(client, command, verbose=verbose)
+
+    if status != 0:
+        raise IOError(err.decode() or 'Could not install base on {}'.format(uri))
+
+    return base_dir
+
+
+def create_container_arch_install(uri, container, start=False, verbose=False, output=None):
+    # ssh client
+    client = ssh_client(uri)
+
+    # create machine dir, subvolume on btrfs so backups can send snapshots
+    command = 'mkdir -p "/var/lib/machines/{id}"'.format(**container)
+
+    if storage_mode(container) == 'copy':
+        command = '{{ [ "$(stat -f -c %T /var/lib/machines)" = btrfs ] && btrfs subvolume create "/var/lib/machines/{id}" >/dev/null 2>&1; }} || {c}'.format(c=command, **container)
+    if verbose: print('{!r}'.format(command))
+    stdin, stdout, stderr = client.exec_command(command)
+    out = stdout.read()
+    err = stderr.read()
+    stdin.close()
+    
+    if err:
+        raise IOError(err)
+
+    # wait until other pacman instances finish install
+    while True:
+        command = 'ls /var/lib/pacman/db.lck'
+        if verbose: print('{!r}'.format(command))
+        stdin, stdout, stderr = client.exec_command(command)
+        out = stdout.read()
+        err = stderr.read()
+        stdin.close()
+
+        if out != '/var/lib/pacman/db.lck':
+            break
+
+        print('Machine already using pacman, waiting 5 seconds...')
+        time.sleep(5.0)
+
+    # boostrap container, output is streamed as it is produced
+    machine_dir = '/var/lib/machines/{id}'.format(**container)
+
+    if output is None:
+        output = OutputMux().stream(container['id'], echo=verbose)
+
+    if storage_mode(container) == 'overlay':
+        # thin writable layer over shared base, mounted while being set up
+        with lease(uri, 'base-arch', wait=BASE_WAIT, verbose=verbose):
+            base_dir = ensure_base_arch(client, uri, output, verbose)
+
+        layer_dir = '{}/{}'.format(LAYERS_DIR, container['id'])
+
+        command = 'mkdir -p {l}/upper {l}/work && ln -sfn {b} {l}/lower && {m}'.format(
+            l=layer_dir,
+            b=shlex.quote(base_dir),
+            m=overlay_mount_command(container['id']),
+        )
+
+        status, out, err = exec_command(client, command, verbose=verbose)
+
+        if status != 0:
+            raise IOError(err.decode() or 'Could not mount overlay of {}'.format(container['id']))
+    else:
+        command = pacstrap_command(machine_dir)
+        if verbose: print('{!r}'.format(command))
+
+        chan = client.get_transport().open_session()
+        chan.exec_command(command)
+        status = stream_channel(chan, output)
+        chan.close()
+
+        if status != 0:
+            raise IOError('pacstrap failed on {} with exit status {}'.format(uri, status))
+
+    # resolv.conf
+    command = ''.join([
+        'echo "nameserver 8.8.8.8" > ',
+        '{}/etc/resolv.conf'.format(machine_dir),
+    ])
+    if verbose: print('{!r}'.format(command))
+    stdin, stdout, stderr = client.exec_command(command)
+    out = stdout.read()
+    err = stderr.read()
+    stdin.close()
+
+    # enable systemd-network.service
+    s = '/usr/lib/systemd/system/systemd-networkd.service'
+    d = '/etc/systemd/system/multi-user.target.wants/systemd-networkd.service'
+    command = 'ln -s "{}{}" "{}{}"'.format(machine_dir, s, machine_dir, d)
+    if verbose: print('{!r}'.format(command))
+    stdin, stdout, stderr = client.exec_command(command)
+    out = stdout.read()
+    err = stderr.read()
+    stdin.close()
+
+    # enable systemd-networkd.socket
+    s = '/usr/lib/systemd/system/systemd-networkd.socket'
+    d = '/etc/systemd/system/sockets.target.wants/systemd-networkd.socket'
+    command = 'ln -s "{}{}" "{}{}"'.format(machine_dir, s, machine_dir, d)
+    if verbose: print('{!r}'.format(command))
+    stdin, stdout, stderr = client.exec_command(command)
+    out = stdout.read()
+    err = stderr.read()
+    stdin.close()
+
+    # enable systemd-resolved.service
+    s = '/usr/lib/systemd/system/systemd-resolved.service'
+    d = '/etc/systemd/system/sockets.target.wants/systemd-resolved.service'
+    command = 'ln -s "{}{}" "{}{}"'.format(machine_dir, s, machine_dir, d)
+    if verbose: print('{!r}'.format(command))
+    stdin, stdout, stderr = client.exec_command(command)
+    out = stdout.read()
+    err = stderr.read()
+    stdin.close()
+
+    # enable sshd
+    s = '/usr/lib/systemd/system/sshd.service'
+    d = '/etc/systemd/system/multi-user.target.wants/sshd.service'
+    command = 'ln -s "{}{}" "{}{}"'.format(machine_dir, s, machine_dir, d)
+    if verbose: print('{!r}'.format(command))
+    stdin, stdout, stderr = client.exec_command(command)
+    out = stdout.read()
+    err = stderr.read()
+    stdin.close()
+    
+    # set locale to utf8
+    f = '#en_US.UTF-8 UTF-8'
+    t = 'en_US.UTF-8 UTF-8'
+    p = '{}/etc/locale.gen'.format(machine_dir)
+    command = 'sed -i \'s/{}/{}/g\' "{}"'.format(f, t, p)
+    if verbose: print('{!r}'.format(command))
+    stdin, stdout, stderr = client.exec_command(command)
+    out = stdout.read()
+    err = stderr.read()
+    stdin.close()
+
+    f = '#en_US ISO-8859-1'
+    t = 'en_US ISO-8859-1'
+    p = '{}/etc/locale.gen'.format(machine_dir)
+    command = 'sed -i \'s/{}/{}/g\' "{}"'.format(f, t, p)
+    if verbose: print('{!r}'.format(command))
+    stdin, stdout, stderr = client.exec_command(command)
+    out = stdout.read()
+    err = stderr.read()
+    stdin.close()
+
+    command = 'localectl set-locale LANG=en_US.UTF-8'
+    if verbose: print('{!r}'.format(command))
+    stdin, stdout, stderr = client.exec_command(command)
+    out = stdout.read()
+    err = stderr.read()
+    stdin.close()
+
+    command = 'locale-gen'
+    if verbose: print('{!r}'.format(command))
+    stdin, stdout, stderr = client.exec_command(command)
+    out = stdout.read()
+    err = stderr.read()
+    stdin.close()
+    
+    # patch sshd
+    f = '#PermitRootLogin prohibit-password'
+    t = 'PermitRootLogin yes'
+    p = '{}/etc/ssh/sshd_config'.format(machine_dir)
+    command = 'sed -i \'s/{}/{}/g\' "{}"'.format(f, t, p)
+    if verbose: print('{!r}'.format(command))
+    stdin, stdout, stderr = client.exec_command(command)
+    out = stdout.read()
+    err = stderr.read()
+    stdin.close()
+
+    # patch sshd
+    f = '#PermitEmptyPasswords no'
+    t = 'PermitEmptyPasswords yes'
+    p = '{}/etc/ssh/sshd_config'.format(machine_dir)
+    command = 'sed -i \'s/{}/{}/g\' "{}"'.format(f, t, p)
+    if verbose: print('{!r}'.format(command))
+    stdin, stdout, stderr = client.exec_command(command)
+    out = stdout.read()
+    err = stderr.read()
+    stdin.close()
+
+    # container side of bridge, macvlan and ipvlan interfaces
+    network = container.get('network')
+
+    if network and network['mode'] in ('bridge', 'macvlan', 'ipvlan'):
+        lines = ['[Match]', 'Name=host0 mv-* iv-*', '', '[Network]']
+
+        if network.get('address'):
+            lines.append('Address={}'.format(network['address']))
+
+            if network.get('gateway'):
+                lines.append('Gateway={}'.format(network['gateway']))
+        else:
+            lines.append('DHCP=yes')
+
+        p = '{}/etc/systemd/network/70-nspawn.network'.format(machine_dir)
+        command = 'mkdir -p "$(dirname {p})" && cat >{p}'.format(p=shlex.quote(p))
+        status, out, err = exec_command(client, command, input_data='\n'.join(lines).encode() + b'\n', verbose=verbose)
+
+        if status != 0:
+            raise IOError(err.decode() or 'Could not configure network of {}'.format(container['id']))
+
+    # remove /etc/securetty
+    # to allow 'machinectl login ....'
+    s = '/etc/securetty'
+    d = '/etc/securetty.0'
+    command = 'mv "{}{}" "{}{}"'.format(machine_dir, s, machine_dir, d)
+    if verbose: print('{!r}'.format(command))
+    stdin, stdout, stderr = client.exec_command(command)
+    out = stdout.read()
+    err = stderr.read()
+    stdin.close()
+
+    # unit mounts overlay itself from now on
+    if storage_mode(container) == 'overlay':
+        command = 'umount {}'.format(machine_dir)
+        exec_command(client, command, verbose=verbose)
+
+    # override service
+    write_container_override(client, container, verbose=verbose)
+
+    # demon-reload
+    command = 'systemctl daemon-reload'
+    if verbose: print('{!r}'.format(command))
+    stdin, stdout, stderr = client.exec_command(command)
+    out = stdout.read()
+    err = stderr.read()
+    stdin.close()
+
+    # possibly run container
+    if start:
+        # start service
+        command = 'systemctl start systemd-nspawn@{}.service'.format(container['id'])
+        if verbose: print('{!r}'.format(command))
+        stdin, stdout, stderr = client.exec_command(command)
+        out = stdout.read()
+        err = stderr.read()
+        stdin.close()
+
+        # enable service
+        command = 'systemctl enable systemd-nspawn@{}.service'.format(container['id'])
+        if verbose: print('{!r}'.format(command))
+        stdin, stdout, stderr = client.exec_command(command)
+        out = stdout.read()
+        err = stderr.read()
+        stdin.close()
+
+    # sync
+    command = 'sync'
+    if verbose: print('{!r}'.format(command))
+    stdin, stdout, stderr = client.exec_command(command)
+    out = stdout.read()
+    err = stderr.read()
+    stdin.close()
+
+    # close ssh client
+    client.close()
+
+
+def destroy_container_arch(uri, container, verbose=False):
+    # ssh client
+    client = ssh_client(uri)
+
+    # stop service
+    command = 'systemctl stop systemd-nspawn@{}.service'.format(container['id'])
+    if verbose: print('{!r}'.format(command))
+    stdin, stdout, stderr = client.exec_command(command)
+    out = stdout.read()
+    err = stderr.read()
+    stdin.close()
+
+    # disable service
+    command = 'systemctl disable systemd-nspawn@{}.service'.format(container['id'])
+    if verbose: print('{!r}'.format(command))
+    stdin, stdout, stderr = client.exec_command(command)
+    out = stdout.read()
+    err = stderr.read()
+    stdin.close()
+
+    # rm service
+    command = 'rm -r /etc/systemd/system/systemd-nspawn@{}.service.d'.format(container['id'])
+    if verbose: print('{!r}'.format(command))
+    stdin, stdout, stderr = client.exec_command(command)
+    out = stdout.read()
+    err = stderr.read()
+    stdin.close()
+
+    # overlay layer, base stays for other containers
+    command = 'umount /var/lib/machines/{id} 2>/dev/null; rm -rf {l}/{id}'.format(l=LAYERS_DIR, id=container['id'])
+    if verbose: print('{!r}'.format(command))
+    stdin, stdout, stderr = client.exec_command(command)
+    out = stdout.read()
+    err = stderr.read()
+    stdin.close()
+
+    # backup snapshots, already on backup machine
+    command = 'btrfs subvolume delete -c {s}/{id}/* >/dev/null 2>&1; rm -rf {s}/{id}'.format(s=SNAPSHOTS_DIR, id=container['id'])
+    if verbose: print('{!r}'.format(command))
+    stdin, stdout, stderr = client.exec_command(command)
+    out = stdout.read()
+    err = stderr.read()
+    stdin.close()
+
+    # rm dir
+    command = 'rm -r /var/lib/machines/{}'.format(container['id'])
+    if verbose: print('{!r}'.format(command))
+    stdin, stdout, stderr = client.exec_command(command)
+    out = stdout.read()
+    err = stderr.read()
+    stdin.close()
+
+    # sync
+    command = 'sync'
+    if verbose: print('{!r}'.format(command))
+    stdin, stdout, stderr = client.exec_command(command)
+    out = stdout.read()
+    err = stderr.read()
+    stdin.close()
+
+    # close ssh client
+    client.close()
+
+
+def start_container_arch(uri, container, verbose=False):
+    if verbose:
+        print('start_container_arch: {}'.format(uri))
+
+    # ssh client
+    client = ssh_client(uri)
+
+    # override service
+    write_container_override(client, container, restart=True, verbose=verbose)
+
+    # demon-reload
+    command = 'systemctl daemon-reload'
+    if verbose: print('{!r}'.format(command))
+    stdin, stdout, stderr = client.exec_command(command)
+    out = stdout.read()
+    err = stderr.read()
+    stdin.close()
+    
+    # start service
+    command = 'systemctl start systemd-nspawn@{}.service'.format(container['id'])
+    if verbose: print('{!r}'.format(command))
+    stdin, stdout, stderr = client.exec_command(command)
+    out = stdout.read()
+    err = stderr.read()
+    stdin.close()
+
+    # enable service
+    command = 'systemctl enable systemd-nspawn@{}.service'.format(container['id'])
+    if verbose: print('{!r}'.format(command))
+    stdin, stdout, stderr = client.exec_command(command)
+    out = stdout.read()
+    err = stderr.read()
+    stdin.close()
+
+    # sync
+    command = 'sync'
+    if verbose: print('{!r}'.format(command))
+    stdin, stdout, stderr = client.exec_command(command)
+    out = stdout.read()
+    err = stderr.read()
+    stdin.close()
+
+    # close ssh client
+    client.close()
+
+
+def stop_container_arch(uri, container, verbose=False):
+    if verbose:
+        print('stop_container_arch: {}'.format(uri))
+
+    # ssh client
+    client = ssh_client(uri)
+
+    # demon-reload
+    command = 'systemctl daemon-reload'
+    if verbose: print('{!r}'.format(command))
+    stdin, stdout, stderr = client.exec_command(command)
+    out = stdout.read()
+    err = stderr.read()
+    stdin.close()
+
+    # stop service
+    command = 'systemctl stop systemd-nspawn@{}.service'.format(container['id'])
+    if verbose: print('{!r}'.format(command))
+    stdin, stdout, stderr = client.exec_command(command)
+    out = stdout.read()
+    err = stderr.read()
+    stdin.close()
+
+    # disable service
+    command = 'systemctl disable systemd-nspawn@{}.service'.format(container['id'])
+    if verbose: print('{!r}'.format(command))
+    stdin, stdout, stderr = client.exec_command(command)
+    out = stdout.read()
+    err = stderr.read()
+    stdin.close()
+
+    # sync
+    command = 'sync'
+    if verbose: print('{!r}'.format(command))
+    stdin, stdout, stderr = client.exec_command(command)
+    out = stdout.read()
+    err = stderr.read()
+    stdin.close()
+
+    # close ssh client
+    client.close()
+
+
+def restart_container_arch(uri, container, verbose=False):
+    if verbose:
+        print('restart_container_arch: {}'.format(uri))
+
+    # ssh client
+    client = ssh_client(uri)
+
+    # demon-reload
+    command = 'systemctl daemon-reload'
+    if verbose: print('{!r}'.format(command))
+    stdin, stdout, stderr = client.exec_command(command)
+    out = stdout.read()
+    err = stderr.read()
+    stdin.close()
+
+    # start service
+    command = 'systemctl restart systemd-nspawn@{}.service'.format(container['id'])
+    if verbose: print('{!r}'.format(command))
+    stdin, stdout, stderr = client.exec_command(command)
+    out = stdout.read()
+    err = stderr.read()
+    stdin.close()
+
+    # enable service
+    command = 'systemctl enable systemd-nspawn@{}.service'.format(container['id'])
+    if verbose: print('{!r}'.format(command))
+    stdin, stdout, stderr = client.exec_command(command)
+    out = stdout.read()
+    err = stderr.read()
+    stdin.close()
+
+    # sync
+    command = 'sync'
+    if verbose: print('{!r}'.format(command))
+    stdin, stdout, stderr = client.exec_command(command)
+    out = stdout.read()
+    err = stderr.read()
+    stdin.close()
+
+    # close ssh client
+    client.close()
+
+
+def container_paths(container):
+    # what makes up container on disk, relative to /var/lib/machines
+    if storage_mode(container) == 'overlay':
+        return ['.layers/{}'.format(container['id'])]
+
+    return [container['id']]
+
+
+def copy_container_arch(source_uri, target_uri, container, direct=False, verbose=False):
+    # stream rootfs as tar between machines, container must be stopped
+    paths = ' '.join(container_paths(container))
+    tar_create = 'tar -C /var/lib/machines -cpf - --xattrs --acls --numeric-owner {}'.format(paths)
+    tar_extract = 'mkdir -p /var/lib/machines/.layers && tar -C /var/lib/machines -xpf - --xattrs --acls --numeric-owner'
+    source = ssh_client(source_uri)
+
+    if direct:
+        # source connects to target itself, needs ssh trust between machines
+        user, host, port = parse_uri(target_uri)
+        command = '{} | ssh -o BatchMode=yes -p {} {}@{} {}'.format(
+            tar_create, port, user, host, shlex.quote(tar_extract),
+        )
+
+        status, out, err = exec_command(source, command, timeout=None, verbose=verbose)
+        source.close()
+
+        if status != 0:
+            raise IOError(err.decode() or 'Could not copy container {}'.format(container['id']))
+
+        return
+
+    # relayed through this host in fixed size chunks
+    target = ssh_client(target_uri)
+
+    try:
+        if verbose: print('{!r} | {!r}'.format(tar_create, tar_extract))
+        src = source.get_transport().open_session()
+        dst = target.get_transport().open_session()
+        src.exec_command(tar_create)
+        dst.exec_command(tar_extract)
+
+        while True:
+            data = src.recv(STREAM_CHUNK_SIZE)
+
+            if not data:
+                break
+
+            dst.sendall(data)
+
+        dst.shutdown_write()
+        src_status = src.recv_exit_status()
+        dst_status = dst.recv_exit_status()
+
+        if src_status != 0 or dst_status != 0:
+            err = src.recv_stderr(STREAM_LINE_MAX) + dst.recv_stderr(STREAM_LINE_MAX)
+            raise IOError(err.decode() or 'Could not copy container {}'.format(container['id']))
+    finally:
+        source.close()
+        target.close()
+
+
+def install_copied_container_arch(uri, container, start=False, verbose=False):
+    # overlay layer is put on machine's own base
+    client = ssh_client(uri)
+
+    if storage_mode(container) == 'overlay':
+        with lease(uri, 'base-arch', wait=BASE_WAIT, verbose=verbose):
+            base_dir = ensure_base_arch(client, uri, OutputMux().stream(container['id'], echo=verbose), verbose)
+
+        command = 'mkdir -p /var/lib/machines/{id} && ln -sfn {b} {l}/{id}/lower'.format(
+            id=container['id'],
+            b=shlex.quote(base_dir),
+            l=LAYERS_DIR,
+        )
+
+        status, out, err = exec_command(client, command, verbose=verbose)
+
+        if status != 0:
+            client.close()
+            raise IOError(err.decode() or 'Could not link base of {}'.format(container['id']))
+
+    write_container_override(client, container, restart=True, verbose=verbose)
+    exec_command(client, 'systemctl daemon-reload', verbose=verbose)
+    client.close()
+
+    if start:
+        start_container_arch(uri, container, verbose=verbose)
+
+
+def is_container_active(uri, container, verbose=False):
+    client = ssh_client(uri)
+    command = 'systemctl is-active --quiet systemd-nspawn@{}.service'.format(container['id'])
+    status, out, err = exec_command(client, command, verbose=verbose)
+    client.close()
+    return status == 0
+
+
+def discard_container_copy(uri, container, verbose=False):
+    # partial copy after failed move
+    client = ssh_client(uri)
+    command = 'rm -rf {}'.format(' '.join('/var/lib/machines/{}'.format(n) for n in container_paths(container)))
+    exec_command(client, command, verbose=verbose)
+    client.close()
+
+
+def rolling_restart_container_arch(uri, container, verbose=False):
+    # restart with override rendered from record, previous one kept for rollback
+    client = ssh_client(uri)
+    unit_dir = '/etc/systemd/system/systemd-nspawn@{}.service.d'.format(container['id'])
+
+    command = 'cp -f {d}/override.conf {d}/override.conf.prev 2>/dev/null; true'.format(d=unit_dir)
+    exec_command(client, command, verbose=verbose)
+    write_container_override(client, container, restart=True, verbose=verbose)
+
+    command = 'systemctl daemon-reload && systemctl restart systemd-nspawn@{}.service'.format(container['id'])
+    status, out, err = exec_command(client, command, verbose=verbose)
+    client.close()
+
+    if status != 0:
+        raise IOError(err.decode() or 'Could not restart container {}'.format(container['id']))
+
+
+def rollback_container_arch(uri, container, verbose=False):
+    # previous override back and restart
+    client = ssh_client(uri)
+    unit_dir = '/etc/systemd/system/systemd-nspawn@{}.service.d'.format(container['id'])
+
+    command = ' && '.join([
+        '{{ [ ! -f {d}/override.conf.prev ] || mv -f {d}/override.conf.prev {d}/override.conf; }}',
+        'systemctl daemon-reload',
+        'systemctl restart systemd-nspawn@{id}.service',
+    ]).format(d=unit_dir, id=container['id'])
+
+    status, out, err = exec_command(client, command, verbose=verbose)
+    client.close()
+
+    if status != 0:
+        raise IOError(err.decode() or 'Could not roll back container {}'.format(container['id']))
+
+
+def check_container_health(client, machine, container, gate, port=None, command=None, verbose=False):
+    # single probe, True when container passes gate
+    if gate == 'tcp':
+        network = container.get('network') or {'mode': 'veth'}
+
+        if network['mode'] == 'veth':
+            host_ports = [int(k) for k, v in container['ports'].items() if int(v) == port]
+
+            if not host_ports:
+                raise ValueError('Container {} does not forward port {}'.format(container['id'], port))
+
+            address = (machine['host'], host_ports[0])
+        else:
+            address = (container_address(container), port)
+
+        try:
+            socket.create_connection(address, timeout=2.0).close()
+            return True
+        except (socket.error, socket.timeout):
+            return False
+
+    unit_command = 'systemctl is-active --quiet systemd-nspawn@{}.service'.format(container['id'])
+
+    if gate == 'exec':
+        unit_command += ' && systemd-run --machine={} --wait --pipe --quiet --collect -- /bin/sh -c {}'.format(
+            container['id'],
+            shlex.quote(command),
+        )
+
+    status, out, err = exec_command(client, unit_command, timeout=30, verbose=verbose)
+    return status == 0
+
+
+def update_container_limits_arch(uri, container, changed, verbose=False):
+    if verbose:
+        print('update_container_limits_arch: {}'.format(uri))
+
+    # ssh client
+    client = ssh_client(uri)
+
+    # persist in override, applied on next start
+    write_container_override(client, container, restart=True, verbose=verbose)
+
+    # running unit gets changed properties live, empty value resets
+    unit = 'systemd-nspawn@{}.service'.format(container['id'])
+    limits = container.get('limits', {})
+    properties = []
+
+    for key, property_, pattern in RESOURCE_LIMITS:
+        if key not in changed:
+            continue
+
+        if limits.get(key) is None or isinstance(limits[key], list):
+            properties.append('{}='.format(property_))
+
+        properties.extend(limit_properties({key: limits.get(key)}))
+
+    command = 'systemctl daemon-reload'
+
+    if properties:
+        command += ' && if systemctl is-active --quiet {u}; then systemctl set-property --runtime {u} {p}; fi'.format(
+            u=unit,
+            p=' '.join(shlex.quote(n) for n in properties),
+        )
+
+    status, out, err = exec_command(client, command, verbose=verbose)
+    client.close()
+
+    if status != 0:
+        raise IOError(err.decode() or 'Could not apply limits of {}'.format(container['id']))
+
+
+def upgrade_base_arch(uri, output, verbose=False):
+    # new base version from current one, containers move over on rebase
+    client = ssh_client(uri)
+    base_dir = '{}/arch-{}'.format(BASE_DIR, time.strftime('%Y%m%d%H%M%S'))
+
+    command = ' && '.join([
+        'cur=$(readlink -f {b}/arch)',
+        'test -d "$cur"',
+        'cp -a --reflink=auto "$cur" "{d}.tmp"',
+        'systemd-nspawn -q -D "{d}.tmp" pacman -Syu --noconfirm',
+        'mv "{d}.tmp" "{d}"',
+        'ln -sfn "$(basename {d})" {b}/arch',
+    ]).format(b=BASE_DIR, d=base_dir)
+
+    if verbose: print('{!r}'.format(command))
+    chan = client.get_transport().open_session()
+    chan.exec_command(command)
+    status = stream_channel(chan, output)
+    chan.close()
+    client.close()
+
+    if status != 0:
+        raise IOError('Could not upgrade base on {}, exit status {}'.format(uri, status))
+
+    return base_dir
+
+
+def rebase_container_arch(uri, container, verbose=False):
+    # point layer at current base, restarting container if it runs
+    client = ssh_client(uri)
+
+    command = '; '.join([
+        'u=systemd-nspawn@{id}.service',
+        'a=0',
+        'systemctl is-active --quiet $u && a=1',
+        '[ $a = 0 ] || systemctl stop $u',
+        'umount /var/lib/machines/{id} 2>/dev/null',
+        'b=$(readlink -f {b}/arch) && test -d "$b" && ln -sfn "$b" {l}/{id}/lower || exit 1',
+        '[ $a = 0 ] || systemctl start $u || exit 1',
+        'basename "$b"',
+    ]).format(id=container['id'], b=BASE_DIR, l=LAYERS_DIR)
+
+    status, out, err = exec_command(client, command, verbose=verbose)
+    client.close()
+
+    if status != 0:
+        raise IOError(err.decode() or 'Could not rebase container {}'.format(container['id']))
+
+    return out.decode().strip()
+
+
+def get_machine_layers(uri, copy_ids=(), verbose=False):
+    # base versions, layers and disk usage in one round trip
+    client = ssh_client(uri)
+
+    command = ' '.join([
+        'cd /var/lib/machines 2>/dev/null || exit 0;',
+        'echo "current $(basename "$(readlink .base/arch)")";',
+        'for b in .base/*; do [ -d "$b" ] && [ ! -L "$b" ] || continue;',
+        'echo "base $(basename $b) $(du -sxb $b | cut -f1)"; done;',
+        'for l in .layers/*; do [ -d "$l/upper" ] || continue;',
+        'echo "layer $(basename $l) $(basename "$(readlink $l/lower)") $(du -sxb $l/upper | cut -f1)"; done;',
+        'for c in {}; do [ -d "$c" ] || continue;'.format(' '.join(copy_ids) or '""'),
+        'echo "copy $c $(du -sxb $c | cut -f1)"; done',
+    ])
+
+    status, out, err = exec_command(client, command, verbose=verbose)
+    client.close()
+
+    if status != 0:
+        raise IOError(err.decode() or 'Could not list layers on {}'.format(uri))
+
+    layers = {'current': None, 'bases': {}, 'layers': {}, 'copies': {}}
+
+    for line in out.decode().splitlines():
+        fields = line.split()
+
+        if fields[:1] == ['current'] and len(fields) == 2:
+            layers['current'] = fields[1]
+        elif fields[:1] == ['base'] and len(fields) == 3:
+            layers['bases'][fields[1]] = int(fields[2])
+        elif fields[:1] == ['layer'] and len(fields) == 4:
+            layers['layers'][fields[1]] = {'base': fields[2], 'usage': int(fields[3])}
+        elif fields[:1] == ['copy'] and len(fields) == 3:
+            layers['copies'][fields[1]] = int(fields[2])
+
+    return layers
+
+
+def iter_remote_config(uri, filename='nspawn.remote.conf', missing_ok=False, verbose=False):
+    uri = rebuild_uri(uri)
+
+    if verbose:
+        print('load_remote_config: {} {}'.format(uri, filename))
+
+    # ssh client
+    client = ssh_client(uri)
+
+    if missing_ok:
+        command = 'if [ -f "{f}" ]; then cat "{f}"; fi'.format(f=filename)
+    else:
+        command = 'cat "{}"'.format(filename)
+
+    stdin, stdout, stderr = client.exec_command(command, timeout=COMMAND_TIMEOUT)
+    stdin.close()
+
+    # stream config as it arrives instead of reading it whole
+    def chunks():
+        while True:
+            data = stdout.channel.recv(CONFIG_CHUNK_SIZE)
+
+            if not data:
+                break
+
+            yield data
+
+        if stdout.channel.recv_exit_status() != 0:
+            raise IOError(stderr.read().decode())
+
+    try:
+        for event in iter_config(chunks()):
+            yield event
+    finally:
+        # close ssh client
+        client.close()
+
+
+def load_remote_config(uri, filename='nspawn.remote.conf', missing_ok=False, verbose=False):
+    config = {'generation': 0, 'machines': {}, 'projects': {}, 'containers': {}}
+    events = iter_remote_config(uri, filename, missing_ok, verbose=verbose)
+    fold_config(config, {}, events)
+    return config
+
+
+def save_remote_config(uri, config, filename='nspawn.remote.conf', expected_generation=None, data=None, verbose=False):
+    uri = rebuild_uri(uri)
+    
+    if verbose:
+        print('save_remote_config: {}'.format(uri))
+
+    generation = int(config.get('generation', 0))
+
+    if expected_generation is None:
+        # replica: only move forward, never overwrite a newer generation
+        check = '[ "$gen" -lt {gen} ] || exit 4; '
+    else:
+        # compare-and-swap against generation we loaded
+        check = '[ "$gen" = "{expected}" ] || {{ echo "$gen"; exit 3; }}; '
+
+    command = ''.join([
+        'exec 9>>"{f}.lock" && flock -w 30 9 || exit 75; ',
+        'gen=$(cat "{f}.gen" 2>/dev/null || echo 0); ',
+        check,
+        'cat > "{f}.tmp" && mv "{f}.tmp" "{f}" && echo {gen} > "{f}.gen"',
+    ]).format(f=filename, gen=generation, expected=expected_generation)
+
+    # ssh client
+    client = ssh_client(uri)
+
+    # save remote config
+    if data is None:
+        data = dump_config(config, *config_format())
+
+    status, out, err = exec_command(client, command, input_data=data)
+
+    # close ssh client
+    client.close()
+
+    if status == 3:
+        msg = 'Remote config on {} is at generation {}, expected {}'.format(
+            uri,
+            out.decode().strip(),
+            expected_generation,
+        )
+
+        raise ConfigConflictError(msg)
+    elif status == 4:
+        if verbose:
+            print('save_remote_config: {} already has newer config'.format(uri))
+    elif status != 0:
+        raise IOError(err or 'Could not save remote config on {}'.format(uri))
+
+
+def _iter_config_dict(config):
+    head = {k: v for k, v in config.items() if k != 'containers'}
+    yield ('head', head)
+
+    for container_id, container in config.get('containers', {}).items():
+        yield ('container', container_id, container)
+
+
+def merge_remote_configs(configs):
+    config = {'generation': 0, 'machines': {}, 'projects': {}, 'containers': {}}
+    generations = {}
+
+    for _config in configs:
+        fold_config(config, generations, _iter_config_dict(_config))
+
+    return config
+
+
+def _record_hash(record):
+    m = hashlib.sha1()
+    m.update(json.dumps(record, sort_keys=True).encode())
+    return int(m.hexdigest()[:16], 16)
+
+
+def shard_hash(containers):
+    # order independent, so it can be computed while records stream in
+    h = 0
+
+    for container_id, container in containers.items():
+        h ^= _record_hash(container)
+
+    return '{:016x}:{}'.format(h, len(containers))
+
+
+def shard_summary(containers, generation):
+    projects = Counter(c['project_id'] for c in containers.values())
+
+    summary = {
+        'generation': generation,
+        'containers': len(containers),
+        'projects': dict(projects),
+    }
+
+    return summary
+
+
+def index_hash(config, sections=('machines', 'projects')):
+    m = hashlib.sha1()
+    index = {k: config.get(k, {}) for k in sections}
+    m.update(json.dumps(index, sort_keys=True).encode())
+    return m.hexdigest()
+
+
+def _load_consensus_config_thread(lock, cancel, merged, generations, machine_uri, verbose=False):
+    try:
+        events = iter_remote_config(machine_uri, verbose=verbose)
+        fold_config(merged, generations, events, lock, cancel)
+    except (IOError, paramiko.SSHException) as e:
+        err = 'WARNING: Could not load remote config from {}, skipping'.format(
+            machine_uri,
+        )
+
+        if verbose:
+            print('ERROR: {!r}'.format(e), file=sys.stderr)
+
+        print(err, file=sys.stderr)
+
+
+def _load_shard_thread(lock, cancel, config, machine, filename='nspawn.shard.conf', verbose=False):
+    machine_uri = '{user}@{host}:{port}'.format(**machine)
+    generation = 0
+    h = 0
+    n = 0
+
+    try:
+        events = iter_remote_config(machine_uri, filename, missing_ok=True, verbose=verbose)
+
+        for event in events:
+            if event[0] == 'head':
+                generation = event[1].get('generation', 0)
+                continue
+
+            _, container_id, container = event
+            h ^= _record_hash(container)
+            n += 1
+
+            with lock:
+                if cancel.is_set():
+                    return
+
+                config['containers'][container_id] = container
+    except (IOError, paramiko.SSHException) as e:
+        err = 'WARNING: Could not load containers from {}, skipping'.format(
+            machine_uri,
+        )
+
+        if verbose:
+            print('ERROR: {!r}'.format(e), file=sys.stderr)
+
+        print(err, file=sys.stderr)
+        return
+
+    with lock:
+        if cancel.is_set():
+            return
+
+        config['shards'][machine['id']] = {
+            'generation': generation,
+            'hash': '{:016x}:{}'.format(h, n),
+        }
+
+
+def ensure_shards(config, machine_ids=None, verbose=False):
+    # load container shards of given machines, in parallel
+    machines = config['machines']
+
+    if machine_ids is None:
+        machine_ids = list(machines.keys())
+
+    threads = []
+    lock = threading.Lock()
+    cancel = threading.Event()
+
+    for machine_id in machine_ids:
+        if machine_id in config['shards'] or machine_id not in machines:
+            continue
+
+        t = threading.Thread(
+            target=_load_shard_thread,
+            args=(lock, cancel, config, machines[machine_id]),
+            kwargs={'verbose': verbose},
+        )
+
+        t.daemon = True
+        t.start()
+        threads.append(t)
+
+    # slow machines are skipped once deadline passes
+    if join_threads(threads):
+        with lock:
+            cancel.set()
+
+        print('WARNING: Some machines did not respond in time, skipping', file=sys.stderr)
+
+    return config
+
+
+def project_machine_ids(config, project_id):
+    # machines whose summary says they host project, unknown ones included
+    machine_ids = []
+    summaries = config.get('summaries', {})
+
+    for machine_id in config['machines']:
+        summary = summaries.get(machine_id)
+
+        if summary is None or any(p.endswith(project_id) for p in summary['projects']):
+            machine_ids.append(machine_id)
+
+    return machine_ids
+
+
+def find_container(config, container_id, verbose=False):
+    if container_id not in config['containers']:
+        ensure_shards(config, verbose=verbose)
+
+    if container_id not in config['containers']:
+        msg = 'Container with id {} does not exists'.format(container_id)
+        print(msg, file=sys.stderr)
+        sys.exit(-1)
+
+    return config['containers'][container_id]
+
+
+def load_cluster_config(uri, machine_ids=None, filename='nspawn.remote.conf', verbose=False):
+    try:
+        return read_cluster_config(uri, machine_ids, filename, verbose=verbose)
+    except ClusterError as e:
+        print('ERROR: Could not load remote config.')
+        sys.exit(-1)
+
+
+def read_cluster_config(uri, machine_ids=None, filename='nspawn.remote.conf', verbose=False):
+    # global index of machines, projects and per-machine summaries
+    try:
+        index = load_remote_config(uri, filename, verbose=verbose)
+    except IOError as e:
+        raise ClusterError('Could not load remote config: {}'.format(e))
+
+    config = {
+        'generation': index.get('generation', 0),
+        'machines': index.get('machines', {}),
+        'projects': index.get('projects', {}),
+        'summaries': index.get('summaries', {}),
+        'containers': {},
+        'shards': {},
+    }
+
+    config['index_hash'] = index_hash(config)
+    config['summaries_hash'] = index_hash(config, ('summaries',))
+    legacy_containers = index.get('containers', {})
+
+    if legacy_containers:
+        # full copies from before sharding, migrated on next save
+        machine_ids = None
+        config['index_hash'] = None
+        legacy = {'generation': 0, 'machines': {}, 'projects': {}, 'containers': {}}
+        generations = {}
+        fold_config(legacy, generations, _iter_config_dict(index))
+        threads = []
+        lock = threading.Lock()
+        cancel = threading.Event()
+
+        for machine_id, machine in config['machines'].items():
+            machine_uri = '{user}@{host}:{port}'.format(**machine)
+
+            if machine_uri == rebuild_uri(uri):
+                continue
+
+            t = threading.Thread(
+                target=_load_consensus_config_thread,
+                args=(lock, cancel, legacy, generations, machine_uri),
+                kwargs={'verbose': verbose},
+            )
+
+            t.daemon = True
+            t.start()
+            threads.append(t)
+
+        if join_threads(threads):
+            with lock:
+                cancel.set()
+
+        legacy_containers = legacy['containers']
+
+    index = None
+    ensure_shards(config, machine_ids, verbose=verbose)
+
+    # shards take precedence over legacy copies
+    for container_id, container in legacy_containers.items():
+        config['containers'].setdefault(container_id, container)
+
+    return config
+
+
+def load_consensus_config(uri, filename='nspawn.remote.conf', verbose=False):
+    return load_cluster_config(uri, None, filename, verbose=verbose)
+
+
+def _save_consensus_config_thread(lock, config, data, machine_uri, verbose=False):
+    try:    
+        save_remote_config(machine_uri, config, data=data, verbose=verbose)
+    except (IOError, paramiko.SSHException) as e:
+        # replica catches up with next save
+        err = 'WARNING: Could not save remote config on {}, skipping'.format(
+            machine_uri,
+        )
+
+        if verbose:
+            print('ERROR: {!r}'.format(e), file=sys.stderr)
+
+        print(err, file=sys.stderr)
+
+
+def _save_shard_thread(lock, errors, shard, expected_generation, machine_uri, verbose=False):
+    try:
+        save_remote_config(
+            machine_uri,
+            shard,
+            'nspawn.shard.conf',
+            expected_generation=expected_generation,
+            verbose=verbose,
+        )
+    except (IOError, paramiko.SSHException) as e:
+        with lock:
+            errors.append(e)
+
+
+def save_shards(config, verbose=False):
+    # group containers of loaded shards by hosting machine
+    groups = {machine_id: {} for machine_id in config['shards']}
+
+    for container_id, container in config['containers'].items():
+        if container['machine_id'] in groups:
+            groups[container['machine_id']][container_id] = container
+        elif container['machine_id'] in config['machines']:
+            # saving without shard would drop record silently
+            raise ClusterError('Containers of machine {} are not loaded, can not save {}'.format(container['machine_id'], container_id))
+
+    # write only shards which changed, each on its own machine
+    dirty = {}
+    threads = []
+    errors = []
+    lock = threading.Lock()
+
+    for machine_id, containers in groups.items():
+        loaded = config['shards'][machine_id]
+
+        if shard_hash(containers) == loaded['hash'] or machine_id not in config['machines']:
+            continue
+
+        shard = {
+            'generation': loaded['generation'] + 1,
+            'machine_id': machine_id,
+            'containers': containers,
+        }
+
+        dirty[machine_id] = shard
+        machine_uri = '{user}@{host}:{port}'.format(**config['machines'][machine_id])
+
+        t = threading.Thread(
+            target=_save_shard_thread,
+            args=(lock, errors, shard, loaded['generation'], machine_uri),
+            kwargs={'verbose': verbose},
+        )
+
+        t.daemon = True
+        t.start()
+        threads.append(t)
+
+    if join_threads(threads):
+        with lock:
+            errors.append(IOError('Timed out saving containers'))
+
+    for e in errors:
+        if isinstance(e, ConfigConflictError):
+            raise e
+
+    if errors:
+        raise ClusterError('Could not save containers: {}'.format(errors[0]))
+
+    for machine_id, shard in dirty.items():
+        config['shards'][machine_id] = {
+            'generation': shard['generation'],
+            'hash': shard_hash(shard['containers']),
+        }
+
+        config['summaries'][machine_id] = shard_summary(shard['containers'], shard['generation'])
+
+    return dirty
+
+
+def save_consensus_config(config, filename='nspawn.remote.conf', remote_uri=None, verbose=False):
+    # container records go only to their hosting machines
+    dirty = save_shards(config, verbose=verbose)
+
+    summaries = {
+        machine_id: summary
+        for machine_id, summary in config['summaries'].items()
+        if machine_id in config['machines']
+    }
+
+    index_changed = index_hash(config) != config['index_hash']
+    summaries_changed = index_hash({'summaries': summaries}, ('summaries',)) != config['summaries_hash']
+
+    if not index_changed and not summaries_changed:
+        return
+
+    expected_generation = config.get('generation', 0)
+
+    index = {
+        'generation': expected_generation + 1,
+        'machines': config['machines'],
+        'projects': config['projects'],
+        'summaries': summaries,
+    }
+
+    # main node serializes writers of small index, replicas only follow it
+    if remote_uri:
+        remote_uri = rebuild_uri(remote_uri)
+
+        for attempt in range(CONSENSUS_RETRIES):
+            try:
+                save_remote_config(
+                    remote_uri,
+                    index,
+                    filename,
+                    expected_generation=expected_generation,
+                    verbose=verbose,
+                )
+
+                break
+            except ConfigConflictError:
+                if index_changed or attempt == CONSENSUS_RETRIES - 1:
+                    raise
+
+            # only summaries changed, rebase them onto latest index
+            latest = load_remote_config(remote_uri, filename, verbose=verbose)
+            summaries = latest.get('summaries', {})
+
+            for machine_id, shard in dirty.items():
+                if summaries.get(machine_id, {}).get('generation', -1) < shard['generation']:
+                    summaries[machine_id] = config['summaries'][machine_id]
+
+            expected_generation = latest.get('generation', 0)
+
+            index = {
+                'generation': expected_generation + 1,
+                'machines': latest.get('machines', {}),
+                'projects': latest.get('projects', {}),
+                'summaries': summaries,
+            }
+
+    config['generation'] = index['generation']
+    config['summaries'] = index['summaries']
+    config['index_hash'] = index_hash(index)
+    config['summaries_hash'] = index_hash(index, ('summaries',))
+
+    # encode once for all nodes
+    data = dump_config(index, *config_format())
+    threads = []
+    lock = threading.Lock()
+
+    for machine_id, machine in index['machines'].items():
+        machine_uri = '{user}@{host}:{port}'.format(**machine)
+
+        if machine_uri == remote_uri:
+            continue
+
+        t = threading.Thread(
+            target=_save_consensus_config_thread,
+            args=(lock, index, data, machine_uri),
+            kwargs={'verbose': verbose},
+        )
+
+        t.daemon = True
+        t.start()
+        threads.append(t)
+
+    if join_threads(threads):
+        print('WARNING: Some replicas did not respond in time, skipping', file=sys.stderr)
+
+
+def consensus_transaction(remote_uri, mutate, machine_ids=None, retries=CONSENSUS_RETRIES, verbose=False):
+    try:
+        return transaction(remote_uri, mutate, machine_ids, retries, verbose=verbose)
+    except ConfigConflictError:
+        msg = 'Could not save remote config, too many concurrent updates'
+        print(msg, file=sys.stderr)
+        sys.exit(1)
+    except ClusterError as e:
+        print('ERROR: {}'.format(e), file=sys.stderr)
+        sys.exit(-1)
+
+
+def transaction(remote_uri, mutate, machine_ids=None, retries=CONSENSUS_RETRIES, verbose=False):
+    # load, mutate and compare-and-swap save, re-planning on conflict
+    for attempt in range(retries):
+        config = read_cluster_config(remote_uri, machine_ids, verbose=verbose)
+        result = mutate(config)
+
+        try:
+            save_consensus_config(config, remote_uri=remote_uri, verbose=verbose)
+        except ConfigConflictError as e:
+            if verbose:
+                print('consensus_transaction: {}, retrying'.format(e))
+
+            # shards may be saved before index conflict, next attempt loads
+            # them so records placed by this one are reused, not duplicated
+            if machine_ids is not None:
+                machine_ids = sorted(set(machine_ids) | set(config['shards']))
+
+            time.sleep(random.uniform(0, 0.25 * 2 ** attempt))
+            continue
+
+        return config, result
+
+    raise ConfigConflictError('Could not save remote config, too many concurrent updates')
+
+
+#
+# stats
+#
+class MetricsRing(object):
+    # fixed size array per field, oldest sample is overwritten
+    def __init__(self, size=STATS_SAMPLES):
+        self.size = size
+        self.head = 0
+        self.count = 0
+        self.fields = {f: array('d', [0.0]) * size for f in STATS_FIELDS}
+
+    def append(self, sample):
+        for f in STATS_FIELDS:
+            self.fields[f][self.head] = float(sample.get(f, 0.0))
+
+        self.head = (self.head + 1) % self.size
+        self.count = min(self.count + 1, self.size)
+
+    def indexes(self, window=None):
+        # chronological slots, limited to last window seconds
+        first = (self.head - self.count) % self.size
+        slots = [(first + i) % self.size for i in range(self.count)]
+
+        if window is not None and slots:
+            since = self.fields['time'][slots[-1]] - window
+            slots = [i for i in slots if self.fields['time'][i] >= since]
+
+        return slots
+
+    def latest(self):
+        if not self.count:
+            return None
+
+        i = (self.head - 1) % self.size
+        return {f: self.fields[f][i] for f in STATS_FIELDS}
+
+    def values(self, field, window=None):
+        return [self.fields[field][i] for i in self.indexes(window)]
+
+    def rates(self, field, window=None):
+        # per second rate of counter between consecutive samples
+        t = self.fields['time']
+        v = self.fields[field]
+        slots = self.indexes(window)
+        rates = []
+
+        for a, b in zip(slots, slots[1:]):
+            # too short intervals are mostly noise
+            if t[b] - t[a] >= 1.0 and v[b] >= v[a]:
+                rates.append((v[b] - v[a]) / (t[b] - t[a]))
+
+        return rates
+
+    def rate(self, field, window=None):
+        rates = self.rates(field, window)
+        return sum(rates) / len(rates) if rates else None
+
+    def cpu_usage(self, window=None):
+        # busy share of each interval, 0-100
+        t = self.fields['time']
+        busy = self.fields['cpu_busy']
+        total = self.fields['cpu_total']
+        slots = self.indexes(window)
+        usage = []
+
+        for a, b in zip(slots, slots[1:]):
+            if t[b] - t[a] >= 1.0 and total[b] > total[a] and busy[b] >= busy[a]:
+                usage.append(100.0 * (busy[b] - busy[a]) / (total[b] - total[a]))
+
+        return usage
+
+    def dump(self):
+        return {
+            'size': self.size,
+            'head': self.head,
+            'count': self.count,
+            'fields': {f: base64.b64encode(a.tobytes()).decode() for f, a in self.fields.items()},
+        }
+
+    @classmethod
+    def load(cls, data):
+        ring = cls(data['size'])
+        ring.head = data['head']
+        ring.count = data['count']
+
+        for f, encoded in data['fields'].items():
+            if f not in ring.fields:
+                continue
+
+            a = array('d')
+            a.frombytes(base64.b64decode(encoded))
+
+            if len(a) == ring.size:
+                ring.fields[f] = a
+
+        return ring
+
+
+def percentile(values, p):
+    # nearest rank
+    if not values:
+        return None
+
+    values = sorted(values)
+    rank = int(-(-p * len(values) // 100))
+    return values[max(0, min(len(values), rank) - 1)]
+
+
+def load_stats():
+    filename = 'nspawn.local.stats'
+    rings = {}
+
+    if os.path.exists(filename):
+        try:
+            with open(filename, 'r') as f:
+                data = json.load(f)
+        except ValueError:
+            data = {}
+
+        for machine_id, ring_data in data.items():
+            try:
+                rings[machine_id] = MetricsRing.load(ring_data)
+            except (KeyError, ValueError, TypeError):
+                continue
+
+    return rings
+
+
+def save_stats(rings):
+    filename = 'nspawn.local.stats'
+    data = {machine_id: ring.dump() for machine_id, ring in rings.items()}
+
+    with open(filename + '.tmp', 'w') as f:
+        json.dump(data, f)
+
+    os.rename(filename + '.tmp', filename)
+
+
+def fresh_stats(ring, max_age=STATS_MAX_AGE):
+    # latest sample if recent enough to base decisions on
+    sample = ring.latest() if ring else None
+
+    if sample is None or time.time() - sample['time'] > max_age:
+        return None
+
+    return sample
+
+
+def get_machine_stats(uri, verbose=False):
+    # one round trip reading /proc and statvfs of machines dir
+    client = ssh_client(uri)
+
+    command = ' '.join([
+        'echo @load; cat /proc/loadavg;',
+        'echo @cpu; grep "^cpu" /proc/stat;',
+        'echo @mem; grep -E "^(MemTotal|MemAvailable):" /proc/meminfo;',
+        'echo @disk; stat -f -c "%S %b %a" /var/lib/machines;',
+        'echo @net; tail -n +3 /proc/net/dev',
+    ])
+
+    status, out, err = exec_command(client, command, verbose=verbose)
+    client.close()
+
+    if status != 0:
+        raise IOError(err or 'Could not read stats on {}'.format(uri))
+
+    sample = {f: 0.0 for f in STATS_FIELDS}
+    sample['time'] = time.time()
+    section = None
+
+    for line in out.decode().splitlines():
+        if line.startswith('@'):
+            section = line[1:]
+            continue
+
+        fields = line.replace(':', ' ').split()
+
+        if not fields:
+            continue
+
+        if section == 'load':
+            sample['load1'], sample['load5'], sample['load15'] = map(float, fields[:3])
+        elif section == 'cpu' and fields[0] == 'cpu':
+            # user nice system idle iowait irq softirq steal
+            ticks = [float(n) for n in fields[1:9]]
+            sample['cpu_total'] = sum(ticks)
+            sample['cpu_busy'] = sample['cpu_total'] - ticks[3] - ticks[4]
+        elif section == 'cpu':
+            sample['cpus'] += 1
+        elif section == 'mem' and fields[0] == 'MemTotal':
+            sample['mem_total'] = float(fields[1]) * 1024
+        elif section == 'mem' and fields[0] == 'MemAvailable':
+            sample['mem_available'] = float(fields[1]) * 1024
+        elif section == 'disk':
+            block_size, blocks, available = map(float, fields[:3])
+            sample['disk_total'] = block_size * blocks
+            sample['disk_free'] = block_size * available
+        elif section == 'net' and fields[0] != 'lo':
+            sample['net_rx'] += float(fields[1])
+            sample['net_tx'] += float(fields[9])
+
+    return sample
+
+
+def _stats_machine_thread(lock, samples, machine, verbose=False):
+    machine_uri = '{user}@{host}:{port}'.format(**machine)
+
+    try:
+        sample = get_machine_stats(machine_uri, verbose=verbose)
+    except (IOError, paramiko.SSHException, ValueError, IndexError) as e:
+        err = 'WARNING: Could not read stats from {}, skipping'.format(
+            machine_uri,
+        )
+
+        if verbose:
+            print('ERROR: {!r}'.format(e), file=sys.stderr)
+
+        print(err, file=sys.stderr)
+        return
+
+    with lock:
+        samples[machine['id']] = sample
+
+
+def collect_stats(config, machine_ids=None, verbose=False):
+    # sample machines concurrently and append to local rings
+    machines = config['machines']
+
+    if machine_ids is None:
+        machine_ids = list(machines)
+
+    threads = []
+    lock = threading.Lock()
+    samples = {}
+
+    for machine_id in machine_ids:
+        t = threading.Thread(
+            target=_stats_machine_thread,
+            args=(lock, samples, machines[machine_id]),
+            kwargs={'verbose': verbose},
+        )
+
+        t.daemon = True
+        t.start()
+        threads.append(t)
+
+    join_threads(threads)
+    rings = load_stats()
+
+    with lock:
+        for machine_id, sample in samples.items():
+            rings.setdefault(machine_id, MetricsRing()).append(sample)
+
+    # forget machines no longer in cluster
+    for machine_id in list(rings):
+        if machine_id not in machines:
+            del rings[machine_id]
+
+    save_stats(rings)
+    return rings
+
+
+def machine_saturated(sample):
+    # nearly out of memory or rootfs space
+    if sample is None:
+        return False
+
+    if sample['mem_total'] and sample['mem_available'] < 0.05 * sample['mem_total']:
+        return True
+
+    if sample['disk_total'] and sample['disk_free'] < 0.05 * sample['disk_total']:
+        return True
+
+    return False
+
+
+def machine_load(sample):
+    # load per cpu, unknown machines count as idle
+    if sample is None:
+        return 0.0
+
+    return sample['load1'] / max(sample['cpus'], 1.0)
+
+
+def machine_container_counts(config):
+    # loaded shards are exact, others come from index summaries
+    counter = Counter({machine_id: 0 for machine_id in config['machines']})
+    summaries = config.get('summaries', {})
+    shards = config.get('shards', {})
+
+    for machine_id in config['machines']:
+        if machine_id not in shards:
+            counter[machine_id] += summaries.get(machine_id, {}).get('containers', 0)
+
+    for container in config['containers'].values():
+        if container['machine_id'] in counter and container['machine_id'] in shards:
+            counter[container['machine_id']] += 1
+
+    return counter
+
+
+def placement_constraints(config, container):
+    # project defaults, container record overrides
+    project = config['projects'].get(container['project_id'], {})
+    constraints = dict(project.get('placement') or {})
+    constraints.update(container.get('placement') or {})
+    return constraints
+
+
+class PlacementIndex(object):
+    # containers per machine by project and group, built once per placement run
+    def __init__(self, config):
+        self.machines = config['machines']
+        self.projects = {n: Counter() for n in self.machines}
+        self.groups = {n: Counter() for n in self.machines}
+        self.avoided = {n: Counter() for n in self.machines}
+        summaries = config.get('summaries', {})
+        shards = config.get('shards', {})
+
+        # unloaded machines are known only by project counts of index
+        for machine_id in self.machines:
+            if machine_id not in shards:
+                self.projects[machine_id].update(summaries.get(machine_id, {}).get('projects', {}))
+
+        for container in config['containers'].values():
+            if container['machine_id'] in shards:
+                self.add(container, container['machine_id'])
+
+    def add(self, container, machine_id):
+        if machine_id not in self.machines:
+            return
+
+        self.projects[machine_id][container['project_id']] += 1
+
+        if container.get('group'):
+            self.groups[machine_id][container['group']] += 1
+
+        for group in (container.get('placement') or {}).get('anti_affinity', []):
+            self.avoided[machine_id][group] += 1
+
+    def count(self, machine_id, container):
+        # replicas are same group, or same project when group is not set
+        if container.get('group'):
+            return self.groups[machine_id][container['group']]
+
+        return self.projects[machine_id][container['project_id']]
+
+    def allows(self, machine_id, container, constraints, candidates):
+        labels = self.machines[machine_id].get('labels', {})
+
+        if self.count(machine_id, container) + 1 > constraints.get('max_per_machine', float('inf')):
+            return False
+
+        # anti-affinity holds both ways
+        if any(self.groups[machine_id][n] for n in constraints.get('anti_affinity', [])):
+            return False
+
+        if container.get('group') and self.avoided[machine_id][container['group']]:
+            return False
+
+        # with no member placed yet any machine will do
+        for group in constraints.get('affinity', []):
+            if not self.groups[machine_id][group] and any(self.groups[n][group] for n in self.machines):
+                return False
+
+        for spread in constraints.get('spread', []):
+            if spread['label'] not in labels:
+                return False
+
+            domains = Counter()
+
+            for n in candidates:
+                value = self.machines[n].get('labels', {}).get(spread['label'])
+
+                if value is not None:
+                    domains[value] += self.count(n, container)
+
+            if domains[labels[spread['label']]] + 1 - min(domains.values()) > spread['max_skew']:
+                return False
+
+        return True
+
+
+def placement_index(config, container):
+    # None when container has no constraints
+    constraints = placement_constraints(config, container)
+
+    # strategy alone needs no per machine counts by project or group
+    if not set(constraints) - {'strategy', 'max_load'} and not container.get('group'):
+        return None
+
+    # groups are only known from container records
+    if container.get('group') or 'affinity' in constraints or 'anti_affinity' in constraints:
+        ensure_shards(config)
+
+    return PlacementIndex(config)
+
+
+def machine_weight(machine):
+    return float(machine.get('weight', 1.0))
+
+
+def hrw_score(key, machine):
+    # weighted rendezvous hash, highest score wins
+    digest = hashlib.sha1('{}:{}'.format(key, machine['id']).encode()).digest()
+    h = (int.from_bytes(digest[:8], 'big') + 0.5) / 2 ** 64
+    return -machine_weight(machine) / math.log(h)
+
+
+def hrw_machines(config, key, machine_ids=None):
+    # machines by preference for key, same order on every client
+    machines = config['machines']
+    machine_ids = list(machines) if machine_ids is None else machine_ids
+    return sorted(machine_ids, key=lambda n: (-hrw_score(key, machines[n]), n))
+
+
+def hrw_capacity(config, machine_ids, max_load, total):
+    # bounded load, no machine takes over max_load times its weighted share
+    machines = config['machines']
+    weights = sum(machine_weight(machines[n]) for n in machine_ids)
+
+    return {
+        n: math.ceil(max_load * total * machine_weight(machines[n]) / weights)
+        for n in machine_ids
+    }
+
+
+def find_hash_machine(config, container, constraints, index=None):
+    # only machine list is needed, counts come from index summaries
+    machines = config['machines']
+    machine_ids = [n for n in machines if not machines[n].get('drain')] or list(machines)
+    ranked = hrw_machines(config, container['id'], machine_ids)
+
+    if index is not None:
+        ranked = [n for n in ranked if index.allows(n, container, constraints, machine_ids)]
+
+    if constraints.get('max_load'):
+        counter = machine_container_counts(config)
+        total = sum(counter[n] for n in machine_ids) + 1
+        capacity = hrw_capacity(config, machine_ids, constraints['max_load'], total)
+        ranked = [n for n in ranked if counter[n] < capacity[n]]
+
+    if not ranked:
+        raise PlacementError('No machine satisfies placement constraints of container {}'.format(container['name']))
+
+    if index is not None:
+        index.add(container, ranked[0])
+
+    return machines[ranked[0]]
+
+
+def find_available_machine(config, container, index=None):
+    machines = config['machines']
+    constraints = placement_constraints(config, container)
+
+    if constraints.get('strategy') == 'hash':
+        return find_hash_machine(config, container, constraints, index)
+
+    counter = machine_container_counts(config)
+
+    # last collected stats, no probing here
+    rings = load_stats()
+    samples = {n: fresh_stats(rings.get(n)) for n in machines}
+
+    # draining machines only get emptied
+    machine_ids = [n for n in machines if not machines[n].get('drain')] or list(machines)
+    machine_ids = [n for n in machine_ids if not machine_saturated(samples[n])] or machine_ids
+
+    if index is None:
+        index = placement_index(config, container)
+
+    if index is None:
+        # find least occupied machine, then least loaded, then by host
+        machine_id = min(machine_ids, key=lambda n: (
+            counter[n],
+            machine_load(samples[n]),
+            machines[n]['host'],
+        ))
+
+        return machines[machine_id]
+
+    allowed = [n for n in machine_ids if index.allows(n, container, constraints, machine_ids)]
+
+    if not allowed:
+        raise PlacementError('No machine satisfies placement constraints of container {}'.format(container['name']))
+
+    # fewest replicas first, then as without constraints
+    machine_id = min(allowed, key=lambda n: (
+        index.count(n, container),
+        counter[n],
+        machine_load(samples[n]),
+        machines[n]['host'],
+    ))
+
+    index.add(container, machine_id)
+    return machines[machine_id]
+
+
+def get_machine_listening_ports(uri, verbose=False):
+    # one batched look at sockets bound on host
+    client = ssh_client(uri)
+    command = 'ss -ltnH'
+    status, out, err = exec_command(client, command, verbose=verbose)
+    client.close()
+
+    if status != 0:
+        raise IOError(err or 'Could not list listening ports on {}'.format(uri))
+
+    ports = set()
+
+    for line in out.decode().splitlines():
+        fields = line.split()
+
+        if len(fields) < 4:
+            continue
+
+        port = fields[3].rsplit(':', 1)[-1]
+
+        if port.isdigit():
+            ports.add(int(port))
+
+    return ports
+
+
+def machine_forwarded_ports(config, machine):
+    # host ports of all containers on machine, in or out of allocator ranges
+    ports = set()
+
+    for container_id, container in config['containers'].items():
+        if container['machine_id'] == machine['id']:
+            ports.update(int(n) for n in container['ports'])
+
+    return ports
+
+
+def machine_port_allocator(config, machine, listening_ports=None):
+    ranges = machine.get('port_ranges') or DEFAULT_PORT_RANGES
+    allocator = PortAllocator(ranges)
+
+    # project reservations
+    for project_id, project in config.get('projects', {}).items():
+        for start, end in project.get('port_ranges', []):
+            allocator.reserve(start, end, project_id)
+
+    # ports forwarded by containers on that machine
+    for port in machine_forwarded_ports(config, machine):
+        allocator.mark(port)
+
+    # ports bound by host itself
+    for port in listening_ports or ():
+        allocator.mark(port)
+
+    return allocator
+
+
+def find_available_machine_port(config, machine, dest_port, project_id=None, allocator=None):
+    if allocator is None:
+        allocator = machine_port_allocator(config, machine)
+
+    # keep familiar mapping 22 -> 10022 when it is free
+    port = dest_port
+
+    if port < 10000:
+        port += 10000
+
+    return allocator.allocate(project_id, hint=port)
+
+
+def find_host_network_ports(config, machine, requested_ports, listening_ports=None):
+    # container binds host ports itself, so they only need to be free
+    used = set(listening_ports or ()) | machine_forwarded_ports(config, machine)
+
+    ports = {}
+
+    for src_port, dest_port in requested_ports:
+        if src_port and int(src_port) != dest_port:
+            raise PortAllocationError('Port {} cannot be mapped to {} on host network'.format(src_port, dest_port))
+
+        if dest_port in used or dest_port in ports:
+            raise PortAllocationError('Port {} is already used on machine {}'.format(dest_port, machine['id']))
+
+        ports[dest_port] = dest_port
+
+    return ports
+
+
+def find_available_machine_ports(config, machine, requested_ports, project_id=None, listening_ports=None, network_mode='veth'):
+    # bridge, macvlan and ipvlan containers have own address, nothing to forward
+    if network_mode in ('bridge', 'macvlan', 'ipvlan'):
+        return {}
+
+    if network_mode == 'host':
+        return find_host_network_ports(config, machine, requested_ports, listening_ports)
+
+    allocator = machine_port_allocator(config, machine, listening_ports)
+    forwarded = machine_forwarded_ports(config, machine)
+    available_ports_map = {}
+
+    # explicitly requested ports first, so they do not get handed out
+    for src_port, dest_port in requested_ports:
+        if not src_port:
+            continue
+
+        src_port = int(src_port)
+
+        if src_port in available_ports_map or src_port in forwarded or allocator.is_used(src_port) or src_port in (listening_ports or ()):
+            raise PortAllocationError('Port {} is already used on machine {}'.format(src_port, machine['id']))
+
+        allocator.mark(src_port)
+        available_ports_map[src_port] = dest_port
+
+    for src_port, dest_port in requested_ports:
+        if src_port:
+            continue
+
+        src_port = find_available_machine_port(config, machine, dest_port, project_id, allocator)
+        available_ports_map[src_port] = dest_port
+
+    return available_ports_map
+
+
+def place_container(config, container, requested_ports, machine_id=None, listening_ports_map=None, verbose=False, index=None):
+    # pick machine and host ports for new container record
+    machines = config['machines']
+    network = container.get('network')
+    network_mode = network['mode'] if network else 'veth'
+
+    if listening_ports_map is None:
+        listening_ports_map = {}
+
+    # find suitable machine where to host container, explicit machine wins over constraints
+    if machine_id:
+        machine = machines[machine_id]
+
+        if index is not None:
+            index.add(container, machine_id)
+    else:
+        machine = find_available_machine(config, container, index)
+
+    container['machine_id'] = machine['id']
+    container['host'] = machine['host']
+
+    # only hosting machine's containers are needed for ports
+    ensure_shards(config, [machine['id']], verbose=verbose)
+
+    if machine['id'] not in config['shards']:
+        raise ClusterError('Could not load containers of machine {}'.format(machine['id']))
+
+    # find available ports, own address needs none of host's
+    if network_mode in ('veth', 'host') and machine['id'] not in listening_ports_map:
+        machine_uri = '{user}@{host}:{port}'.format(**machine)
+        listening_ports_map[machine['id']] = get_machine_listening_ports(machine_uri, verbose=verbose)
+
+    listening_ports = listening_ports_map.get(machine['id'])
+    container['ports'] = find_available_machine_ports(
+        config,
+        machine,
+        requested_ports,
+        container['project_id'],
+        listening_ports,
+        network_mode,
+    )
+
+    if network_mode == 'host':
+        network['address'] = machine['host']
+    elif network_mode != 'veth':
+        network['ports'] = [dest_port for src_port, dest_port in requested_ports]
+
+    return machine
+
+
+#
+# config
+#
+def config_config(section, property_, value=None):
+    config = load_local_config()
+
+    if section not in config:
+        config[section] = {}
+
+    if value:
+        config[section][property_] = value    
+        save_local_config(config)
+    else:
+        value = config[section][property_]
+        print(value)
+
+
+#
+# machine
+#
+def _format_stat(value, fmt='{:.1f}'):
+    return '-' if value is None else fmt.format(value)
+
+
+def _format_bytes(value):
+    if value is None:
+        return '-'
+
+    for unit in ('B', 'K', 'M', 'G', 'T'):
+        if value < 1024 or unit == 'T':
+            return '{:.1f}{}'.format(value, unit)
+
+        value /= 1024.0
+
+
+def _stats_row(ring, window=STATS_WINDOW):
+    # summary of one machine ring, None where unknown
+    sample = ring.latest() if ring else None
+
+    if sample is None:
+        return {}
+
+    usage = ring.cpu_usage(window)
+
+    return {
+        'age': time.time() - sample['time'],
+        'load1': sample['load1'],
+        'cpu': usage[-1] if usage else None,
+        'cpu_p95': percentile(usage, 95),
+        'mem': 100.0 * (1 - sample['mem_available'] / sample['mem_total']) if sample['mem_total'] else None,
+        'disk': 100.0 * (1 - sample['disk_free'] / sample['disk_total']) if sample['disk_total'] else None,
+        'disk_free': sample['disk_free'],
+        'rx': ring.rate('net_rx', window),
+        'tx': ring.rate('net_tx', window),
+    }
+
+
+def machine_list(remote_uri, stats=False, verbose=False):
+    if not remote_uri:
+        local_config = load_local_config()
+        remote_uri = local_config['main']['remote_address']
+
+    remote_config = load_cluster_config(remote_uri, [], verbose=verbose)
+    machine_items = remote_config.get('machines', {}).items()
+    machine_items = sorted(
+        list(machine_items),
+        key=lambda n: (n[1]['host'], n[1]['port'])
+    )
+
+    # last collected samples, see machine stats
+    rings = load_stats() if stats else {}
+
+    if stats:
+        print('{a: <12} {b: <40} {c: >6} {d: >6} {e: >6} {f: >6} {g: >6}'.format(
+            a='MACHINE_ID', b='ADDRESS', c='LOAD1', d='CPU%', e='MEM%', f='DISK%', g='AGE',
+        ))
+    else:
+        print('{a: <12} {b: <40} {c}'.format(a='MACHINE_ID', b='ADDRESS', c='LABELS'))
+
+    for machine_id, machine in machine_items:
+        address = '{}@{}:{}'.format(
+            machine['user'],
+            machine['host'],
+            machine['port'],
+        )
+
+        if not stats:
+            labels = ','.join('{}={}'.format(k, v) for k, v in sorted(machine.get('labels', {}).items()))
+            print('{a: <12} {b: <40} {c}'.format(a=machine['id'], b=address, c=labels or '-'))
+            continue
+
+        row = _stats_row(rings.get(machine_id))
+
+        print('{a: <12} {b: <40} {c: >6} {d: >6} {e: >6} {f: >6} {g: >6}'.format(
+            a=machine['id'],
+            b=address,
+            c=_format_stat(row.get('load1'), '{:.2f}'),
+            d=_format_stat(row.get('cpu')),
+            e=_format_stat(row.get('mem')),
+            f=_format_stat(row.get('disk')),
+            g=_format_stat(row.get('age'), '{:.0f}s'),
+        ))
+
+
+def machine_stats(remote_uri, machine_id=None, count=1, interval=5.0, window=STATS_WINDOW, format_='table', verbose=False):
+    if not remote_uri:
+        local_config = load_local_config()
+        remote_uri = local_config['main']['remote_address']
+
+    config = load_cluster_config(remote_uri, [], verbose=verbose)
+    machines = config['machines']
+
+    if machine_id:
+        if machine_id not in machines:
+            msg = 'Machine with id {} does not exists'.format(machine_id)
+            print(msg, file=sys.stderr)
+            sys.exit(1)
+
+        machine_ids = [machine_id]
+    else:
+        machine_ids = list(machines)
+
+    # rates need previous sample, take one now if ring has none recent
+    rings = load_stats()
+
+    if any(not fresh_stats(rings.get(n), window) for n in machine_ids):
+        collect_stats(config, machine_ids, verbose=verbose)
+        time.sleep(1.0)
+
+    for i in range(count):
+        if i:
+            time.sleep(interval)
+
+        rings = collect_stats(config, machine_ids, verbose=verbose)
+        rows = []
+
+        for n in sorted(machine_ids, key=lambda n: (machines[n]['host'], machines[n]['port'])):
+            row = _stats_row(rings.get(n), window)
+            row['id'] = n
+            row['host'] = machines[n]['host']
+            rows.append(row)
+
+        if format_ == 'json':
+            print(json.dumps(rows, indent=True))
+            continue
+
+        print('{a: <12} {b: <24} {c: >6} {d: >6} {e: >7} {f: >6} {g: >6} {h: >8} {i: >8} {j: >8}'.format(
+            a='MACHINE_ID', b='HOST', c='LOAD1', d='CPU%', e='CPU%P95', f='MEM%', g='DISK%',
+            h='FREE', i='RX/S', j='TX/S',
+        ))
+
+        for row in rows:
+            print('{a: <12} {b: <24} {c: >6} {d: >6} {e: >7} {f: >6} {g: >6} {h: >8} {i: >8} {j: >8}'.format(
+                a=row['id'],
+                b=row['host'],
+                c=_format_stat(row.get('load1'), '{:.2f}'),
+                d=_format_stat(row.get('cpu')),
+                e=_format_stat(row.get('cpu_p95')),
+                f=_format_stat(row.get('mem')),
+                g=_format_stat(row.get('disk')),
+                h=_format_bytes(row.get('disk_free')),
+                i=_format_bytes(row.get('rx')),
+                j=_format_bytes(row.get('tx')),
+            ))
+
+
+def machine_base(remote_uri, machine_id, upgrade=False, prune=False, verbose=False):
+    if not remote_uri:
+        local_config = load_local_config()
+        remote_uri = local_config['main']['remote_address']
+
+    config = load_cluster_config(remote_uri, [], verbose=verbose)
+    machines = config['machines']
+
+    if machine_id not in machines:
+        msg = 'Machine with id {} does not exists'.format(machine_id)
+        print(msg, file=sys.stderr)
+        sys.exit(1)
+
+    machine_uri = '{user}@{host}:{port}'.format(**machines[machine_id])
+
+    try:
+        with lease(machine_uri, 'base-arch', wait=BASE_WAIT, verbose=verbose):
+            if upgrade:
+                output = OutputMux().stream(machine_id, echo=True)
+                base_dir = upgrade_base_arch(machine_uri, output, verbose=verbose)
+                print('{} {}'.format(machine_id, os.path.basename(base_dir)))
+
+            layers = get_machine_layers(machine_uri, verbose=verbose)
+
+            # bases no container layer sits on
+            if prune:
+                used = set(n['base'] for n in layers['layers'].values())
+                unused = [n for n in layers['bases'] if n not in used and n != layers['current']]
+
+                if unused:
+                    client = ssh_client(machine_uri)
+                    command = 'rm -rf {}'.format(' '.join('{}/{}'.format(BASE_DIR, n) for n in unused))
+                    status, out, err = exec_command(client, command, verbose=verbose)
+                    client.close()
+
+                    if status != 0:
+                        raise IOError(err.decode() or 'Could not prune bases on {}'.format(machine_uri))
+
+                    for n in unused:
+                        del layers['bases'][n]
+    except (IOError, paramiko.SSHException) as e:
+        print('ERROR: {}'.format(e), file=sys.stderr)
+        sys.exit(1)
+
+    print('{a: <24} {b: <8} {c: >8} {d: >10}'.format(a='BASE', b='CURRENT', c='SIZE', d='CONTAINERS'))
+
+    for name, size in sorted(layers['bases'].items()):
+        print('{a: <24} {b: <8} {c: >8} {d: >10}'.format(
+            a=name,
+            b='*' if name == layers['current'] else '',
+            c=_format_bytes(size),
+            d=sum(1 for n in layers['layers'].values() if n['base'] == name),
+        ))
+
+
+def machine_add(remote_uri, uri, port_ranges_str=None, provision=False, admin=None, labels=None, weight=None, verbose=False):
+    if not remote_uri:
+        local_config = load_local_config()
+        remote_uri = local_config['main']['remote_address']
+
+    remote_user, remote_host, remote_port = parse_uri(remote_uri)
+    user, host, port = parse_uri(uri)
+    port_ranges = parse_port_ranges(port_ranges_str) if port_ranges_str else None
+
+    try:
+        labels = parse_labels(labels)
+    except ValueError as e:
+        print(e, file=sys.stderr)
+        sys.exit(1)
+
+    if weight is not None and weight <= 0:
+        print('Invalid weight {}'.format(weight), file=sys.stderr)
+        sys.exit(1)
+
+    # generate random ID
+    m = hashlib.sha1()
+    m.update('{}'.format(random.randint(0, 2 ** 128)).encode())
+    machine_id = m.hexdigest()[-12:]
+
+    def mutate(config):
+        machines = config['machines']
+
+        # check if host already exists
+        for _machine_id, machine in machines.items():
+            if host == machine['host']:
+                msg = 'Machine with host {} already exists'.format(host)
+                print(msg, file=sys.stderr)
+                sys.exit(1)
+
+        machine = {
+            'id': machine_id,
+            'user': user,
+            'host': host,
+            'port': port,
+        }
+
+        if port_ranges:
+            machine['port_ranges'] = port_ranges
+
+        # rack, zone and such for spread constraints
+        if labels:
+            machine['labels'] = labels
+
+        # share of hash placed containers
+        if weight is not None:
+            machine['weight'] = weight
+
+        machines[machine_id] = machine
+
+    consensus_transaction(remote_uri, mutate, machine_ids=[], verbose=verbose)
+    print('{} {}@{}:{}'.format(machine_id, user, host, port))
+
+    # host prep right away, machine stays in config if it fails
+    if provision and provision_machines(remote_uri, [machine_id], admin, verbose=verbose):
+        sys.exit(1)
+
+
+def machine_set_weight(remote_uri, machine_id=None, weight=None, verbose=False):
+    if not remote_uri:
+        local_config = load_local_config()
+        remote_uri = local_config['main']['remote_address']
+
+    if weight is not None and weight <= 0:
+        print('Invalid weight {}'.format(weight), file=sys.stderr)
+        sys.exit(1)
+
+    # without explicit weight, CPUs from last collected stats
+    rings = load_stats()
+
+    def mutate(config):
+        machines = config['machines']
+
+        if machine_id and machine_id not in machines:
+            msg = 'Machine with id {} does not exists'.format(machine_id)
+            print(msg, file=sys.stderr)
+            sys.exit(1)
+
+        weights = {}
+
+        for n in [machine_id] if machine_id else sorted(machines):
+            if weight is not None:
+                weights[n] = weight
+                continue
+
+            sample = fresh_stats(rings.get(n))
+
+            if sample is None or not sample['cpus']:
+                continue
+
+            weights[n] = sample['cpus']
+
+        for n, w in weights.items():
+            machines[n]['weight'] = w
+
+        return weights
+
+    config, weights = consensus_transaction(remote_uri, mutate, machine_ids=[], verbose=verbose)
+
+    for n in sorted(config['machines']):
+        if n in weights:
+            print('{} {:g}'.format(n, weights[n]))
+        elif not machine_id or n == machine_id:
+            print('WARNING: No fresh stats for machine {}, skipping'.format(n), file=sys.stderr)
+
+
+def machine_remove(remote_uri, machine_id, verbose=False):
+    if not remote_uri:
+        local_config = load_local_config()
+        remote_uri = local_config['main']['remote_address']
+
+    remote_user, remote_host, remote_port = parse_uri(remote_uri)
+
+    # make sure user wants to delete machine
+    answer = input('Are you sure you want to remove machine? [y/n]: ')
+
+    if answer != 'y':
+        sys.exit(-1)
+
+    def mutate(config):
+        machines = config['machines']
+
+        if machine_id not in machines:
+            msg = 'Machine with id {} does not exists'.format(machine_id)
+            print(msg, file=sys.stderr)
+            sys.exit(1)
+
+        del machines[machine_id]
+
+    consensus_transaction(remote_uri, mutate, machine_ids=[], verbose=verbose)
+    print('{}'.format(machine_id))
+
+
+#
+# provision
+#
+def load_provision_cache():
+    filename = 'nspawn.local.provision'
+
+    if not os.path.exists(filename):
+        return {}
+
+    try:
+        with open(filename, 'r') as f:
+            return json.load(f)
+    except ValueError:
+        return {}
+
+
+def save_provision_cache(cache):
+    filename = 'nspawn.local.provision'
+
+    with open(filename + '.tmp', 'w') as f:
+        json.dump(cache, f, indent=True)
+
+    os.rename(filename + '.tmp', filename)
+
+
+def provision_steps(machine, admin):
+    steps = []
+
+    for name, probe, apply_ in PROVISION_STEPS:
+        probe = probe.format(user=machine['user'], admin=admin)
+        apply_ = apply_.format(user=machine['user'], admin=admin)
+
+        # changed step invalidates cached completion
+        m = hashlib.sha1()
+        m.update('{}\n{}'.format(probe, apply_).encode())
+        steps.append((name, m.hexdigest()[:12], probe, apply_))
+
+    return steps
+
+
+def as_root(command, admin):
+    if admin == 'root':
+        return command
+
+    return 'sudo -n sh -c {}'.format(shlex.quote(command))
+
+
+def provision_machine(machine, index, admin, done, output, verbose=False):
+    # probes batched in one command, then only missing steps applied in order
+    machine_uri = '{user}@{host}:{port}'.format(**machine)
+    admin_uri = '{}@{}:{}'.format(admin, machine['host'], machine['port'])
+    steps = [n for n in provision_steps(machine, admin) if done.get(n[0]) != n[1]]
+    applied = []
+
+    if steps:
+        client = ssh_client(admin_uri)
+
+        try:
+            probe = ' '.join(
+                'if ( {} ) >/dev/null 2>&1; then echo {} ok; else echo {} missing; fi;'.format(probe, name, name)
+                for name, digest, probe, apply_ in steps
+            )
+
+            status, out, err = exec_command(client, as_root(probe, admin), verbose=verbose)
+
+            if status != 0:
+                raise IOError(err.decode().strip() or 'Could not probe {}'.format(machine_uri))
+
+            missing = set(n.split()[0] for n in out.decode().splitlines() if n.endswith(' missing'))
+
+            for name, digest, probe, apply_ in steps:
+                if name in missing:
+                    output('stdout', '{} applying\n'.format(name).encode())
+                    chan = client.get_transport().open_session()
+                    command = as_root(apply_, admin)
+                    if verbose: print('{!r}'.format(command))
+                    chan.exec_command(command)
+                    status = stream_channel(chan, output, PROVISION_TIMEOUT)
+
+                    if status != 0:
+                        raise IOError('Step {} failed with status {}'.format(name, status))
+
+                    applied.append(name)
+                else:
+                    output('stdout', '{} ok\n'.format(name).encode())
+
+                done[name] = digest
+        finally:
+            client.close()
+
+    # replica of index so machine can serve config, generation decides
+    client = ssh_client(machine_uri)
+    status, out, err = exec_command(client, 'cat nspawn.remote.conf.gen 2>/dev/null || echo 0', verbose=verbose)
+    client.close()
+
+    if int(out.decode().strip() or 0) < index.get('generation', 0):
+        output('stdout', 'config seeding\n'.encode())
+        save_remote_config(machine_uri, index, verbose=verbose)
+        applied.append('config')
+    else:
+        output('stdout', 'config ok\n'.encode())
+
+    return applied
+
+
+def _provision_machine_thread(lock, results, semaphore, machine, index, admin, cache, mux, verbose=False):
+    key = '{host}:{port}'.format(**machine)
+    output = mux.stream(machine['id'], '[{}] '.format(machine['host']), echo=verbose)
+    status = 0
+
+    with lock:
+        done = dict(cache.get(key, {}))
+
+    try:
+        with semaphore:
+            applied = provision_machine(machine, index, admin or machine['user'], done, output, verbose=verbose)
+
+        with lock:
+            results.append((machine, applied, None))
+    except (IOError, paramiko.SSHException, ValueError) as e:
+        status = -1
+
+        with lock:
+            results.append((machine, None, e))
+    finally:
+        # steps finished before a failure stay cached
+        with lock:
+            cache[key] = done
+
+        mux.done(machine['id'], status)
+
+
+def provision_machines(remote_uri, machine_ids, admin=None, parallel=32, progress=False, recheck=False, verbose=False):
+    index = load_remote_config(remote_uri, verbose=verbose)
+    machines = index.get('machines', {})
+    cache = {} if recheck else load_provision_cache()
+    semaphore = threading.Semaphore(parallel)
+    mux = OutputMux(progress=progress)
+    mux.start()
+    threads = []
+    results = []
+    lock = threading.Lock()
+
+    for machine_id in machine_ids:
+        t = threading.Thread(
+            target=_provision_machine_thread,
+            args=(lock, results, semaphore, machines[machine_id], index, admin, cache, mux),
+            kwargs={'verbose': verbose},
+        )
+
+        t.daemon = True
+        t.start()
+        threads.append(t)
+
+    # host prep may install packages, no cluster deadline here
+    for t in threads:
+        t.join()
+
+    mux.stop()
+    save_provision_cache(dict(load_provision_cache(), **cache))
+
+    print('{a: <12} {b: <24} {c: <8} {d}'.format(a='MACHINE_ID', b='HOST', c='STATUS', d='APPLIED'))
+    failed = 0
+
+    for machine, applied, e in sorted(results, key=lambda n: n[0]['host']):
+        if e is not None:
+            failed += 1
+
+        print('{a: <12} {b: <24} {c: <8} {d}'.format(
+            a=machine['id'],
+            b=machine['host'],
+            c='failed' if e is not None else 'ok',
+            d=e if e is not None else ','.join(applied) or '-',
+        ))
+
+    return failed
+
+
+def machine_provision(remote_uri, machine_id=None, all_=False, admin=None, parallel=32, progress=False, recheck=False, verbose=False):
+    if not remote_uri:
+        local_config = load_local_config()
+        remote_uri = local_config['main']['remote_address']
+
+    config = load_cluster_config(remote_uri, [], verbose=verbose)
+    machines = config['machines']
+
+    if all_:
+        machine_ids = sorted(machines, key=lambda n: machines[n]['host'])
+    elif machine_id in machines:
+        machine_ids = [machine_id]
+    else:
+        msg = 'Machine with id {} does not exists'.format(machine_id)
+        print(msg, file=sys.stderr)
+        sys.exit(1)
+
+    if provision_machines(remote_uri, machine_ids, admin, parallel, progress, recheck, verbose):
+        sys.exit(1)
+
+
+#
+# cache
+#
+def cache_machine(config):
+    for machine in config['machines'].values():
+        if machine.get('cache'):
+            return machine
+
+    return None
+
+
+def cache_url(machine):
+    return 'http://{}:{}'.format(machine['host'], machine['cache']['port'])
+
+
+def split_cache_upstream(upstream):
+    # http(s)://host[:port][/path] into origin and path without trailing slash
+    m = re.match(r'^(https?://[^/?#]+)(/[^?#]*)?$', upstream)
+
+    if not m:
+        raise ValueError('Invalid upstream {!r}, expected http(s)://HOST[/PATH] or file:///DIR'.format(upstream))
+
+    return m.group(1), (m.group(2) or '').rstrip('/')
+
+
+def render_cache_nginx(port, upstream):
+    # pull-through cache, concurrent misses of same package fetched once
+    lines = [
+        'worker_processes auto;',
+        'pid /run/nspawn-cache.pid;',
+        'events { worker_connections 1024; }',
+        'http {',
+        "    log_format nspawn_cache '$upstream_cache_status $body_bytes_sent $upstream_response_length';",
+        '    access_log {} nspawn_cache;'.format(CACHE_LOG),
+        '    proxy_cache_path {} levels=1:2 keys_zone=pkg:16m max_size={} inactive=90d use_temp_path=off;'.format(CACHE_DIR, CACHE_MAX_SIZE),
+    ]
+
+    # local directory stands in for upstream mirror
+    if upstream.startswith('file://'):
+        lines.extend([
+            '    server {',
+            '        listen 127.0.0.1:{};'.format(port + 1),
+            # fetches are logged once, by cache server in front of it
+            '        access_log off;',
+            '        root {};'.format(upstream[len('file://'):]),
+            '    }',
+        ])
+
+        upstream = 'http://127.0.0.1:{}'.format(port + 1)
+
+    # proxy_pass in regex location takes no URI, mirror path goes by rewrite
+    origin, path = split_cache_upstream(upstream)
+    proxy = ['            proxy_pass {};'.format(origin)]
+
+    if path:
+        proxy.insert(0, '            rewrite ^ {}$uri break;'.format(path))
+
+    lines.extend([
+        '    server {',
+        '        listen {};'.format(port),
+        '        proxy_ssl_server_name on;',
+        # repo databases change in place, always from upstream
+        r'        location ~ \.(db|files)(\.sig)?$ {',
+    ] + proxy + [
+        '        }',
+        '        location / {',
+    ] + proxy + [
+        '            proxy_cache pkg;',
+        '            proxy_cache_valid 200 90d;',
+        '            proxy_cache_lock on;',
+        '            proxy_cache_lock_timeout 600s;',
+        '            proxy_cache_use_stale error timeout updating;',
+        '        }',
+        '    }',
+        '}',
+    ])
+
+    return '\n'.join(lines) + '\n'
+
+
+def render_cache_unit():
+    lines = [
+        '[Unit]',
+        'Description=nspawn package cache',
+        'After=network-online.target',
+        '',
+        '[Service]',
+        "ExecStart=/usr/bin/nginx -c {}/nginx.conf -g 'daemon off;'".format(CACHE_CONF_DIR),
+        'ExecReload=/bin/kill -HUP $MAINPID',
+        'Restart=on-failure',
+        '',
+        '[Install]',
+        'WantedBy=multi-user.target',
+    ]
+
+    return '\n'.join(lines) + '\n'
+
+
+def write_remote_file(client, path, data, verbose=False):
+    command = 'mkdir -p {d} && cat >{p}.tmp && mv {p}.tmp {p}'.format(
+        d=shlex.quote(os.path.dirname(path)),
+        p=shlex.quote(path),
+    )
+
+    status, out, err = exec_command(client, command, input_data=data.encode(), verbose=verbose)
+
+    if status != 0:
+        raise IOError(err.decode() or 'Could not write {}'.format(path))
+
+
+def setup_cache_node(machine, verbose=False):
+    machine_uri = '{user}@{host}:{port}'.format(**machine)
+    client = ssh_client(machine_uri)
+
+    try:
+        status, out, err = exec_command(
+            client,
+            'pacman -Q nginx >/dev/null 2>&1 || pacman -S --noconfirm --needed nginx',
+            timeout=PROVISION_TIMEOUT,
+            verbose=verbose,
+        )
+
+        if status != 0:
+            raise IOError(err.decode() or 'Could not install nginx on {}'.format(machine['host']))
+
+        write_remote_file(client, CACHE_CONF_DIR + '/nginx.conf', render_cache_nginx(machine['cache']['port'], machine['cache']['upstream']), verbose)
+        write_remote_file(client, '/etc/systemd/system/nspawn-cache.service', render_cache_unit(), verbose)
+
+        command = ' && '.join([
+            'install -d -o http -g http {}'.format(CACHE_DIR),
+            'nginx -t -q -c {}/nginx.conf'.format(CACHE_CONF_DIR),
+            'systemctl daemon-reload',
+            'systemctl enable --quiet nspawn-cache',
+            'systemctl reload-or-restart nspawn-cache',
+        ])
+
+        status, out, err = exec_command(client, command, verbose=verbose)
+
+        if status != 0:
+            raise IOError(err.decode() or 'Could not start cache on {}'.format(machine['host']))
+    finally:
+        client.close()
+
+
+def teardown_cache_node(machine, verbose=False):
+    # cached packages are kept, re-enabling starts warm
+    machine_uri = '{user}@{host}:{port}'.format(**machine)
+    client = ssh_client(machine_uri)
+
+    try:
+        command = 'systemctl disable --now --quiet nspawn-cache; rm -f /etc/systemd/system/nspawn-cache.service && systemctl daemon-reload'
+        status, out, err = exec_command(client, command, verbose=verbose)
+
+        if status != 0:
+            raise IOError(err.decode() or 'Could not stop cache on {}'.format(machine['host']))
+    finally:
+        client.close()
+
+
+def point_machine_cache(machine, url, verbose=False):
+    # cache first, regular mirrors stay as fallback; no url removes it
+    if url:
+        expression = r's|^Include *= */etc/pacman.d/mirrorlist|Server = {}/$repo/os/$arch\n&|'.format(url)
+        command = 'mkdir -p {d} && sed {e} /etc/pacman.conf >{c}.tmp && mv {c}.tmp {c}'.format(
+            d=os.path.dirname(PACMAN_CONF),
+            e=shlex.quote(expression),
+            c=PACMAN_CONF,
+        )
+    else:
+        command = 'rm -f {}'.format(PACMAN_CONF)
+
+    machine_uri = '{user}@{host}:{port}'.format(**machine)
+    client = ssh_client(machine_uri)
+
+    try:
+        status, out, err = exec_command(client, command, verbose=verbose)
+    finally:
+        client.close()
+
+    if status != 0:
+        raise IOError(err.decode() or 'Could not write {} on {}'.format(PACMAN_CONF, machine['host']))
+
+
+def _point_machine_cache_thread(lock, errors, machine, url, verbose=False):
+    try:
+        point_machine_cache(machine, url, verbose=verbose)
+    except (IOError, paramiko.SSHException) as e:
+        with lock:
+            errors.append((machine, e))
+
+
+def point_machines_cache(machines, url, verbose=False):
+    threads = []
+    errors = []
+    lock = threading.Lock()
+
+    for machine in machines:
+        t = threading.Thread(
+            target=_point_machine_cache_thread,
+            args=(lock, errors, machine, url),
+            kwargs={'verbose': verbose},
+        )
+
+        t.daemon = True
+        t.start()
+        threads.append(t)
+
+    join_threads(threads, CLUSTER_DEADLINE)
+
+    for machine, e in errors:
+        print('WARNING: Could not point machine {} at cache, skipping'.format(machine['id']), file=sys.stderr)
+        if verbose: print('ERROR: {!r}'.format(e), file=sys.stderr)
+
+    return errors
+
+
+def cache_enable(remote_uri, machine_id=None, port=None, upstream=None, verbose=False):
+    if not remote_uri:
+        local_config = load_local_config()
+        remote_uri = local_config['main']['remote_address']
+
+    if upstream and not upstream.startswith('file://'):
+        try:
+            split_cache_upstream(upstream)
+        except ValueError as e:
+            print(e, file=sys.stderr)
+            sys.exit(1)
+
+    def mutate(config):
+        machines = config['machines']
+        current = cache_machine(config)
+
+        # without id, current cache node is set up again and machines re-pointed
+        if not machine_id and not current:
+            print('No cache machine, give machine id', file=sys.stderr)
+            sys.exit(1)
+
+        if machine_id and machine_id not in machines:
+            msg = 'Machine with id {} does not exists'.format(machine_id)
+            print(msg, file=sys.stderr)
+            sys.exit(1)
+
+        target_id = machine_id or current['id']
+        previous = dict(current['cache']) if current else {}
+
+        for machine in machines.values():
+            machine.pop('cache', None)
+
+        machines[target_id]['cache'] = {
+            'port': port or previous.get('port', CACHE_PORT),
+            'upstream': upstream or previous.get('upstream', CACHE_UPSTREAM),
+        }
+
+        return dict(current) if current and current['id'] != target_id else None
+
+    config, previous = consensus_transaction(remote_uri, mutate, machine_ids=[], verbose=verbose)
+    machine = cache_machine(config)
+
+    if previous:
+        try:
+            teardown_cache_node(previous, verbose=verbose)
+        except (IOError, paramiko.SSHException) as e:
+            print('WARNING: Could not stop old cache on {}: {}'.format(previous['host'], e), file=sys.stderr)
+
+    try:
+        setup_cache_node(machine, verbose=verbose)
+    except (IOError, paramiko.SSHException) as e:
+        print('ERROR: Could not set up cache on {}: {}'.format(machine['host'], e), file=sys.stderr)
+        sys.exit(1)
+
+    errors = point_machines_cache(config['machines'].values(), cache_url(machine), verbose=verbose)
+    print('{} {}'.format(machine['id'], cache_url(machine)))
+
+    if errors:
+        sys.exit(1)
+
+
+def cache_disable(remote_uri, verbose=False):
+    if not remote_uri:
+        local_config = load_local_config()
+        remote_uri = local_config['main']['remote_address']
+
+    def mutate(config):
+        current = cache_machine(config)
+
+        if current:
+            current = dict(current)
+            config['machines'][current['id']].pop('cache')
+
+        return current
+
+    config, machine = consensus_transaction(remote_uri, mutate, machine_ids=[], verbose=verbose)
+
+    # machines first, pacstrap never points at stopped cache
+    errors = point_machines_cache(config['machines'].values(), None, verbose=verbose)
+
+    if machine:
+        try:
+            teardown_cache_node(machine, verbose=verbose)
+        except (IOError, paramiko.SSHException) as e:
+            print('ERROR: Could not stop cache on {}: {}'.format(machine['host'], e), file=sys.stderr)
+            sys.exit(1)
+
+    if errors:
+        sys.exit(1)
+
+
+def cache_stats(remote_uri, format_='table', verbose=False):
+    if not remote_uri:
+        local_config = load_local_config()
+        remote_uri = local_config['main']['remote_address']
+
+    config = load_cluster_config(remote_uri, [], verbose=verbose)
+    machine = cache_machine(config)
+
+    if not machine:
+        print('No cache machine', file=sys.stderr)
+        sys.exit(1)
+
+    # one pass over access log on cache node, only totals come back
+    command = ' && '.join([
+        'touch {}'.format(CACHE_LOG),
+        "awk '{{n[$1]++; b[$1]+=$2; if ($3 ~ /^[0-9]+$/) u+=$3}} END {{for (k in n) print k, n[k], b[k]; print \"UPSTREAM\", 0, u+0}}' {}".format(CACHE_LOG),
+        'echo SIZE 0 $(du -sb {} 2>/dev/null | cut -f1)'.format(CACHE_DIR),
+    ])
+
+    machine_uri = '{user}@{host}:{port}'.format(**machine)
+    client = ssh_client(machine_uri)
+
+    try:
+        status, out, err = exec_command(client, command, verbose=verbose)
+    finally:
+        client.close()
+
+    if status != 0:
+        print('ERROR: Could not read cache stats on {}: {}'.format(machine['host'], err.decode()), file=sys.stderr)
+        sys.exit(1)
+
+    requests = Counter()
+    sent = Counter()
+
+    for line in out.decode().splitlines():
+        key, count, size = (line.split() + ['0', '0'])[:3]
+        requests[key] += int(count)
+        sent[key] += int(size or 0)
+
+    # '-' are repo databases, passed through uncached
+    cacheable = sum(v for k, v in requests.items() if k not in ('-', 'UPSTREAM', 'SIZE'))
+    hits = requests['HIT']
+
+    stats = {
+        'machine_id': machine['id'],
+        'url': cache_url(machine),
+        'upstream': machine['cache']['upstream'],
+        'requests': sum(v for k, v in requests.items() if k not in ('UPSTREAM', 'SIZE')),
+        'cacheable': cacheable,
+        'hits': hits,
+        'misses': cacheable - hits,
+        'hit_rate': hits / cacheable if cacheable else None,
+        'bytes_served': sum(v for k, v in sent.items() if k not in ('UPSTREAM', 'SIZE')),
+        'bytes_from_cache': sent['HIT'],
+        'bytes_upstream': sent['UPSTREAM'],
+        'cache_size': sent['SIZE'],
+    }
+
+    if format_ == 'json':
+        print(json.dumps(stats, indent=2))
+        return
+
+    print('{} {} <- {}'.format(stats['machine_id'], stats['url'], stats['upstream']))
+    print('{a: <10} {b: >8} {c: >8} {d: >8} {e: >12} {f: >12} {g: >12}'.format(
+        a='HIT_RATE', b='REQUESTS', c='HITS', d='MISSES', e='FROM_CACHE', f='UPSTREAM', g='CACHE_SIZE',
+    ))
+
+    print('{a: <10} {b: >8} {c: >8} {d: >8} {e: >12} {f: >12} {g: >12}'.format(
+        a=_format_stat(stats['hit_rate'] and 100.0 * stats['hit_rate'], '{:.1f}%'),
+        b=stats['requests'],
+        c=stats['hits'],
+        d=stats['misses'],
+        e=_format_bytes(stats['bytes_from_cache']),
+        f=_format_bytes(stats['bytes_upstream']),
+        g=_format_bytes(stats['cache_size']),
+    ))
+
+
+#
+# project
+#
+def project_list(remote_uri, verbose=False):
+    if not remote_uri:
+        local_config = load_local_config()
+        remote_uri = local_config['main']['remote_address']
+
+    remote_config = load_cluster_config(remote_uri, [], verbose=verbose)
+    project_items = remote_config.get('projects', {}).items()
+    project_items = list(project_items)
+    project_items = sorted(project_items, key=lambda n: n[1]['name'])
+    print('{a: <12} {b: <67}'.format(a='PROJECT_ID', b='NAME'))
+
+    for project_id, project in project_items:
+        print('{a: <12} {b: <67}'.format(
+            a=project['id'],
+            b='{}'.format(project['name']),
+        ))
+
+
+def project_add(remote_uri, project_name, port_ranges_str=None, placement=None, verbose=False):
+    if not remote_uri:
+        local_config = load_local_config()
+        remote_uri = local_config['main']['remote_address']
+
+    remote_user, remote_host, remote_port = parse_uri(remote_uri)
+
+    # generate random ID
+    m = hashlib.sha1()
+    m.update('{}'.format(random.randint(0, 2 ** 128)).encode())
+    project_id = m.hexdigest()[-12:]
+
+    # ports reserved for project on every machine
+    port_ranges = parse_port_ranges(port_ranges_str) if port_ranges_str else None
+
+    try:
+        placement = parse_placement(**(placement or {}))
+    except ValueError as e:
+        print(e, file=sys.stderr)
+        sys.exit(1)
+
+    def mutate(config):
+        projects = config['projects']
+
+        # check if project name already exists
+        for _project_id, project in projects.items():
+            if project_name == project['name']:
+                msg = 'Project with name {} already exists'.format(project_name)
+                print(msg, file=sys.stderr)
+                sys.exit(1)
+
+        # reservations must not overlap
+        for start, end in port_ranges or ():
+            for _project_id, project in projects.items():
+                for r_start, r_end in project.get('port_ranges', []):
+                    if start <= r_end and r_start <= end:
+                        msg = 'Port range {}-{} overlaps project {}'.format(start, end, project['name'])
+                        print(msg, file=sys.stderr)
+                        sys.exit(1)
+
+        project = {
+            'id': project_id,
+            'name': project_name,
+        }
+
+        if port_ranges:
+            project['port_ranges'] = port_ranges
+
+        # defaults for containers of project
+        if placement:
+            project['placement'] = placement
+
+        projects[project_id] = project
+
+    consensus_transaction(remote_uri, mutate, machine_ids=[], verbose=verbose)
+    print('{} {}'.format(project_id, project_name))
+
+
+def project_remove(remote_uri, project_id, verbose=False):
+    if not remote_uri:
+        local_config = load_local_config()
+        remote_uri = local_config['main']['remote_address']
+
+    remote_user, remote_host, remote_port = parse_uri(remote_uri)
+
+    # make sure user wants to delete project
+    answer = input('Are you sure you want to remove project? [y/n]: ')
+
+    if answer != 'y':
+        sys.exit(-1)
+
+    def mutate(config):
+        projects = config['projects']
+
+        if project_id not in projects:
+            msg = 'Project with id {} does not exists'.format(project_id)
+            print(msg, file=sys.stderr)
+            sys.exit(1)
+
+        del projects[project_id]
+
+    consensus_transaction(remote_uri, mutate, machine_ids=[], verbose=verbose)
+    print('{}'.format(project_id))
+
+
+#
+# container
+#
+def get_machine_running_containers(uri, verbose=False):
+    # one batched query for all containers on machine
+    client = ssh_client(uri)
+    command = 'machinectl list --no-legend --no-pager'
+    status, out, err = exec_command(client, command, verbose=verbose)
+    client.close()
+
+    if status != 0:
+        raise IOError(err or 'Could not list running containers on {}'.format(uri))
+
+    return parse_machine_list(out.decode())
+
+
+def parse_machine_list(out):
+    # running container id to its first address, if machinectl shows one
+    running = {}
+
+    for line in out.splitlines():
+        fields = line.split()
+
+        if not fields:
+            continue
+
+        address = fields[5].rstrip('\u2026') if len(fields) > 5 and fields[5] != '-' else None
+        running[fields[0]] = address
+
+    return running
+
+
+def get_machine_live_state(uri, verbose=False):
+    # running containers and rootfs dirs present on disk
+    client = ssh_client(uri)
+    command = 'machinectl list --no-legend --no-pager && echo @ && ls -1 /var/lib/machines'
+    status, out, err = exec_command(client, command, verbose=verbose)
+    client.close()
+
+    if status != 0:
+        raise IOError(err or 'Could not read state of {}'.format(uri))
+
+    running, _, present = out.decode().partition('@\n')
+    return parse_machine_list(running), set(present.split())
+
+
+def encode_list_cursor(machine, container):
+    cursor = json.dumps([machine['host'], machine['id'], container['name'], container['id']])
+    return base64.urlsafe_b64encode(cursor.encode()).decode()
+
+
+def decode_list_cursor(cursor):
+    host, machine_id, name, container_id = json.loads(base64.urlsafe_b64decode(cursor.encode()).decode())
+    return (host, machine_id), (name, container_id)
+
+
+def _container_matches(container, filters):
+    project_id = filters.get('project_id')
+    name = filters.get('name')
+
+    if project_id and not container['project_id'].endswith(project_id):
+        return False
+
+    if name and not fnmatch.fnmatchcase(container['name'], name):
+        return False
+
+    return True
+
+
+def _list_machine_thread(q, machine, filters, with_status, after=None, verbose=False):
+    # stream shard and keep only matching records
+    machine_uri = '{user}@{host}:{port}'.format(**machine)
+    rows = []
+
+    try:
+        events = iter_remote_config(machine_uri, 'nspawn.shard.conf', missing_ok=True, verbose=verbose)
+
+        for event in events:
+            if event[0] == 'head' or not _container_matches(event[2], filters):
+                continue
+
+            container = event[2]
+
+            if after and (container['name'], container['id']) <= after:
+                continue
+
+            rows.append(container)
+
+        running = get_machine_running_containers(machine_uri, verbose=verbose) if with_status else None
+    except (IOError, paramiko.SSHException) as e:
+        q.put((machine['id'], None, e))
+        return
+
+    for container in rows:
+        if running is None:
+            container['status'] = 'x'
+        elif container['id'] in running:
+            container['status'] = 'running'
+
+            # dhcp leased address of directly reachable containers
+            network = container.get('network')
+
+            if network and not network.get('address') and running[container['id']]:
+                network['address'] = running[container['id']]
+        else:
+            container['status'] = 'stopped'
+
+    if filters.get('status'):
+        rows = [c for c in rows if c['status'] == filters['status']]
+
+    rows.sort(key=lambda n: (n['name'], n['id']))
+    q.put((machine['id'], rows, None))
+
+
+def iter_containers(config, filters, limit=None, offset=0, cursor=None, with_status=False, verbose=False):
+    # machines in stable order, narrowed by index before any shard is fetched
+    machines = config['machines']
+    summaries = config.get('summaries', {})
+    machine_ids = sorted(machines, key=lambda n: (machines[n]['host'], n))
+    after = None
+
+    if filters.get('machine_id'):
+        machine_ids = [n for n in machine_ids if n.endswith(filters['machine_id'])]
+
+    if filters.get('project_id'):
+        machine_ids = [n for n in machine_ids if n in project_machine_ids(config, filters['project_id'])]
+
+    if cursor:
+        cursor_machine, after = decode_list_cursor(cursor)
+        machine_ids = [n for n in machine_ids if (machines[n]['host'], n) >= cursor_machine]
+
+        if not machine_ids or machine_ids[0] != cursor_machine[1]:
+            after = None
+
+    # summaries are exact when only project/machine filters are given
+    exact = not filters.get('name') and not filters.get('status')
+    selected = []
+    needed = None if limit is None else offset + limit
+
+    for i, machine_id in enumerate(machine_ids):
+        summary = summaries.get(machine_id)
+        partial = after is not None and i == 0
+
+        if not exact or summary is None or partial:
+            selected.append(machine_id)
+
+            # counts unknown from here on
+            if not partial or offset:
+                exact = False
+
+            continue
+
+        count = sum(
+            n
+            for p, n in summary['projects'].items()
+            if p.endswith(filters.get('project_id') or '')
+        )
+
+        if count == 0:
+            continue
+
+        if offset >= count:
+            # skip whole machine without fetching it
+            offset -= count
+
+            if needed is not None:
+                needed -= count
+
+            continue
+
+        selected.append(machine_id)
+
+        if needed is not None:
+            needed -= count
+
+            if needed <= 0:
+                break
+
+    # fetch shards in parallel, emit in order as soon as prefix is complete
+    q = queue.Queue()
+
+    for machine_id in selected:
+        t = threading.Thread(
+            target=_list_machine_thread,
+            args=(q, machines[machine_id], filters, with_status),
+            kwargs={
+                'after': after if machine_id == machine_ids[0] else None,
+                'verbose': verbose,
+            },
+        )
+
+        t.daemon = True
+        t.start()
+
+    done = {}
+    emitted = 0
+
+    for machine_id in selected:
+        while machine_id not in done:
+            _machine_id, rows, err = q.get()
+            done[_machine_id] = (rows, err)
+
+        rows, err = done.pop(machine_id)
+
+        if err is not None:
+            print('ERROR: Could not list containers on machine {}: {}'.format(machine_id, err), file=sys.stderr)
+            continue
+
+        for container in rows:
+            if offset:
+                offset -= 1
+                continue
+
+            yield machine_id, container
+            emitted += 1
+
+            if limit is not None and emitted >= limit:
+                return
+
+
+def container_list(remote_uri, project_id, machine_id=None, name=None, status=None, limit=None, offset=0, cursor=None, format_='table', verbose=False):
+    if not remote_uri:
+        local_config = load_local_config()
+        remote_uri = local_config['main']['remote_address']
+
+    if not project_id:
+        local_config = load_local_config()
+        project_id = local_config['main']['project_id']
+
+    filters = {
+        'project_id': project_id,
+        'machine_id': machine_id,
+        'name': name,
+        'status': status,
+    }
+
+    # index only, shards are fetched by iter_containers
+    remote_config = load_cluster_config(remote_uri, [], verbose=verbose)
+    rows = iter_containers(remote_config, filters, limit, offset, cursor, with_status=bool(status), verbose=verbose)
+    containers = []
+    count = 0
+    last = None
+
+    if format_ == 'table':
+        print('{a: <12} {b: <10} {c: <15} {d: <33} {e: <6}'.format(
+            a='CONTAINER_ID',
+            b='NAME',
+            c='ADDRESS',
+            d='PORTS',
+            e='STATUS',
+        ))
+
+    for _machine_id, container in rows:
+        last = (remote_config['machines'][_machine_id], container)
+        count += 1
+
+        if format_ == 'json':
+            containers.append(container)
+        elif format_ == 'jsonl':
+            print(json.dumps(container), flush=True)
+        else:
+            ports_str = ','.join(
+                '{}:{}'.format(k, v)
+                for k, v in sorted(
+                    list(container['ports'].items()),
+                    key=lambda n: n[1],
+                )
+            )
+
+            # directly reachable container, ports are its own
+            network = container.get('network')
+
+            if network and network['mode'] != 'veth' and network.get('ports'):
+                ports_str = ','.join(str(n) for n in network['ports'])
+
+            print('{a: <12} {b: <10} {c: <15} {d: <33} {e: <6}'.format(
+                a=container['id'],
+                b=container['name'],
+                c=container_address(container),
+                d=ports_str,
+                e=container['status'],
+            ), flush=True)
+
+    # cursor for next page
+    next_cursor = None
+
+    if limit is not None and count == limit:
+        next_cursor = encode_list_cursor(*last)
+
+    if format_ == 'json':
+        print(json.dumps({'containers': containers, 'next_cursor': next_cursor}, indent=True))
+    elif next_cursor:
+        print('next cursor: {}'.format(next_cursor), file=sys.stderr)
+
+
+def _bootstrap_container_thread(lock, errors, machine_uri, container, start, mux, verbose=False):
+    output = mux.stream(container['name'], '[{}/{}] '.format(container['name'], container['id']), echo=verbose)
+    status = 0
+
+    try:
+        if container['distro'] == 'arch':
+            if container['image_id']:
+                raise NotImplementedError
+            elif container['image']:
+                raise NotImplementedError
+            else:
+                with lease(machine_uri, 'container-{}'.format(container['id']), verbose=verbose):
+                    create_container_arch_install(machine_uri, container, start, verbose, output)
+        else:
+            raise NotImplementedError
+    except (IOError, paramiko.SSHException, NotImplementedError) as e:
+        status = -1
+
+        with lock:
+            errors.append((container, e))
+    finally:
+        mux.done(container['name'], status)
+
+
+def container_add(remote_uri, project_id, name, ports_str, distro, image_id, image, machine_id=None, start=False, count=1, progress=False, limits=None, network_mode='veth', network_interface=None, address=None, gateway=None, storage='copy', pinned=False, group=None, placement=None, verbose=False):
+    if not remote_uri:
+        local_config = load_local_config()
+        remote_uri = local_config['main']['remote_address']
+    
+    if not project_id:
+        local_config = load_local_config()
+        project_id = local_config['main']['project_id']
+
+    remote_user, remote_host, remote_port = parse_uri(remote_uri)
+
+    # parse ports
+    requested_ports = parse_ports(ports_str)
+
+    # resource limits, unset ones are left out of record
+    try:
+        limits = {k: v for k, v in parse_limits(limits or {}).items() if v is not None}
+        network = parse_network(network_mode, network_interface, address, gateway)
+        placement = parse_placement(**(placement or {}))
+    except ValueError as e:
+        print(e, file=sys.stderr)
+        sys.exit(1)
+
+    if address and count > 1:
+        print('Static address can be given only to single container', file=sys.stderr)
+        sys.exit(1)
+
+    # generate random IDs
+    container_ids = []
+
+    for i in range(count):
+        m = hashlib.sha1()
+        m.update('{}'.format(random.randint(0, 2 ** 128)).encode())
+        container_ids.append(m.hexdigest()[-12:])
+
+    # host sockets are checked once per machine, not on every retry
+    listening_ports_map = {}
+
+    def mutate(config):
+        containers = config['containers']
+        machines = config['machines']
+
+        # check if project id exists
+        projects = config['projects']
+
+        if project_id not in projects:
+            msg = 'Project with id {} does not exists'.format(project_id)
+            print(msg, file=sys.stderr)
+            sys.exit(1)
+
+        planned = []
+        index = None
+
+        for i, container_id in enumerate(container_ids):
+            # already saved by attempt which lost index race
+            if container_id in containers:
+                planned.append((machines[containers[container_id]['machine_id']], containers[container_id]))
+                continue
+
+            # init container
+            container = {
+                'id': container_id,
+                'project_id': project_id,
+                'name': name if count == 1 else '{}-{}'.format(name, i + 1),
+                'distro': distro,
+                'image_id': image_id,
+                'image': image,
+            }
+
+            if limits:
+                container['limits'] = dict(limits)
+
+            if network:
+                container['network'] = dict(network)
+
+            if storage != 'copy':
+                container['storage'] = {'mode': storage}
+
+            if pinned:
+                container['pinned'] = True
+
+            if group:
+                container['group'] = group
+
+            if placement:
+                container['placement'] = dict(placement)
+
+            # find suitable machine and ports, replicas share one placement index
+            try:
+                if index is None:
+                    index = placement_index(config, container)
+
+                machine = place_container(config, container, requested_ports, machine_id, listening_ports_map, verbose, index)
+            except PortAllocationError as e:
+                print(e, file=sys.stderr)
+                sys.exit(1)
+
+            containers[container_id] = container
+            planned.append((machine, container))
+
+        return planned
+
+    # save not yet bootstrapped containers, re-planned on concurrent update
+    config, planned = consensus_transaction(remote_uri, mutate, machine_ids=[], verbose=verbose)
+
+    # bootstrap containers concurrently, output multiplexed
+    mux = OutputMux(progress=progress)
+    mux.start()
+    threads = []
+    errors = []
+    lock = threading.Lock()
+
+    for machine, container in planned:
+        # create systemd-nspawn container on machine
+        machine_uri = '{user}@{host}:{port}'.format(**machine)
+
+        t = threading.Thread(
+            target=_bootstrap_container_thread,
+            args=(lock, errors, machine_uri, container, start, mux),
+            kwargs={'verbose': verbose},
+        )
+
+        t.start()
+        threads.append(t)
+
+    for t in threads:
+        t.join()
+
+    mux.stop()
+
+    for container, e in errors:
+        print('ERROR: Could not bootstrap container {}: {}'.format(container['id'], e), file=sys.stderr)
+
+    # output on success
+    failed = set(container['id'] for container, e in errors)
+
+    for machine, container in planned:
+        if container['id'] in failed:
+            continue
+
+        print('{} {} {}'.format(
+            container['id'],
+            container_address(container),
+            ','.join('{}:{}'.format(k, v) for k, v in container['ports'].items())
+        ))
+
+    if errors:
+        sys.exit(1)
+
+
+def container_remove(remote_uri, project_id, container_id, force=False, verbose=False):
+    if not remote_uri:
+        local_config = load_local_config()
+        remote_uri = local_config['main']['remote_address']
+
+    if not project_id:
+        local_config = load_local_config()
+        project_id = local_config['main']['project_id']
+
+    remote_user, remote_host, remote_port = parse_uri(remote_uri)
+    config = load_cluster_config(remote_uri, [], verbose=verbose)
+    ensure_shards(config, project_machine_ids(config, project_id), verbose=verbose)
+    machines = config['machines']
+
+    # make sure user wants to delete container
+    answer = input('Are you sure you want to remove container? [y/n]: ')
+
+    if answer != 'y':
+        sys.exit(-1)
+
+    def mutate(config):
+        config['containers'].pop(container_id, None)
+
+    if force:
+        # try to remove container on each machine
+        for machine_id, machine in machines.items():
+            container = {
+                'id': container_id,
+                'project_id': project_id,
+                'machine_id': machine_id,
+            }
+
+            uri = '{user}@{host}:{port}'.format(**machine)
+
+            with lease(uri, 'container-{}'.format(container_id), verbose=verbose):
+                destroy_container_arch(uri, container, verbose)
+
+        consensus_transaction(remote_uri, mutate, machine_ids=None, verbose=verbose)
+        print('{}'.format(container_id))
+        return
+
+    # check if project id exists
+    projects = config['projects']
+
+    if project_id not in projects:
+        msg = 'Project with id {} does not exists'.format(project_id)
+        print(msg, file=sys.stderr)
+        sys.exit(-1)
+
+    project = projects[project_id]
+    container = find_container(config, container_id, verbose=verbose)
+
+    # machine
+    machine_id = container['machine_id']
+    machine = machines[machine_id]
+
+    # create systemd-nspawn container on machine
+    uri = '{user}@{host}:{port}'.format(**machine)
+
+    if container['distro'] == 'arch':
+        if container['image_id']:
+            raise NotImplementedError
+        elif container['image']:
+            raise NotImplementedError
+        else:
+            try:
+                with lease(uri, 'container-{}'.format(container_id), verbose=verbose):
+                    destroy_container_arch(uri, container, verbose)
+            except Exception as e:
+                msg = e
+                print(msg, file=sys.stderr)
+
+                # make sure user wants to delete container
+                answer = input('There was an error, are you sure you want to remove container? [y/n]: ')
+
+                if answer != 'y':
+                    sys.exit(-1)
+    else:
+        raise NotImplementedError
+    
+    consensus_transaction(remote_uri, mutate, machine_ids=[machine_id], verbose=verbose)
+    print('{}'.format(container_id))
+
+
+def container_start(remote_uri, project_id, container_id, verbose=False):
+    if not remote_uri:
+        local_config = load_local_config()
+        remote_uri = local_config['main']['remote_address']
+
+    if not project_id:
+        local_config = load_local_config()
+        project_id = local_config['main']['project_id']
+
+    config = load_cluster_config(remote_uri, [], verbose=verbose)
+    ensure_shards(config, project_machine_ids(config, project_id), verbose=verbose)
+    machines = config['machines']
+    container = find_container(config, container_id, verbose=verbose)
+    machine_id = container['machine_id']
+    machine = machines[machine_id]
+    machine_uri = '{user}@{host}:{port}'.format(**machine)
+
+    if container['distro'] == 'arch':
+        with lease(machine_uri, 'container-{}'.format(container_id), verbose=verbose):
+            start_container_arch(machine_uri, container, verbose=verbose)
+    else:
+        raise NotImplementedError
+
+
+def container_update(remote_uri, project_id, container_id, limits, pinned=None, verbose=False):
+    if not remote_uri:
+        local_config = load_local_config()
+        remote_uri = local_config['main']['remote_address']
+
+    if not project_id:
+        local_config = load_local_config()
+        project_id = local_config['main']['project_id']
+
+    try:
+        limits = parse_limits(limits)
+    except ValueError as e:
+        print(e, file=sys.stderr)
+        sys.exit(1)
+
+    if not limits and pinned is None:
+        print('Nothing to update', file=sys.stderr)
+        sys.exit(1)
+
+    config = load_cluster_config(remote_uri, [], verbose=verbose)
+    ensure_shards(config, project_machine_ids(config, project_id), verbose=verbose)
+    machines = config['machines']
+    container = find_container(config, container_id, verbose=verbose)
+    machine_id = container['machine_id']
+    machine = machines[machine_id]
+    machine_uri = '{user}@{host}:{port}'.format(**machine)
+
+    def mutate(config):
+        container = config['containers'].get(container_id)
+
+        if container is None:
+            msg = 'Container with id {} does not exists'.format(container_id)
+            print(msg, file=sys.stderr)
+            sys.exit(1)
+
+        container_limits = container.setdefault('limits', {})
+
+        for key, value in limits.items():
+            if value is None:
+                container_limits.pop(key, None)
+            else:
+                container_limits[key] = value
+
+        if not container_limits:
+            del container['limits']
+
+        # pinned containers are never moved by rebalance
+        if pinned:
+            container['pinned'] = True
+        elif pinned is not None:
+            container.pop('pinned', None)
+
+        return container
+
+    config, container = consensus_transaction(remote_uri, mutate, machine_ids=[machine_id], verbose=verbose)
+
+    if not limits:
+        print('{} pinned={}'.format(container_id, 'yes' if container.get('pinned') else 'no'))
+        return
+
+    if container['distro'] == 'arch':
+        with lease(machine_uri, 'container-{}'.format(container_id), verbose=verbose):
+            update_container_limits_arch(machine_uri, container, set(limits), verbose=verbose)
+    else:
+        raise NotImplementedError
+
+    print(' '.join([container_id] + limit_properties(container.get('limits', {}))))
+
+
+def container_rebase(remote_uri, project_id, container_id, verbose=False):
+    if not remote_uri:
+        local_config = load_local_config()
+        remote_uri = local_config['main']['remote_address']
+
+    if not project_id:
+        local_config = load_local_config()
+        project_id = local_config['main']['project_id']
+
+    config = load_cluster_config(remote_uri, [], verbose=verbose)
+    ensure_shards(config, project_machine_ids(config, project_id), verbose=verbose)
+    machines = config['machines']
+    container = find_container(config, container_id, verbose=verbose)
+    machine = machines[container['machine_id']]
+    machine_uri = '{user}@{host}:{port}'.format(**machine)
+
+    if storage_mode(container) != 'overlay':
+        msg = 'Container {} has no overlay storage'.format(container_id)
+        print(msg, file=sys.stderr)
+        sys.exit(1)
+
+    if container['distro'] == 'arch':
+        with lease(machine_uri, 'container-{}'.format(container_id), verbose=verbose):
+            base = rebase_container_arch(machine_uri, container, verbose=verbose)
+    else:
+        raise NotImplementedError
+
+    print('{} {}'.format(container_id, base))
+
+
+def _usage_machine_thread(lock, results, machine, containers, verbose=False):
+    machine_uri = '{user}@{host}:{port}'.format(**machine)
+    copy_ids = [c['id'] for c in containers if storage_mode(c) == 'copy']
+
+    try:
+        layers = get_machine_layers(machine_uri, copy_ids, verbose=verbose)
+    except (IOError, paramiko.SSHException) as e:
+        err = 'WARNING: Could not read usage on {}, skipping'.format(machine_uri)
+
+        if verbose:
+            print('ERROR: {!r}'.format(e), file=sys.stderr)
+
+        print(err, file=sys.stderr)
+        return
+
+    with lock:
+        for container in containers:
+            layer = layers['layers'].get(container['id'], {})
+            usage = layer.get('usage', layers['copies'].get(container['id']))
+            results.append((container, layer.get('base', '-'), usage))
+
+
+def container_usage(remote_uri, project_id, machine_id=None, verbose=False):
+    if not remote_uri:
+        local_config = load_local_config()
+        remote_uri = local_config['main']['remote_address']
+
+    if not project_id:
+        local_config = load_local_config()
+        project_id = local_config['main']['project_id']
+
+    config = load_cluster_config(remote_uri, [], verbose=verbose)
+    machine_ids = project_machine_ids(config, project_id)
+
+    if machine_id:
+        machine_ids = [n for n in machine_ids if n == machine_id]
+
+    ensure_shards(config, machine_ids, verbose=verbose)
+    machines = config['machines']
+    by_machine = {}
+
+    for container in config['containers'].values():
+        if container['project_id'].endswith(project_id) and container['machine_id'] in machine_ids:
+            by_machine.setdefault(container['machine_id'], []).append(container)
+
+    # du runs on every machine concurrently
+    threads = []
+    results = []
+    lock = threading.Lock()
+
+    for _machine_id, containers in by_machine.items():
+        t = threading.Thread(
+            target=_usage_machine_thread,
+            args=(lock, results, machines[_machine_id], containers),
+            kwargs={'verbose': verbose},
+        )
+
+        t.daemon = True
+        t.start()
+        threads.append(t)
+
+    join_threads(threads)
+
+    print('{a: <12} {b: <10} {c: <8} {d: <24} {e: >8}'.format(
+        a='CONTAINER_ID', b='NAME', c='STORAGE', d='BASE', e='USAGE',
+    ))
+
+    with lock:
+        results.sort(key=lambda n: (n[0]['name'], n[0]['id']))
+
+        for container, base, usage in results:
+            print('{a: <12} {b: <10} {c: <8} {d: <24} {e: >8}'.format(
+                a=container['id'],
+                b=container['name'],
+                c=storage_mode(container),
+                d=base,
+                e=_format_bytes(usage),
+            ))
+
+
+def container_stop(remote_uri, project_id, container_id, verbose=False):
+    if not remote_uri:
+        local_config = load_local_config()
+        remote_uri = local_config['main']['remote_address']
+
+    if not project_id:
+        local_config = load_local_config()
+        project_id = local_config['main']['project_id']
+
+    config = load_cluster_config(remote_uri, [], verbose=verbose)
+    ensure_shards(config, project_machine_ids(config, project_id), verbose=verbose)
+    machines = config['machines']
+    container = find_container(config, container_id, verbose=verbose)
+    machine_id = container['machine_id']
+    machine = machines[machine_id]
+    machine_uri = '{user}@{host}:{port}'.format(**machine)
+    
+    if container['distro'] == 'arch':
+        with lease(machine_uri, 'container-{}'.format(container_id), verbose=verbose):
+            stop_container_arch(machine_uri, container, verbose=verbose)
+    else:
+        raise NotImplementedError
+
+
+def container_restart(remote_uri, project_id, container_id, verbose=False):
+    if not remote_uri:
+        local_config = load_local_config()
+        remote_uri = local_config['main']['remote_address']
+
+    if not project_id:
+        local_config = load_local_config()
+        project_id = local_config['main']['project_id']
+
+    config = load_cluster_config(remote_uri, [], verbose=verbose)
+    ensure_shards(config, project_machine_ids(config, project_id), verbose=verbose)
+    machines = config['machines']
+    container = find_container(config, container_id, verbose=verbose)
+    machine_id = container['machine_id']
+    machine = machines[machine_id]
+    machine_uri = '{user}@{host}:{port}'.format(**machine)
+    
+    if container['distro'] == 'arch':
+        with lease(machine_uri, 'container-{}'.format(container_id), verbose=verbose):
+            restart_container_arch(machine_uri, container, verbose=verbose)
+    else:
+        raise NotImplementedError
+
+
+def parse_max_unavailable(value, total):
+    # absolute number or percent of containers, at least one
+    if value.endswith('%'):
+        return max(1, int(total * int(value[:-1]) / 100))
+
+    return max(1, int(value))
+
+
+def spread_containers(machine_containers, machines):
+    # round robin over machines so neighbours in order are on different hosts
+    queues = [
+        sorted(machine_containers[n], key=lambda c: (c['name'], c['id']))
+        for n in sorted(machine_containers, key=lambda n: (machines[n]['host'], n))
+    ]
+
+    order = []
+
+    while any(queues):
+        for q in queues:
+            if q:
+                order.append(q.pop(0))
+
+    return order
+
+
+def _rolling_step_thread(q, machine, container, gate, port, command, timeout, verbose=False):
+    machine_uri = '{user}@{host}:{port}'.format(**machine)
+    started = time.time()
+    restarted = None
+
+    try:
+        with lease(machine_uri, 'container-{}'.format(container['id']), verbose=verbose):
+            rolling_restart_container_arch(machine_uri, container, verbose=verbose)
+
+        restarted = time.time()
+
+        # health gate, polled until timeout
+        client = ssh_client(machine_uri)
+        deadline = time.time() + timeout
+        healthy = False
+
+        try:
+            while not healthy and time.time() < deadline:
+                healthy = check_container_health(client, machine, container, gate, port, command, verbose)
+
+                if not healthy:
+                    time.sleep(1.0)
+        finally:
+            client.close()
+
+        error = None if healthy else 'not healthy after {:.0f}s'.format(timeout)
+    except (IOError, paramiko.SSHException, ValueError) as e:
+        error = str(e)
+
+    finished = time.time()
+    restart_time = (restarted or finished) - started
+    gate_time = finished - restarted if restarted else 0.0
+    q.put((container, error, restart_time, gate_time))
+
+
+def container_rolling_restart(remote_uri, project_id, machine_id=None, name=None, max_unavailable='1', gate='unit', port=None, command=None, timeout=120.0, max_failures=1, rollback=False, verbose=False):
+    if not remote_uri:
+        local_config = load_local_config()
+        remote_uri = local_config['main']['remote_address']
+
+    if not project_id:
+        local_config = load_local_config()
+        project_id = local_config['main']['project_id']
+
+    if gate == 'tcp' and not port:
+        print('TCP gate needs --port', file=sys.stderr)
+        sys.exit(1)
+
+    if gate == 'exec' and not command:
+        print('Exec gate needs --command', file=sys.stderr)
+        sys.exit(1)
+
+    filters = {
+        'project_id': project_id,
+        'machine_id': machine_id,
+        'name': name,
+    }
+
+    config = load_cluster_config(remote_uri, [], verbose=verbose)
+    machines = config['machines']
+    machine_containers = {}
+
+    stopped = 0
+
+    # stopped containers stay stopped
+    for _machine_id, container in iter_containers(config, filters, with_status=True, verbose=verbose):
+        if container['distro'] != 'arch':
+            raise NotImplementedError
+
+        if container['status'] == 'stopped':
+            stopped += 1
+            continue
+
+        machine_containers.setdefault(_machine_id, []).append(container)
+
+    order = spread_containers(machine_containers, machines)
+
+    if not order:
+        print('No containers to restart', file=sys.stderr)
+        sys.exit(1)
+
+    window = parse_max_unavailable(max_unavailable, len(order))
+    print('Restarting {} containers on {} machines, {} at a time, {} stopped left alone'.format(
+        len(order),
+        len(machine_containers),
+        window,
+        stopped,
+    ))
+
+    # keep window full, preferring machines with least restarts in flight
+    q = queue.Queue()
+    inflight = Counter()
+    restarted = []
+    failures = []
+    started = time.time()
+    aborted = False
+
+    while order or sum(inflight.values()):
+        while order and not aborted and sum(inflight.values()) < window:
+            container = min(order, key=lambda c: inflight[c['machine_id']])
+            order.remove(container)
+            inflight[container['machine_id']] += 1
+
+            t = threading.Thread(
+                target=_rolling_step_thread,
+                args=(q, machines[container['machine_id']], container, gate, port, command, timeout),
+                kwargs={'verbose': verbose},
+            )
+
+            t.daemon = True
+            t.start()
+
+        if not sum(inflight.values()):
+            break
+
+        container, error, restart_time, gate_time = q.get()
+        inflight[container['machine_id']] -= 1
+        restarted.append(container)
+
+        print('{a: <6} {b: <12} {c: <10} {d: <12} restart {e:.1f}s health {f:.1f}s{g}'.format(
+            a='ok' if error is None else 'FAIL',
+            b=container['id'],
+            c=container['name'],
+            d=container['machine_id'],
+            e=restart_time,
+            f=gate_time,
+            g='' if error is None else ': {}'.format(error),
+        ), flush=True)
+
+        if error is not None:
+            failures.append(container)
+
+            if len(failures) >= max_failures and not aborted:
+                print('Aborting after {} failures, {} containers not restarted'.format(len(failures), len(order)), file=sys.stderr)
+                aborted = True
+
+    # restarted containers go back to previous unit
+    if aborted and rollback:
+        for container in reversed(restarted):
+            machine = machines[container['machine_id']]
+            machine_uri = '{user}@{host}:{port}'.format(**machine)
+            t = time.time()
+
+            try:
+                with lease(machine_uri, 'container-{}'.format(container['id']), verbose=verbose):
+                    rollback_container_arch(machine_uri, container, verbose=verbose)
+
+                print('rolled back {} {} {:.1f}s'.format(container['id'], container['name'], time.time() - t), flush=True)
+            except (IOError, paramiko.SSHException) as e:
+                print('ERROR: Could not roll back {}: {}'.format(container['id'], e), file=sys.stderr)
+
+    print('{} restarted, {} failed, {} skipped in {:.1f}s'.format(
+        len(restarted) - len(failures),
+        len(failures),
+        len(order),
+        time.time() - started,
+    ))
+
+    if failures:
+        sys.exit(1)
+
+
+def _exec_container_worker(lock, results, transport, tasks, command_fmt, command, timeout, verbose=False):
+    # each worker runs containers of one machine in its own channel
+    while True:
+        try:
+            container = tasks.get_nowait()
+        except queue.Empty:
+            return
+
+        prefix = '[{}/{}] '.format(container['name'], container['id'])
+        remote_command = command_fmt.format(id=container['id'], command=command)
+        if verbose: print('{!r}'.format(remote_command))
+        start = time.time()
+
+        try:
+            chan = transport.open_session()
+            chan.exec_command(remote_command)
+            status = stream_channel(chan, line_writer(prefix, lock), timeout)
+            chan.close()
+        except (IOError, paramiko.SSHException) as e:
+            with lock:
+                print('{}ERROR: {}'.format(prefix, e), file=sys.stderr)
+
+            status = -1
+
+        with lock:
+            results.append((container, status, time.time() - start))
+
+
+def _exec_machine_thread(lock, results, machine, containers, command_fmt, command, per_machine, timeout, verbose=False):
+    # one ssh connection per machine, shared by concurrent channels
+    machine_uri = '{user}@{host}:{port}'.format(**machine)
+
+    try:
+        client = ssh_client(machine_uri)
+    except (IOError, paramiko.SSHException) as e:
+        with lock:
+            print('ERROR: Could not connect to {}: {}'.format(machine_uri, e), file=sys.stderr)
+
+            for container in containers:
+                results.append((container, -1, 0.0))
+
+        return
+
+    tasks = queue.Queue()
+
+    for container in containers:
+        tasks.put(container)
+
+    threads = []
+    transport = client.get_transport()
+
+    for i in range(min(per_machine, len(containers))):
+        t = threading.Thread(
+            target=_exec_container_worker,
+            args=(lock, results, transport, tasks, command_fmt, command, timeout),
+            kwargs={'verbose': verbose},
+        )
+
+        t.start()
+        threads.append(t)
+
+    for t in threads:
+        t.join()
+
+    client.close()
+
+
+def container_exec(remote_uri, project_id, command, machine_id=None, name=None, method='systemd-run', per_machine=8, timeout=None, verbose=False):
+    if not remote_uri:
+        local_config = load_local_config()
+        remote_uri = local_config['main']['remote_address']
+
+    if not project_id:
+        local_config = load_local_config()
+        project_id = local_config['main']['project_id']
+
+    if command and command[0] == '--':
+        command = command[1:]
+
+    if not command:
+        print('Command is required', file=sys.stderr)
+        sys.exit(1)
+
+    # argv joined for container shell, then quoted once more for host shell
+    command = shlex.quote(' '.join(shlex.quote(n) for n in command))
+
+    if method == 'machinectl':
+        command_fmt = 'machinectl shell --quiet {id} /bin/sh -c {command}'
+    else:
+        command_fmt = 'systemd-run --machine={id} --wait --pipe --quiet --collect -- /bin/sh -c {command}'
+
+    filters = {
+        'project_id': project_id,
+        'machine_id': machine_id,
+        'name': name,
+    }
+
+    # resolve containers and group them by machine
+    config = load_cluster_config(remote_uri, [], verbose=verbose)
+    machine_containers = {}
+
+    for _machine_id, container in iter_containers(config, filters, verbose=verbose):
+        machine_containers.setdefault(_machine_id, []).append(container)
+
+    threads = []
+    results = []
+    lock = threading.Lock()
+
+    for _machine_id, containers in machine_containers.items():
+        t = threading.Thread(
+            target=_exec_machine_thread,
+            args=(lock, results, config['machines'][_machine_id], containers, command_fmt, command, per_machine, timeout),
+            kwargs={'verbose': verbose},
+        )
+
+        t.start()
+        threads.append(t)
+
+    for t in threads:
+        t.join()
+
+    # exit code summary
+    ok = [r for r in results if r[1] == 0]
+    timed_out = [r for r in results if r[1] is None]
+    failed = [r for r in results if r[1] not in (0, None)]
+
+    print('{} containers: {} ok, {} failed, {} timed out'.format(
+        len(results),
+        len(ok),
+        len(failed),
+        len(timed_out),
+    ), file=sys.stderr)
+
+    for container, status, duration in sorted(failed + timed_out, key=lambda n: n[0]['name']):
+        print('{a: <12} {b: <10} {c: <8} {d:.1f}s'.format(
+            a=container['id'],
+            b=container['name'],
+            c='timeout' if status is None else status,
+            d=duration,
+        ), file=sys.stderr)
+
+    if failed or timed_out:
+        sys.exit(1)
+
+
+def migration_ports(config, container, target, listening_ports=None):
+    # keep host ports when free on target, otherwise allocate new ones
+    network = container.get('network') or {'mode': 'veth'}
+
+    if network['mode'] == 'veth':
+        requested = [(int(k), v) for k, v in container['ports'].items()]
+    elif network['mode'] == 'host':
+        requested = [(v, v) for v in container['ports'].values()]
+    else:
+        requested = [(None, n) for n in network.get('ports', [])]
+
+    try:
+        return find_available_machine_ports(config, target, requested, container['project_id'], listening_ports, network['mode'])
+    except PortAllocationError:
+        if network['mode'] != 'veth':
+            raise
+
+    requested = [(None, v) for src_port, v in requested]
+    return find_available_machine_ports(config, target, requested, container['project_id'], listening_ports, network['mode'])
+
+
+def migrate_container(remote_uri, container, source, target, direct=False, verbose=False):
+    # stop, stream rootfs, move record, start on target, destroy source copy
+    source_uri = '{user}@{host}:{port}'.format(**source)
+    target_uri = '{user}@{host}:{port}'.format(**target)
+    resource = 'container-{}'.format(container['id'])
+    listening_ports = get_machine_listening_ports(target_uri, verbose=verbose)
+
+    if container['distro'] != 'arch':
+        raise NotImplementedError
+
+    # upper layer only works on base it was built on, targets have their own
+    if storage_mode(container) == 'overlay':
+        raise IOError('Overlay container {} can not be moved, base of target machine differs'.format(container['id']))
+
+    with lease(source_uri, resource, verbose=verbose), lease(target_uri, resource, verbose=verbose):
+        running = is_container_active(source_uri, container, verbose=verbose)
+
+        if running:
+            stop_container_arch(source_uri, container, verbose=verbose)
+
+        def mutate(config):
+            record = config['containers'].get(container['id'])
+
+            if record is None or record['machine_id'] != source['id']:
+                raise IOError('Container {} changed during move'.format(container['id']))
+
+            record['ports'] = migration_ports(config, record, target, listening_ports)
+            record['machine_id'] = target['id']
+            record['host'] = target['host']
+
+            if (record.get('network') or {}).get('mode') == 'host':
+                record['network']['address'] = target['host']
+
+            return record
+
+        try:
+            copy_container_arch(source_uri, target_uri, container, direct, verbose=verbose)
+            config, record = transaction(remote_uri, mutate, machine_ids=[source['id'], target['id']], verbose=verbose)
+        except (IOError, paramiko.SSHException, PortAllocationError):
+            discard_container_copy(target_uri, container, verbose=verbose)
+
+            if running:
+                start_container_arch(source_uri, container, verbose=verbose)
+
+            raise
+
+        install_copied_container_arch(target_uri, record, running, verbose=verbose)
+        destroy_container_arch(source_uri, container, verbose=verbose)
+
+    return record
+
+
+def container_migrate(remote_uri, project_id, container_id, target_machine_id=None, direct=False, verbose=False):
+    if not remote_uri:
+        local_config = load_local_config()
+        remote_uri = local_config['main']['remote_address']
+
+    if not project_id:
+        local_config = load_local_config()
+        project_id = local_config['main']['project_id']
+
+    config = load_cluster_config(remote_uri, [], verbose=verbose)
+    ensure_shards(config, project_machine_ids(config, project_id), verbose=verbose)
+    machines = config['machines']
+    container = find_container(config, container_id, verbose=verbose)
+    machine_id = container['machine_id']
+    machine = machines[machine_id]
+
+    if target_machine_id is None:
+        # least loaded of the other machines
+        others = dict(config, machines={k: v for k, v in machines.items() if k != machine_id})
+
+        if not others['machines']:
+            print('No other machine to move container to', file=sys.stderr)
+            sys.exit(1)
+
+        ensure_shards(config, verbose=verbose)
+        target = find_available_machine(others, container)
+    elif target_machine_id not in machines or target_machine_id == machine_id:
+        msg = 'Invalid target machine {}'.format(target_machine_id)
+        print(msg, file=sys.stderr)
+        sys.exit(1)
+    else:
+        target = machines[target_machine_id]
+
+    t = time.time()
+
+    try:
+        record = migrate_container(remote_uri, container, machine, target, direct, verbose=verbose)
+    except (IOError, paramiko.SSHException, PortAllocationError) as e:
+        print('ERROR: Could not move container {}: {}'.format(container_id, e), file=sys.stderr)
+        sys.exit(1)
+
+    print('{} {} {} {} {:.1f}s'.format(
+        container_id,
+        target['id'],
+        container_address(record),
+        ','.join('{}:{}'.format(k, v) for k, v in record['ports'].items()),
+        time.time() - t,
+    ))
+
+
+#
+# backup
+#
+def backup_machine(config):
+    for machine in config['machines'].values():
+        if machine.get('backup'):
+            return machine
+
+    return None
+
+
+def ssh_command(machine):
+    # machine to machine, needs ssh trust like direct migrate
+    return 'ssh -o BatchMode=yes -p {port} {user}@{host}'.format(**machine)
+
+
+def ensure_packages(client, packages, verbose=False):
+    command = 'pacman -Q {p} >/dev/null 2>&1 || pacman -S --noconfirm --needed {p}'.format(p=' '.join(packages))
+    status, out, err = exec_command(client, command, timeout=PROVISION_TIMEOUT, verbose=verbose)
+
+    if status != 0:
+        raise IOError(err.decode() or 'Could not install {}'.format(', '.join(packages)))
+
+
+def restic_command(backup, arguments, local=False, unless=None):
+    # password is read from root-only key file on backup machine, other
+    # machines get it through stdin, never on command line or their disk
+    path = backup['backup']['path'] + '/restic'
+
+    if local:
+        repo = '{} --password-file {}'.format(shlex.quote(path), shlex.quote(backup_key_path(backup)))
+    else:
+        repo = '{} -o sftp.command={}'.format(
+            shlex.quote('sftp:{}@{}:{}'.format(backup['user'], backup['host'], path)),
+            shlex.quote('{} -s sftp'.format(ssh_command(backup))),
+        )
+
+    command = 'restic -r {} {}'.format(repo, arguments)
+
+    if unless:
+        command = '{{ {} || {}; }}'.format(unless, command)
+
+    if local:
+        return command
+
+    return 'read -r RESTIC_PASSWORD && export RESTIC_PASSWORD && {}'.format(command)
+
+
+def backup_key_path(backup):
+    return backup['backup']['path'] + '/restic.key'
+
+
+def backup_key(client, backup, verbose=False):
+    # key never leaves backup machine except to stdin of restic
+    key_path = backup_key_path(backup)
+    legacy = backup['backup'].get('key')
+
+    # key of older config kept in cluster index moves into key file
+    command = 'mkdir -p {p} && exec 9>>{p}/.lock && flock -w 60 9 && {{ [ -s {k} ] || {{ umask 077 && {g} >{k}.tmp && mv {k}.tmp {k}; }}; }} && cat {k}'.format(
+        p=backup['backup']['path'],
+        k=key_path,
+        g='cat' if legacy else 'head -c 32 /dev/urandom | base64',
+    )
+
+    status, out, err = exec_command(client, command, input_data=(legacy + '\n').encode() if legacy else None, verbose=verbose)
+
+    if status != 0 or not out.strip():
+        raise IOError(err.decode() or 'Could not read backup key on {}'.format(backup['host']))
+
+    return out.decode().splitlines()[0].encode() + b'\n'
+
+
+def rate_limit(limit):
+    return ' | pv -q -L {}k'.format(limit) if limit else ''
+
+
+def restic_utc_offset(value):
+    # restic times are local with offset, like 2024-05-01T10:00:00.123+02:00
+    m = re.search(r'([+-])(\d\d):(\d\d)$', value)
+
+    if not m:
+        return 0
+
+    return (1 if m.group(1) == '+' else -1) * (int(m.group(2)) * 3600 + int(m.group(3)) * 60)
+
+
+def list_backups(client, backup, container_ids=None, verbose=False):
+    # btrfs snapshots by directory, restic ones from repository
+    path = backup['backup']['path']
+    backups = []
+
+    command = 'cd {p} 2>/dev/null && for d in btrfs/*/*; do [ -d "$d" ] && echo "$d"; done; true'.format(p=path)
+    status, out, err = exec_command(client, command, verbose=verbose)
+
+    for line in out.decode().splitlines():
+        mode, container_id, name = line.split('/')
+
+        backups.append({
+            'container_id': container_id,
+            'name': name,
+            'mode': mode,
+            'time': calendar.timegm(time.strptime(name, '%Y%m%dT%H%M%SZ')),
+        })
+
+    backup_key(client, backup, verbose=verbose)
+    command = restic_command(backup, 'snapshots --json --tag nspawn', local=True, unless='[ ! -f {}/restic/config ]'.format(path))
+    status, out, err = exec_command(client, command, verbose=verbose)
+
+    if status != 0:
+        raise IOError(err.decode() or 'Could not list backups on {}'.format(backup['host']))
+
+    for snapshot in json.loads(out.decode() or '[]') or []:
+        container_id = [n for n in snapshot.get('tags', []) if n != 'nspawn'][0]
+
+        backups.append({
+            'container_id': container_id,
+            'name': snapshot['short_id'],
+            'mode': 'restic',
+            'time': calendar.timegm(time.strptime(snapshot['time'][:19], '%Y-%m-%dT%H:%M:%S')) - restic_utc_offset(snapshot['time']),
+        })
+
+    if container_ids is not None:
+        backups = [n for n in backups if n['container_id'] in container_ids]
+
+    return sorted(backups, key=lambda n: (n['container_id'], n['time']))
+
+
+def backup_container(container, machine, backup, limit=None, verbose=False):
+    # streams from container's machine straight to backup machine
+    machine_uri = '{user}@{host}:{port}'.format(**machine)
+    backup_uri = '{user}@{host}:{port}'.format(**backup)
+    path = backup['backup']['path']
+    client = ssh_client(machine_uri)
+    target = ssh_client(backup_uri)
+
+    try:
+        # btrfs send when both ends are btrfs and rootfs is a subvolume
+        command = 'btrfs subvolume show /var/lib/machines/{} >/dev/null 2>&1'.format(container['id'])
+        status, out, err = exec_command(client, command, verbose=verbose)
+        source_btrfs = status == 0 and storage_mode(container) == 'copy'
+
+        command = 'mkdir -p {p} && stat -f -c %T {p}'.format(p=path)
+        status, out, err = exec_command(target, command, verbose=verbose)
+        target_btrfs = out.decode().strip() == 'btrfs'
+
+        if source_btrfs and target_btrfs:
+            name = time.strftime('%Y%m%dT%H%M%SZ', time.gmtime())
+            snapshots = '{}/{}'.format(SNAPSHOTS_DIR, container['id'])
+            received = '{}/btrfs/{}'.format(path, container['id'])
+
+            # parent is newest snapshot both sides still have
+            status, out, err = exec_command(client, 'ls {} 2>/dev/null'.format(snapshots), verbose=verbose)
+            local = set(out.decode().split())
+            status, out, err = exec_command(target, 'ls {} 2>/dev/null'.format(received), verbose=verbose)
+            common = sorted(local & set(out.decode().split()))
+            parent = '-p {}/{} '.format(snapshots, common[-1]) if common else ''
+
+            if limit:
+                ensure_packages(client, ['pv'], verbose=verbose)
+
+            command = 'set -o pipefail; mkdir -p {s} && btrfs subvolume snapshot -r /var/lib/machines/{id} {s}/{n} >/dev/null && {{ btrfs send -q {p}{s}/{n}{l} | {ssh} {r}; }}'.format(
+                id=container['id'],
+                s=snapshots,
+                n=name,
+                p=parent,
+                l=rate_limit(limit),
+                ssh=ssh_command(backup),
+                r=shlex.quote('mkdir -p {r} && btrfs receive -q {r}'.format(r=received)),
+            )
+
+            status, out, err = exec_command(client, command, timeout=None, verbose=verbose)
+
+            if status != 0:
+                exec_command(client, 'btrfs subvolume delete -c {}/{} 2>/dev/null'.format(snapshots, name), verbose=verbose)
+                exec_command(target, 'btrfs subvolume delete -c {}/{} 2>/dev/null'.format(received, name), verbose=verbose)
+                raise IOError(err.decode() or 'Could not send snapshot of {}'.format(container['id']))
+
+            # only newest snapshot is needed as next parent
+            command = 'for d in {s}/*; do [ "$d" = {s}/{n} ] || btrfs subvolume delete -c "$d" >/dev/null; done'.format(s=snapshots, n=name)
+            exec_command(client, command, verbose=verbose)
+            return 'btrfs', name
+
+        # otherwise chunked, deduplicated archive in restic repository
+        ensure_packages(target, ['restic'], verbose=verbose)
+        ensure_packages(client, ['restic'], verbose=verbose)
+        key = backup_key(target, backup, verbose=verbose)
+
+        # concurrent backups race to create repository
+        command = 'exec 9>>{p}/.lock && flock -w 60 9 && {r}'.format(
+            p=path,
+            r=restic_command(backup, 'init --quiet', local=True, unless='[ -f {}/restic/config ]'.format(path)),
+        )
+
+        status, out, err = exec_command(target, command, verbose=verbose)
+
+        if status != 0:
+            raise IOError(err.decode() or 'Could not create backup repository on {}'.format(backup['host']))
+
+        arguments = 'backup --json --quiet --host nspawn --tag nspawn --tag {id}{l} /var/lib/machines/{d}'.format(
+            id=container['id'],
+            l=' --limit-upload {}'.format(limit) if limit else '',
+            d=container_paths(container)[0],
+        )
+
+        status, out, err = exec_command(client, restic_command(backup, arguments), input_data=key, timeout=None, verbose=verbose)
+
+        if status != 0:
+            raise IOError(err.decode() or 'Could not back up {}'.format(container['id']))
+
+        summary = [json.loads(n) for n in out.decode().splitlines() if n.startswith('{')]
+        return 'restic', summary[-1].get('snapshot_id', '')[:8] if summary else '-'
+    finally:
+        client.close()
+        target.close()
+
+
+def prune_backups(backup, container_ids, keep, verbose=False):
+    # keep newest per container, both kinds
+    backup_uri = '{user}@{host}:{port}'.format(**backup)
+    path = backup['backup']['path']
+    client = ssh_client(backup_uri)
+
+    try:
+        backups = list_backups(client, backup, container_ids, verbose=verbose)
+        expired = []
+
+        for container_id in container_ids:
+            snapshots = [n for n in backups if n['container_id'] == container_id and n['mode'] == 'btrfs']
+            expired.extend(snapshots[:-keep])
+
+        if expired:
+            command = 'btrfs subvolume delete -c {} >/dev/null'.format(' '.join(
+                '{}/btrfs/{}/{}'.format(path, n['container_id'], n['name']) for n in expired
+            ))
+
+            status, out, err = exec_command(client, command, verbose=verbose)
+
+            if status != 0:
+                raise IOError(err.decode() or 'Could not delete old snapshots on {}'.format(backup['host']))
+
+        if any(n['mode'] == 'restic' for n in backups):
+            arguments = 'forget --quiet --prune --group-by tags --keep-last {} {}'.format(
+                keep,
+                ' '.join('--tag nspawn,{}'.format(n) for n in container_ids),
+            )
+
+            status, out, err = exec_command(
+                client,
+                restic_command(backup, arguments, local=True),
+                timeout=None,
+                verbose=verbose,
+            )
+
+            if status != 0:
+                raise IOError(err.decode() or 'Could not prune backups on {}'.format(backup['host']))
+
+        return len(expired)
+    finally:
+        client.close()
+
+
+def _backup_container_thread(lock, results, semaphore, container, machine, backup, limit, verbose=False):
+    machine_uri = '{user}@{host}:{port}'.format(**machine)
+    t = time.time()
+
+    try:
+        with semaphore, lease(machine_uri, 'backup-{}'.format(container['id']), verbose=verbose):
+            mode, name = backup_container(container, machine, backup, limit, verbose=verbose)
+
+        # record is kept next to data, restore works after container is gone
+        client = ssh_client('{user}@{host}:{port}'.format(**backup))
+
+        try:
+            write_remote_file(
+                client,
+                '{}/records/{}.json'.format(backup['backup']['path'], container['id']),
+                json.dumps(container, indent=True),
+                verbose,
+            )
+        finally:
+            client.close()
+
+        with lock:
+            results.append((container, mode, name, None, time.time() - t))
+    except (IOError, LeaseError, paramiko.SSHException) as e:
+        with lock:
+            results.append((container, None, None, e, time.time() - t))
+
+
+def container_backup(remote_uri, project_id, container_id=None, machine_id=None, name=None, backup_machine_id=None, parallel=4, limit=None, keep=BACKUP_KEEP, list_=False, verbose=False):
+    if not remote_uri:
+        local_config = load_local_config()
+        remote_uri = local_config['main']['remote_address']
+
+    if not project_id:
+        local_config = load_local_config()
+        project_id = local_config['main']['project_id']
+
+    if backup_machine_id:
+        def mutate(config):
+            machines = config['machines']
+
+            if backup_machine_id not in machines:
+                msg = 'Machine with id {} does not exists'.format(backup_machine_id)
+                print(msg, file=sys.stderr)
+                sys.exit(1)
+
+            current = backup_machine(config)
+            settings = dict(current['backup']) if current else {'path': BACKUP_DIR}
+
+            # new backup machine starts new repository with its own key
+            if current and current['id'] != backup_machine_id:
+                settings.pop('key', None)
+
+            for machine in machines.values():
+                machine.pop('backup', None)
+
+            machines[backup_machine_id]['backup'] = settings
+
+        config, result = consensus_transaction(remote_uri, mutate, machine_ids=[], verbose=verbose)
+    else:
+        config = load_cluster_config(remote_uri, [], verbose=verbose)
+
+    backup = backup_machine(config)
+
+    if not backup:
+        print('No backup machine, give one with --to', file=sys.stderr)
+        sys.exit(1)
+
+    filters = {
+        'project_id': project_id,
+        'machine_id': machine_id,
+        'name': name,
+    }
+
+    if list_:
+        # backups of removed container are listed by its id
+        if container_id:
+            container_ids = [container_id]
+        else:
+            container_ids = [c['id'] for m, c in iter_containers(config, filters, verbose=verbose)]
+
+        backup_uri = '{user}@{host}:{port}'.format(**backup)
+        client = ssh_client(backup_uri)
+
+        try:
+            backups = list_backups(client, backup, container_ids, verbose=verbose)
+        except (IOError, paramiko.SSHException) as e:
+            print('ERROR: {}'.format(e), file=sys.stderr)
+            sys.exit(1)
+        finally:
+            client.close()
+
+        print('{a: <12} {b: <18} {c: <8} {d: <20}'.format(a='CONTAINER_ID', b='BACKUP', c='MODE', d='TIME'))
+
+        for n in backups:
+            print('{a: <12} {b: <18} {c: <8} {d: <20}'.format(
+                a=n['container_id'],
+                b=n['name'],
+                c=n['mode'],
+                d=time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(n['time'])),
+            ))
+
+        return
+
+    if container_id:
+        containers = [(find_container(config, container_id, verbose=verbose)['machine_id'], config['containers'][container_id])]
+    else:
+        containers = list(iter_containers(config, filters, verbose=verbose))
+
+    semaphore = threading.Semaphore(parallel)
+    threads = []
+    results = []
+    lock = threading.Lock()
+
+    for _machine_id, container in containers:
+        t = threading.Thread(
+            target=_backup_container_thread,
+            args=(lock, results, semaphore, container, config['machines'][_machine_id], backup, limit),
+            kwargs={'verbose': verbose},
+        )
+
+        t.daemon = True
+        t.start()
+        threads.append(t)
+
+    # copies run as long as they need
+    for t in threads:
+        t.join()
+
+    print('{a: <12} {b: <10} {c: <8} {d: <18} {e: >8}'.format(a='CONTAINER_ID', b='NAME', c='MODE', d='BACKUP', e='TIME'))
+    failed = 0
+
+    for container, mode, name_, e, duration in sorted(results, key=lambda n: n[0]['name']):
+        if e is not None:
+            failed += 1
+
+        print('{a: <12} {b: <10} {c: <8} {d: <18} {e: >7.1f}s'.format(
+            a=container['id'],
+            b=container['name'],
+            c=mode or 'failed',
+            d=name_ or str(e),
+            e=duration,
+        ))
+
+    backed_up = [container['id'] for container, mode, name_, e, duration in results if e is None]
+
+    # key is in key file by now, drop copy replicated with cluster index
+    if backed_up and 'key' in backup['backup']:
+        def forget_key(config):
+            for machine in config['machines'].values():
+                if machine.get('backup'):
+                    machine['backup'].pop('key', None)
+
+        consensus_transaction(remote_uri, forget_key, machine_ids=[], verbose=verbose)
+
+    if keep and backed_up:
+        try:
+            prune_backups(backup, backed_up, keep, verbose=verbose)
+        except (IOError, paramiko.SSHException) as e:
+            print('WARNING: Could not apply retention: {}'.format(e), file=sys.stderr)
+
+    if failed:
+        sys.exit(1)
+
+
+def restore_container_data(record, container, backup, target, snapshot, limit=None, verbose=False):
+    # backup machine or target pulls, nothing passes through this host
+    target_dir = '/var/lib/machines/{}'.format(container_paths(container)[0])
+    path = backup['backup']['path']
+
+    if snapshot['mode'] == 'btrfs':
+        client = ssh_client('{user}@{host}:{port}'.format(**backup))
+
+        extract = ' && '.join([
+            'mkdir -p $(dirname {d})',
+            '{{ [ "$(stat -f -c %T /var/lib/machines)" = btrfs ] && btrfs subvolume create {d} >/dev/null || mkdir -p {d}; }}',
+            'tar -C {d} -xpf - --xattrs --acls --numeric-owner',
+        ]).format(d=target_dir)
+
+        command = 'set -o pipefail; tar -C {s} -cpf - --xattrs --acls --numeric-owner .{l} | {ssh} {e}'.format(
+            s='{}/btrfs/{}/{}'.format(path, record['id'], snapshot['name']),
+            l=rate_limit(limit),
+            ssh=ssh_command(target),
+            e=shlex.quote(extract),
+        )
+
+        input_data = None
+    else:
+        backup_client = ssh_client('{user}@{host}:{port}'.format(**backup))
+
+        try:
+            input_data = backup_key(backup_client, backup, verbose=verbose)
+        finally:
+            backup_client.close()
+
+        client = ssh_client('{user}@{host}:{port}'.format(**target))
+        ensure_packages(client, ['restic'], verbose=verbose)
+
+        arguments = 'restore --quiet {s}:/var/lib/machines/{p} --target {d}{l}'.format(
+            s=snapshot['name'],
+            p=container_paths(record)[0],
+            d=target_dir,
+            l=' --limit-download {}'.format(limit) if limit else '',
+        )
+
+        command = 'mkdir -p {} && {}'.format(target_dir, restic_command(backup, arguments))
+
+    try:
+        if limit and snapshot['mode'] == 'btrfs':
+            ensure_packages(client, ['pv'], verbose=verbose)
+
+        status, out, err = exec_command(client, command, input_data=input_data, timeout=None, verbose=verbose)
+    finally:
+        client.close()
+
+    if status != 0:
+        raise IOError(err.decode() or 'Could not restore {}'.format(record['id']))
+
+
+def container_restore(remote_uri, container_id, backup_name=None, machine_id=None, name=None, start=False, limit=None, verbose=False):
+    if not remote_uri:
+        local_config = load_local_config()
+        remote_uri = local_config['main']['remote_address']
+
+    config = load_cluster_config(remote_uri, [], verbose=verbose)
+    backup = backup_machine(config)
+
+    if not backup:
+        print('No backup machine', file=sys.stderr)
+        sys.exit(1)
+
+    if machine_id and machine_id not in config['machines']:
+        msg = 'Machine with id {} does not exists'.format(machine_id)
+        print(msg, file=sys.stderr)
+        sys.exit(1)
+
+    backup_uri = '{user}@{host}:{port}'.format(**backup)
+    client = ssh_client(backup_uri)
+
+    try:
+        command = 'cat {}/records/{}.json'.format(backup['backup']['path'], container_id)
+        status, out, err = exec_command(client, command, verbose=verbose)
+
+        if status != 0:
+            print('No backup of container {}'.format(container_id), file=sys.stderr)
+            sys.exit(1)
+
+        record = json.loads(out.decode())
+        backups = list_backups(client, backup, [container_id], verbose=verbose)
+    except (IOError, paramiko.SSHException) as e:
+        print('ERROR: {}'.format(e), file=sys.stderr)
+        sys.exit(1)
+    finally:
+        client.close()
+
+    backups = [n for n in backups if not backup_name or n['name'] == backup_name]
+
+    if not backups:
+        print('No backup {} of container {}'.format(backup_name or '', container_id).replace('  ', ' '), file=sys.stderr)
+        sys.exit(1)
+
+    snapshot = backups[-1]
+
+    # ports are allocated again on whichever machine it lands
+    network = record.get('network') or {'mode': 'veth'}
+
+    if network['mode'] == 'host':
+        requested_ports = [(int(v), int(v)) for v in record['ports'].values()]
+    elif network['mode'] == 'veth':
+        requested_ports = [(None, int(v)) for v in record['ports'].values()]
+    else:
+        requested_ports = [(None, int(n)) for n in network.get('ports', [])]
+
+    listening_ports_map = {}
+
+    def mutate(config):
+        if record['project_id'] not in config['projects']:
+            raise ClusterError('Project with id {} does not exists'.format(record['project_id']))
+
+        # original, if still around, is on machine it was backed up from
+        ensure_shards(config, [record['machine_id']], verbose=verbose)
+
+        if record['machine_id'] in config['machines'] and record['machine_id'] not in config['shards']:
+            raise ClusterError('Could not load containers of machine {}'.format(record['machine_id']))
+
+        exists = record['id'] in config['containers']
+
+        # original stays, restored one is a copy under new ID
+        container = {k: v for k, v in record.items() if k not in ('machine_id', 'host', 'ports')}
+        container['id'] = random_id() if exists else record['id']
+        container['name'] = name or ('{}-restored'.format(record['name']) if exists else record['name'])
+
+        if container.get('network'):
+            container['network'] = {k: v for k, v in container['network'].items() if k != 'ports'}
+
+        try:
+            place_container(config, container, requested_ports, machine_id, listening_ports_map, verbose)
+        except PortAllocationError as e:
+            print(e, file=sys.stderr)
+            sys.exit(1)
+
+        config['containers'][container['id']] = container
+        return container
+
+    # host shard is loaded by placement
+    config, container = consensus_transaction(remote_uri, mutate, machine_ids=[machine_id] if machine_id else [], verbose=verbose)
+    target = config['machines'][container['machine_id']]
+    target_uri = '{user}@{host}:{port}'.format(**target)
+    t = time.time()
+
+    try:
+        with lease(target_uri, 'container-{}'.format(container['id']), verbose=verbose):
+            restore_container_data(record, container, backup, target, snapshot, limit, verbose=verbose)
+            install_copied_container_arch(target_uri, container, start, verbose=verbose)
+    except (IOError, LeaseError, paramiko.SSHException) as e:
+        print('ERROR: Could not restore container {}: {}'.format(container_id, e), file=sys.stderr)
+
+        def forget(config):
+            config['containers'].pop(container['id'], None)
+
+        discard_container_copy(target_uri, container, verbose=verbose)
+        consensus_transaction(remote_uri, forget, machine_ids=[target['id']], verbose=verbose)
+        sys.exit(1)
+
+    print('{} {} {} {} {} {:.1f}s'.format(
+        container['id'],
+        snapshot['name'],
+        target['id'],
+        container_address(container),
+        ','.join('{}:{}'.format(k, v) for k, v in container['ports'].items()),
+        time.time() - t,
+    ))
+
+
+#
+# cluster
+#
+def cluster_export(remote_uri, format_='json', output=None, verbose=False):
+    if not remote_uri:
+        local_config = load_local_config()
+        remote_uri = local_config['main']['remote_address']
+
+    config = load_consensus_config(remote_uri, verbose=verbose)
+
+    config = {
+        'generation': config['generation'],
+        'machines': config['machines'],
+        'projects': config['projects'],
+        'summaries': config['summaries'],
+        'containers': config['containers'],
+    }
+
+    data = dump_config(config, format_, config_format()[1])
+
+    if output:
+        with open(output, 'wb') as f:
+            f.write(data)
+    else:
+        sys.stdout.buffer.write(data)
+        sys.stdout.flush()
+
+
+#
+# apply
+#
+def load_desired_state(filename):
+    # projects by name, containers by project and name
+    with open(filename, 'rb') as f:
+        data = f.read()
+
+    spec = json.loads(data.decode())
+    project_names = list(spec.get('projects', []))
+    containers = []
+
+    for item in spec.get('containers', []):
+        count = item.get('count', 1)
+
+        if item['project'] not in project_names:
+            project_names.append(item['project'])
+
+        if item.get('state', 'running') not in ('running', 'stopped'):
+            raise ValueError('Invalid state {!r} of {}'.format(item['state'], item['name']))
+
+        if item.get('storage', 'copy') not in ('copy', 'overlay'):
+            raise ValueError('Invalid storage {!r} of {}'.format(item['storage'], item['name']))
+
+        network = item.get('network') or {}
+
+        for i in range(count):
+            containers.append({
+                'project': item['project'],
+                'name': item['name'] if count == 1 else '{}-{}'.format(item['name'], i + 1),
+                'state': item.get('state', 'running'),
+                'distro': item.get('distro', 'arch'),
+                'ports': item.get('ports', '22'),
+                'machine_id': item.get('machine_id'),
+                'limits': {k: v for k, v in parse_limits(item.get('limits', {})).items() if v is not None},
+                'network': parse_network(
+                    network.get('mode', 'veth'),
+                    network.get('interface'),
+                    network.get('address'),
+                    network.get('gateway'),
+                ),
+                'storage': item.get('storage', 'copy'),
+            })
+
+    return hashlib.sha256(data).hexdigest(), project_names, containers
+
+
+def _live_state_thread(lock, live, machine, verbose=False):
+    machine_uri = '{user}@{host}:{port}'.format(**machine)
+
+    try:
+        state = get_machine_live_state(machine_uri, verbose=verbose)
+    except (IOError, paramiko.SSHException) as e:
+        err = 'WARNING: Could not read state of {}, skipping its containers'.format(machine_uri)
+
+        if verbose:
+            print('ERROR: {!r}'.format(e), file=sys.stderr)
+
+        print(err, file=sys.stderr)
+        return
+
+    with lock:
+        live[machine['id']] = state
+
+
+def load_live_state(config, verbose=False):
+    threads = []
+    live = {}
+    lock = threading.Lock()
+
+    for machine_id, machine in config['machines'].items():
+        t = threading.Thread(
+            target=_live_state_thread,
+            args=(lock, live, machine),
+            kwargs={'verbose': verbose},
+        )
+
+        t.daemon = True
+        t.start()
+        threads.append(t)
+
+    join_threads(threads)
+
+    with lock:
+        return dict(live)
+
+
+def _container_spec(container):
+    network = dict(container.get('network') or {'mode': 'veth'})
+    ports = network.pop('ports', None) or [int(n) for n in container['ports'].values()]
+
+    # host network address is machine's own, not part of spec
+    if network['mode'] == 'host':
+        network.pop('address', None)
+
+    return {'ports': sorted(ports), 'network': network, 'storage': storage_mode(container)}
+
+
+def _desired_spec(d):
+    return {
+        'ports': sorted(dest_port for src_port, dest_port in parse_ports(d['ports'])),
+        'network': d['network'] or {'mode': 'veth'},
+        'storage': d['storage'],
+    }
+
+
+def plan_apply(config, live, project_names, desired):
+    # minimal actions turning config and live state into desired one
+    project_ids = {p['name']: p['id'] for p in config['projects'].values()}
+    plan = {'projects': {}, 'new': {}, 'limits': {}, 'containers': {}, 'actions': []}
+    actions = plan['actions']
+    last = {}
+
+    def add(op, container, machine_id, detail='', deps=(), start=None):
+        key = '{}:{}'.format(op, container['id'])
+        deps = list(deps)
+
+        # actions on same container run in order
+        if container['id'] in last:
+            deps.append(last[container['id']])
+
+        actions.append({
+            'key': key,
+            'op': op,
+            'container_id': container['id'],
+            'label': '{}/{}'.format(container['project'], container['name']),
+            'machine_id': machine_id,
+            'detail': detail,
+            'deps': deps,
+        })
+
+        # desired state of created container, not derived from detail text
+        if op == 'create':
+            actions[-1]['start'] = start
+
+        last[container['id']] = key
+
+    for name in project_names:
+        if name not in project_ids:
+            m = hashlib.sha1()
+            m.update('{}'.format(random.randint(0, 2 ** 128)).encode())
+            project_ids[name] = plan['projects'][name] = m.hexdigest()[-12:]
+
+    # existing containers of desired projects, others are left alone
+    names = {project_ids[n]: n for n in project_names}
+    existing = {}
+
+    for container in sorted(config['containers'].values(), key=lambda n: n['id']):
+        if container['project_id'] in names:
+            existing.setdefault((names[container['project_id']], container['name']), []).append(container)
+
+    # placement is decided here so dry run shows what is executed
+    scratch = dict(config, containers=dict(config['containers']))
+    wanted = set()
+
+    for d in desired:
+        key = (d['project'], d['name'])
+        wanted.add(key)
+        matches = existing.get(key, [])
+
+        if not matches:
+            m = hashlib.sha1()
+            m.update('{}'.format(random.randint(0, 2 ** 128)).encode())
+            container_id = m.hexdigest()[-12:]
+
+            record = {
+                'id': container_id,
+                'project_id': project_ids[d['project']],
+                'name': d['name'],
+                'distro': d['distro'],
+                'image_id': None,
+                'image': None,
+            }
+
+            if d['limits']:
+                record['limits'] = dict(d['limits'])
+
+            if d['network']:
+                record['network'] = dict(d['network'])
+
+            if d['storage'] != 'copy':
+                record['storage'] = {'mode': d['storage']}
+
+            machine_id = d['machine_id'] or find_available_machine(scratch, record)['id']
+            scratch['containers'][container_id] = dict(record, machine_id=machine_id)
+            plan['new'][container_id] = {'record': record, 'machine_id': machine_id, 'ports': d['ports']}
+
+            add('create', dict(d, id=container_id), machine_id, d['state'], ['config'], start=d['state'] == 'running')
+            continue
+
+        container = matches[0]
+        machine_id = container['machine_id']
+        view = dict(d, id=container['id'])
+        plan['containers'][container['id']] = container
+
+        # surplus containers with same name go away
+        for extra in matches[1:]:
+            plan['containers'][extra['id']] = extra
+            add('remove', dict(d, id=extra['id']), extra['machine_id'], 'duplicate')
+
+        if machine_id not in live:
+            print('WARNING: Machine {} unreachable, skipping {}/{}'.format(machine_id, *key), file=sys.stderr)
+            continue
+
+        # only limits change in place, rest needs new container
+        for field in ('ports', 'network', 'storage'):
+            if _container_spec(container)[field] != _desired_spec(d)[field]:
+                print('WARNING: {} of {}/{} differs, needs container to be recreated'.format(field, *key), file=sys.stderr)
+
+        running, present = live[machine_id]
+        is_running = container['id'] in running
+        limits_changed = container.get('limits', {}) != d['limits']
+
+        if limits_changed:
+            plan['limits'][container['id']] = d['limits']
+
+        if container['id'] not in present:
+            add('create', view, machine_id, 'missing on disk', ['config'] if limits_changed else [], start=d['state'] == 'running')
+            continue
+
+        if d['state'] == 'stopped' and is_running:
+            add('stop', view, machine_id)
+
+        if limits_changed:
+            add('limits', view, machine_id, ' '.join(limit_properties(d['limits'])) or 'clear', ['config'])
+
+        if d['state'] == 'running' and not is_running:
+            add('start', view, machine_id)
+
+    for key, matches in sorted(existing.items()):
+        if key in wanted:
+            continue
+
+        for container in matches:
+            plan['containers'][container['id']] = container
+
+            if container['machine_id'] not in live:
+                print('WARNING: Machine {} unreachable, not removing {}/{}'.format(container['machine_id'], *key), file=sys.stderr)
+                continue
+
+            add('remove', dict(container, project=key[0]), container['machine_id'])
+
+    # free machines before filling them
+    removes = {}
+
+    for action in actions:
+        if action['op'] == 'remove':
+            removes.setdefault(action['machine_id'], []).append(action['key'])
+
+    for action in actions:
+        if action['op'] == 'create':
+            action['deps'].extend(removes.get(action['machine_id'], []))
+
+    if plan['projects'] or plan['new'] or plan['limits']:
+        actions.insert(0, {
+            'key': 'config',
+            'op': 'config',
+            'container_id': None,
+            'label': '-',
+            'machine_id': None,
+            'detail': '{} projects, {} containers, {} limits'.format(
+                len(plan['projects']), len(plan['new']), len(plan['limits']),
+            ),
+            'deps': [],
+        })
+    else:
+        for action in actions:
+            action['deps'] = [n for n in action['deps'] if n != 'config']
+
+    return plan
+
+
+def print_plan(plan, done=()):
+    print('{a: <8} {b: <24} {c: <12} {d: <12} {e}'.format(
+        a='ACTION', b='CONTAINER', c='CONTAINER_ID', d='MACHINE_ID', e='DETAIL',
+    ))
+
+    for name, project_id in sorted(plan['projects'].items()):
+        print('{a: <8} {b: <24} {c: <12} {d: <12} {e}'.format(
+            a='project', b=name, c=project_id, d='-', e='add',
+        ))
+
+    for action in plan['actions']:
+        if action['op'] == 'config':
+            continue
+
+        print('{a: <8} {b: <24} {c: <12} {d: <12} {e}'.format(
+            a=action['op'],
+            b=action['label'],
+            c=action['container_id'],
+            d=action['machine_id'],
+            e=(action['detail'] + (' (done)' if action['key'] in done else '')).strip(),
+        ))
+
+
+def _apply_action_thread(q, action, execute):
+    started = time.time()
+    error = None
+
+    try:
+        execute(action)
+    except (IOError, paramiko.SSHException, NotImplementedError, PortAllocationError) as e:
+        error = e
+    except BaseException as e:
+        # scheduler waits for every action, even one which exited
+        error = RuntimeError('{}: {}'.format(type(e).__name__, e))
+    finally:
+        q.put((action['key'], error, time.time() - started))
+
+
+def run_plan(actions, execute, per_machine=2, done=(), on_done=None, limit=None):
+    # dag of actions, independent machines in parallel, bounded per machine
+    pending = {a['key']: a for a in actions if a['key'] not in done}
+    finished = set(done)
+    failed = set()
+    running = Counter()
+    q = queue.Queue()
+    inflight = 0
+
+    while pending or inflight:
+        for key, action in list(pending.items()):
+            if any(n in failed for n in action['deps']):
+                print('skipped {} {}, dependency failed'.format(action['op'], action['label']), file=sys.stderr)
+                failed.add(key)
+                del pending[key]
+
+        for key, action in sorted(pending.items()):
+            if not all(n in finished for n in action['deps']):
+                continue
+
+            # moves occupy both machines
+            machine_ids = [n for n in action.get('machine_ids') or [action['machine_id']] if n]
+
+            if any(running[n] >= per_machine for n in machine_ids):
+                continue
+
+            if limit and inflight >= limit:
+                break
+
+            for n in machine_ids:
+                running[n] += 1
+
+            inflight += 1
+            del pending[key]
+
+            t = threading.Thread(target=_apply_action_thread, args=(q, action, execute))
+            t.daemon = True
+            t.start()
+
+        if not inflight:
+            break
+
+        key, e, elapsed = q.get()
+        action = next(a for a in actions if a['key'] == key)
+        inflight -= 1
+
+        for n in action.get('machine_ids') or [action['machine_id']]:
+            if n:
+                running[n] -= 1
+
+        if e is None:
+            finished.add(key)
+            print('ok {} {} {} {:.1f}s'.format(action['op'], action['label'], action['machine_id'] or '', elapsed))
+
+            if on_done:
+                on_done(key)
+        else:
+            failed.add(key)
+            print('ERROR: {} {} failed: {}'.format(action['op'], action['label'], e), file=sys.stderr)
+
+    return finished, failed
+
+
+def load_apply_checkpoint(digest):
+    filename = 'nspawn.local.apply'
+
+    if not os.path.exists(filename):
+        return None
+
+    with open(filename, 'r') as f:
+        checkpoint = json.load(f)
+
+    if checkpoint.get('digest') != digest:
+        print('WARNING: Discarding checkpoint of different desired state', file=sys.stderr)
+        return None
+
+    return checkpoint
+
+
+def save_apply_checkpoint(checkpoint):
+    filename = 'nspawn.local.apply'
+
+    if checkpoint is None:
+        if os.path.exists(filename):
+            os.remove(filename)
+
+        return
+
+    with open(filename + '.tmp', 'w') as f:
+        json.dump(checkpoint, f, indent=True)
+
+    os.rename(filename + '.tmp', filename)
+
+
+def apply(remote_uri, filename, dry_run=False, per_machine=2, yes=False, verbose=False):
+    if not remote_uri:
+        local_config = load_local_config()
+        remote_uri = local_config['main']['remote_address']
+
+    try:
+        digest, project_names, desired = load_desired_state(filename)
+    except (IOError, ValueError, KeyError) as e:
+        print('Invalid desired state {}: {}'.format(filename, e), file=sys.stderr)
+        sys.exit(1)
+
+    # interrupted run continues where it stopped
+    checkpoint = None if dry_run else load_apply_checkpoint(digest)
+
+    if checkpoint:
+        plan = checkpoint['plan']
+        print('Resuming apply, {} of {} actions done'.format(len(checkpoint['done']), len(plan['actions'])))
+    else:
+        config = load_consensus_config(remote_uri, verbose=verbose)
+        live = load_live_state(config, verbose=verbose)
+        plan = plan_apply(config, live, project_names, desired)
+        checkpoint = {'digest': digest, 'plan': plan, 'done': []}
+
+    if not plan['actions']:
+        print('Nothing to do')
+        save_apply_checkpoint(None)
+        return
+
+    print_plan(plan, checkpoint['done'])
+
+    if dry_run:
+        return
+
+    # make sure user wants containers removed
+    if not yes and any(a['op'] == 'remove' for a in plan['actions']):
+        answer = input('Plan removes containers, apply? [y/n]: ')
+
+        if answer != 'y':
+            sys.exit(-1)
+
+    save_apply_checkpoint(checkpoint)
+    mux = OutputMux()
+    mux.start()
+
+    def commit_config():
+        def mutate(config):
+            projects = config['projects']
+            containers = config['containers']
+            listening_ports_map = {}
+
+            for name, project_id in plan['projects'].items():
+                if project_id not in projects:
+                    projects[project_id] = {'id': project_id, 'name': name}
+
+            for container_id, new in plan['new'].items():
+                if container_id in containers:
+                    continue
+
+                if new['machine_id'] not in config['machines']:
+                    raise IOError('Machine {} is gone'.format(new['machine_id']))
+
+                container = json.loads(json.dumps(new['record']))
+                place_container(config, container, parse_ports(new['ports']), new['machine_id'], listening_ports_map, verbose)
+                containers[container_id] = container
+
+            for container_id, limits in plan['limits'].items():
+                container = containers.get(container_id)
+
+                if container is None:
+                    continue
+
+                if limits:
+                    container['limits'] = dict(limits)
+                else:
+                    container.pop('limits', None)
+
+            return {n: containers[n] for n in list(plan['new']) + list(plan['limits']) if n in containers}
+
+        machine_ids = set(n['machine_id'] for n in plan['new'].values())
+        machine_ids.update(plan['containers'][n]['machine_id'] for n in plan['limits'])
+        # runs in plan worker, errors fail the action instead of exiting
+        config, records = transaction(remote_uri, mutate, machine_ids=sorted(machine_ids), verbose=verbose)
+        plan['containers'].update(records)
+
+    def execute(action):
+        if action['op'] == 'config':
+            commit_config()
+            return
+
+        container = plan['containers'][action['container_id']]
+        machine_uri = plan_machine_uris[action['machine_id']]
+
+        if container['distro'] != 'arch':
+            raise NotImplementedError
+
+        with lease(machine_uri, 'container-{}'.format(container['id']), verbose=verbose):
+            if action['op'] == 'create':
+                output = mux.stream(action['label'], '[{}] '.format(action['label']), echo=verbose)
+                status = 0
+
+                try:
+                    create_container_arch_install(machine_uri, container, action['start'], verbose, output)
+                except Exception:
+                    status = -1
+                    raise
+                finally:
+                    mux.done(action['label'], status)
+            elif action['op'] == 'start':
+                start_container_arch(machine_uri, container, verbose=verbose)
+            elif action['op'] == 'stop':
+                stop_container_arch(machine_uri, container, verbose=verbose)
+            elif action['op'] == 'limits':
+                update_container_limits_arch(machine_uri, container, set(k for k, p, v in RESOURCE_LIMITS), verbose=verbose)
+            elif action['op'] == 'remove':
+                destroy_container_arch(machine_uri, container, verbose=verbose)
+
+    def on_done(key):
+        checkpoint['done'].append(key)
+        save_apply_checkpoint(checkpoint)
+
+    index = load_cluster_config(remote_uri, [], verbose=verbose)
+    plan_machine_uris = {
+        machine_id: '{user}@{host}:{port}'.format(**machine)
+        for machine_id, machine in index['machines'].items()
+    }
+
+    finished, failed = run_plan(plan['actions'], execute, per_machine, checkpoint['done'], on_done)
+    mux.stop()
+
+    # records of destroyed containers go last
+    removed = [a['container_id'] for a in plan['actions'] if a['op'] == 'remove' and a['key'] in finished]
+
+    if removed:
+        def mutate(config):
+            for container_id in removed:
+                config['containers'].pop(container_id, None)
+
+        machine_ids = sorted(set(plan['containers'][n]['machine_id'] for n in removed))
+        consensus_transaction(remote_uri, mutate, machine_ids=machine_ids, verbose=verbose)
+
+    if failed:
+        print('{} actions failed, run apply again to resume'.format(len(failed)), file=sys.stderr)
+        sys.exit(1)
+
+    save_apply_checkpoint(None)
+
+
+def machine_memory_samples(machines):
+    # bytes and counts never mix, None unless every machine has fresh stats
+    rings = load_stats()
+    samples = {n: fresh_stats(rings.get(n)) for n in machines}
+
+    if any(sample is None or not sample['mem_total'] for sample in samples.values()):
+        return None
+
+    return samples
+
+
+def machine_weights(config, metric='count'):
+    # capacity per machine and weight per container in same unit
+    machines = config['machines']
+    counter = machine_container_counts(config)
+    capacity = {n: 1.0 for n in machines}
+    weights = {c['id']: 1.0 for c in config['containers'].values()}
+
+    if metric == 'hash':
+        capacity = {n: machine_weight(machines[n]) for n in machines}
+
+    samples = machine_memory_samples(machines) if metric == 'memory' else None
+
+    if samples:
+        # container share of used memory, empty machines still get capacity
+        for machine_id in machines:
+            sample = samples[machine_id]
+            capacity[machine_id] = sample['mem_total']
+
+            if not counter[machine_id]:
+                continue
+
+            used = sample['mem_total'] - sample['mem_available']
+
+            for container in config['containers'].values():
+                if container['machine_id'] == machine_id:
+                    weights[container['id']] = used / counter[machine_id]
+
+    return capacity, weights
+
+
+def plan_rebalance(config, metric='count', tolerance=0.1, drain_id=None):
+    # greedy moves, each one shrinking the worst deviation from mean
+    machines = config['machines']
+    problems = []
+
+    if metric == 'memory' and machine_memory_samples(machines) is None:
+        problems.append('No fresh memory stats of every machine, balancing by count')
+        metric = 'count'
+
+    capacity, weights = machine_weights(config, metric)
+    targets = [n for n in machines if n != drain_id and not machines[n].get('drain')]
+    placement = {c['id']: c['machine_id'] for c in config['containers'].values()}
+    scratch = dict(config, containers={k: dict(v) for k, v in config['containers'].items()})
+    listening = {}
+    moves = []
+
+    if not targets:
+        return moves, problems + ['No machine to move containers to']
+
+    def load(machine_id):
+        return sum(weights[n] for n, m in placement.items() if m == machine_id) / capacity[machine_id]
+
+    def fits(container, target):
+        # ports checked against target as it will be after earlier moves
+        mode = (container.get('network') or {'mode': 'veth'})['mode']
+
+        if mode in ('veth', 'host') and target['id'] not in listening:
+            machine_uri = '{user}@{host}:{port}'.format(**target)
+
+            try:
+                listening[target['id']] = get_machine_listening_ports(machine_uri)
+            except (IOError, paramiko.SSHException):
+                listening[target['id']] = None
+
+        if mode in ('veth', 'host') and listening[target['id']] is None:
+            return None
+
+        try:
+            return migration_ports(scratch, container, target, listening.get(target['id']))
+        except PortAllocationError:
+            return None
+
+    def move(container, target_id, ports):
+        moves.append((container, container['machine_id'], target_id))
+        placement[container['id']] = target_id
+        scratch['containers'][container['id']] = dict(container, machine_id=target_id, ports=ports)
+
+    if drain_id:
+        # everything leaves, heaviest first onto least loaded machine that fits
+        leaving = [c for c in config['containers'].values() if c['machine_id'] == drain_id]
+
+        for container in sorted(leaving, key=lambda c: (-weights[c['id']], c['name'], c['id'])):
+            if container.get('pinned'):
+                problems.append('Container {} is pinned'.format(container['id']))
+                continue
+
+            if storage_mode(container) == 'overlay':
+                problems.append('Container {} has overlay storage, can not be moved'.format(container['id']))
+                continue
+
+            for target_id in sorted(targets, key=lambda n: (load(n), machines[n]['host'])):
+                ports = fits(container, machines[target_id])
+
+                if ports is not None:
+                    move(container, target_id, ports)
+                    break
+            else:
+                problems.append('No machine with free ports for container {}'.format(container['id']))
+
+        return moves, problems
+
+    if metric == 'hash':
+        # hash placed containers back to first preferred machine with room, only those whose owner changed
+        counter = Counter(placement.values())
+        hashed = [c for c in config['containers'].values() if placement_constraints(config, c).get('strategy') == 'hash']
+
+        for container in sorted(hashed, key=lambda c: c['id']):
+            if container.get('pinned') or storage_mode(container) == 'overlay':
+                continue
+
+            constraints = placement_constraints(config, container)
+            source_id = placement[container['id']]
+            preferred = hrw_machines(config, container['id'], targets)
+
+            if constraints.get('max_load'):
+                capacity = hrw_capacity(config, targets, constraints['max_load'], len(placement))
+                preferred = [n for n in preferred if n == source_id or counter[n] < capacity[n]]
+
+            for target_id in preferred:
+                if target_id == source_id:
+                    break
+
+                ports = fits(container, machines[target_id])
+
+                if ports is not None:
+                    counter[source_id] -= 1
+                    counter[target_id] += 1
+                    move(container, target_id, ports)
+                    break
+            else:
+                problems.append('No machine with free ports for container {}'.format(container['id']))
+
+        return moves, problems
+
+    total = sum(weights[n] for n, m in placement.items() if m in targets)
+    mean = total / sum(capacity[n] for n in targets)
+
+    # within tolerance, or half of smallest step since moves are whole containers
+    steps = [weights[n] / capacity[m] for n, m in placement.items() if m in targets]
+    slack = max(tolerance * mean, 0.5 * min(steps) if steps else 0)
+
+    for _ in range(len(placement)):
+        loads = {n: load(n) for n in targets}
+        deviation = max(abs(loads[n] - mean) for n in targets)
+
+        if deviation <= slack:
+            break
+
+        best = None
+        moved = set(c['id'] for c, a, b in moves)
+
+        for source_id in sorted(targets, key=lambda n: -loads[n])[:1]:
+            for target_id in sorted(targets, key=lambda n: loads[n]):
+                if target_id == source_id:
+                    continue
+
+                for container in config['containers'].values():
+                    if placement[container['id']] != source_id or container.get('pinned') or storage_mode(container) == 'overlay' or container['id'] in moved:
+                        continue
+
+                    w = weights[container['id']]
+                    new_source = loads[source_id] - w / capacity[source_id]
+                    new_target = loads[target_id] + w / capacity[target_id]
+                    after = max(abs(new_source - mean), abs(new_target - mean))
+                    before = max(abs(loads[source_id] - mean), abs(loads[target_id] - mean))
+
+                    if after >= before or (best and after >= best[0]):
+                        continue
+
+                    ports = fits(container, machines[target_id])
+
+                    if ports is not None:
+                        best = (after, container, target_id, ports)
+
+                if best:
+                    break
+
+        if not best:
+            problems.append('Could not balance further, containers pinned or ports taken')
+            break
+
+        move(best[1], best[2], best[3])
+
+    return moves, problems
+
+
+def print_rebalance(config, moves, metric):
+    machines = config['machines']
+
+    if metric == 'memory' and machine_memory_samples(machines) is None:
+        metric = 'count'
+    capacity, weights = machine_weights(config, metric)
+    before = Counter()
+    after = Counter()
+
+    for container in config['containers'].values():
+        before[container['machine_id']] += weights[container['id']]
+        after[container['machine_id']] += weights[container['id']]
+
+    for container, source_id, target_id in moves:
+        after[source_id] -= weights[container['id']]
+        after[target_id] += weights[container['id']]
+
+    print('{a: <12} {b: <10} {c: <12} {d: <12}'.format(a='CONTAINER_ID', b='NAME', c='FROM', d='TO'))
+
+    for container, source_id, target_id in moves:
+        print('{a: <12} {b: <10} {c: <12} {d: <12}'.format(
+            a=container['id'], b=container['name'], c=source_id, d=target_id,
+        ))
+
+    print()
+    print('{a: <12} {b: <24} {c: >10} {d: >10}'.format(a='MACHINE_ID', b='HOST', c='BEFORE', d='AFTER'))
+
+    for machine_id in sorted(machines, key=lambda n: machines[n]['host']):
+        fmt = {'count': '{:.0f}', 'memory': '{:.1%}'}.get(metric, '{:.1f}')
+        print('{a: <12} {b: <24} {c: >10} {d: >10}'.format(
+            a=machine_id,
+            b=machines[machine_id]['host'],
+            c=fmt.format(before[machine_id] / capacity[machine_id]),
+            d=fmt.format(after[machine_id] / capacity[machine_id]),
+        ))
+
+
+def run_moves(remote_uri, config, moves, parallel=2, direct=False, verbose=False):
+    # one move per machine at a time, at most parallel moves overall
+    machines = config['machines']
+
+    actions = [{
+        'key': 'move:{}'.format(container['id']),
+        'op': 'move',
+        'container_id': container['id'],
+        'label': container['name'],
+        'machine_id': source_id,
+        'machine_ids': [source_id, target_id],
+        'target_id': target_id,
+        'deps': [],
+    } for container, source_id, target_id in moves]
+
+    containers = {container['id']: container for container, source_id, target_id in moves}
+
+    def execute(action):
+        migrate_container(
+            remote_uri,
+            containers[action['container_id']],
+            machines[action['machine_id']],
+            machines[action['target_id']],
+            direct,
+            verbose=verbose,
+        )
+
+    finished, failed = run_plan(actions, execute, per_machine=1, limit=parallel)
+    return finished, failed
+
+
+def cluster_rebalance(remote_uri, metric='count', tolerance=0.1, dry_run=False, parallel=2, direct=False, verbose=False):
+    if not remote_uri:
+        local_config = load_local_config()
+        remote_uri = local_config['main']['remote_address']
+
+    config = load_consensus_config(remote_uri, verbose=verbose)
+    moves, problems = plan_rebalance(config, metric, tolerance)
+
+    for problem in problems:
+        print('WARNING: {}'.format(problem), file=sys.stderr)
+
+    if not moves:
+        print('Cluster is balanced')
+        return
+
+    print_rebalance(config, moves, metric)
+
+    if dry_run:
+        return
+
+    finished, failed = run_moves(remote_uri, config, moves, parallel, direct, verbose)
+
+    if failed:
+        print('{} of {} moves failed'.format(len(failed), len(moves)), file=sys.stderr)
+        sys.exit(1)
+
+
+def machine_drain(remote_uri, machine_id, dry_run=False, parallel=2, direct=False, cancel=False, verbose=False):
+    if not remote_uri:
+        local_config = load_local_config()
+        remote_uri = local_config['main']['remote_address']
+
+    def mutate(config):
+        if machine_id not in config['machines']:
+            msg = 'Machine with id {} does not exists'.format(machine_id)
+            print(msg, file=sys.stderr)
+            sys.exit(1)
+
+        if cancel:
+            config['machines'][machine_id].pop('drain', None)
+        else:
+            config['machines'][machine_id]['drain'] = True
+
+    # no new containers land there while it empties
+    if not dry_run:
+        consensus_transaction(remote_uri, mutate, machine_ids=[], verbose=verbose)
+
+    if cancel:
+        print('{} drain cancelled'.format(machine_id))
+        return
+
+    config = load_consensus_config(remote_uri, verbose=verbose)
+
+    if machine_id not in config['machines']:
+        msg = 'Machine with id {} does not exists'.format(machine_id)
+        print(msg, file=sys.stderr)
+        sys.exit(1)
+
+    moves, problems = plan_rebalance(config, drain_id=machine_id)
+
+    for problem in problems:
+        print('WARNING: {}'.format(problem), file=sys.stderr)
+
+    if moves:
+        print_rebalance(config, moves, 'count')
+    elif not problems:
+        print('{} has no containers'.format(machine_id))
+
+    if dry_run:
+        return
+
+    finished, failed = run_moves(remote_uri, config, moves, parallel, direct, verbose)
+
+    if failed or problems:
+        print('Machine {} not empty, {} moves failed'.format(machine_id, len(failed)), file=sys.stderr)
+        sys.exit(1)
+
+    print('{} drained, ready for machine remove'.format(machine_id))
+
+
+#
+# watch
+#
+def load_watch_cursors():
+    filename = 'nspawn.local.watch'
+
+    if not os.path.exists(filename):
+        return {}
+
+    try:
+        with open(filename, 'r') as f:
+            return json.load(f)
+    except ValueError:
+        return {}
+
+
+def save_watch_cursors(cursors):
+    filename = 'nspawn.local.watch'
+
+    with open(filename + '.tmp', 'w') as f:
+        json.dump(cursors, f, indent=True)
+
+    os.rename(filename + '.tmp', filename)
+
+
+def journal_follow_command(cursor=None, since=None):
+    # pid1 messages about nspawn units, only fields needed for transitions
+    command = [
+        'journalctl',
+        '--follow',
+        '--no-pager',
+        '--output=json',
+        '--unit=systemd-nspawn@*.service',
+        '--output-fields={}'.format(','.join(JOURNAL_FIELDS)),
+    ]
+
+    # resume right after last seen entry, or from when watching began
+    if cursor:
+        command += ['--after-cursor={}'.format(cursor), '--lines=all']
+    elif since:
+        command += ['--since=@{}'.format(int(since)), '--lines=all']
+    else:
+        command += ['--lines=0']
+
+    return ' '.join(shlex.quote(n) for n in command)
+
+
+def journal_event(machine_id, entry):
+    state = UNIT_EVENTS.get(entry.get('MESSAGE_ID'))
+    m = re.match(r'^systemd-nspawn@(.+)\.service$', entry.get('UNIT') or '')
+
+    if state is None or m is None:
+        return None
+
+    if state == 'exited':
+        reason = '{}={}'.format(entry.get('EXIT_CODE', ''), entry.get('EXIT_STATUS', ''))
+    elif state == 'failed':
+        reason = entry.get('UNIT_RESULT') or 'failed'
+    elif state == 'restarting':
+        reason = 'restart {}'.format(entry.get('N_RESTARTS', '')).strip()
+    else:
+        reason = entry.get('JOB_RESULT', '') if entry.get('JOB_RESULT') not in (None, 'done') else ''
+
+    # job failure is reported on started message
+    if state == 'started' and reason:
+        state = 'failed'
+
+    return {
+        'time': int(entry.get('__REALTIME_TIMESTAMP', 0)) / 1000000.0,
+        'machine_id': machine_id,
+        'container_id': m.group(1),
+        'state': state,
+        'reason': reason,
+        'cursor': entry.get('__CURSOR'),
+    }
+
+
+class EventStream(object):
+    # one journal follower channel per machine, all read from one selector loop
+    def __init__(self, machines, cursors=None, verbose=False):
+        self.machines = machines
+        self.cursors = dict(cursors or {})
+        self.verbose = verbose
+        self.selector = selectors.DefaultSelector()
+        self.connected = queue.Queue()
+        self.clients = {}
+        self.buffers = {}
+        self.pending = set()
+        self.retry = {machine_id: (0, 1) for machine_id in machines}
+        self.seen = {machine_id: (deque(), set()) for machine_id in machines}
+        self.last = {}
+        self.since = {}
+
+    def _connect_thread(self, machine_id, cursor, since):
+        machine_uri = '{user}@{host}:{port}'.format(**self.machines[machine_id])
+        command = journal_follow_command(cursor, since)
+
+        try:
+            client = ssh_client(machine_uri, retries=1)
+            transport = client.get_transport()
+
+            # dead links surface as closed channels instead of silent hangs
+            transport.set_keepalive(WATCH_KEEPALIVE)
+            chan = transport.open_session()
+            if self.verbose: print('{!r}'.format(command))
+            chan.exec_command(command)
+            self.connected.put((machine_id, client, chan, None))
+        except (IOError, paramiko.SSHException) as e:
+            self.connected.put((machine_id, None, None, e))
+
+    def _connect_due(self):
+        now = time.time()
+
+        for machine_id, (at, delay) in list(self.retry.items()):
+            if at > now or machine_id in self.pending:
+                continue
+
+            self.pending.add(machine_id)
+            since = self.since.setdefault(machine_id, now)
+
+            # connecting blocks, reading never does
+            t = threading.Thread(target=self._connect_thread, args=(machine_id, self.cursors.get(machine_id), since))
+            t.daemon = True
+            t.start()
+
+    def _register_connected(self):
+        while True:
+            try:
+                machine_id, client, chan, e = self.connected.get_nowait()
+            except queue.Empty:
+                return
+
+            self.pending.discard(machine_id)
+
+            if e is not None:
+                self._schedule(machine_id, e)
+                continue
+
+            del self.retry[machine_id]
+            self.clients[machine_id] = (client, chan)
+            self.buffers[machine_id] = b''
+            self.selector.register(chan, selectors.EVENT_READ, machine_id)
+
+            if self.verbose:
+                print('connected {}'.format(machine_id), file=sys.stderr)
+
+    def _schedule(self, machine_id, e):
+        delay = self.retry.get(machine_id, (0, 1))[1]
+        print('WARNING: Lost events of {}, retrying in {}s'.format(machine_id, delay), file=sys.stderr)
+
+        if self.verbose:
+            print('ERROR: {!r}'.format(e), file=sys.stderr)
+
+        self.retry[machine_id] = (time.time() + delay, min(delay * 2, WATCH_RECONNECT_MAX))
+
+    def _disconnect(self, machine_id, e):
+        client, chan = self.clients.pop(machine_id)
+        self.selector.unregister(chan)
+        chan.close()
+        client.close()
+
+        # partial line is sent again after resume, backoff starts over
+        self.buffers.pop(machine_id, None)
+        self.retry[machine_id] = (0, 1)
+        self._schedule(machine_id, e)
+
+    def _is_duplicate(self, machine_id, event):
+        order, seen = self.seen[machine_id]
+
+        if event['cursor'] in seen:
+            return True
+
+        order.append(event['cursor'])
+        seen.add(event['cursor'])
+
+        if len(order) > WATCH_SEEN:
+            seen.discard(order.popleft())
+
+        # same state reported twice in a row carries nothing new
+        key = (machine_id, event['container_id'])
+        transition = (event['state'], event['reason'])
+
+        if self.last.get(key) == transition:
+            return True
+
+        self.last[key] = transition
+        return False
+
+    def _read(self, machine_id, chan):
+        events = []
+
+        while chan.recv_stderr_ready():
+            err = chan.recv_stderr(STREAM_CHUNK_SIZE)
+
+            if self.verbose:
+                print('[{}] {}'.format(machine_id, err.decode(errors='replace').rstrip()), file=sys.stderr)
+
+        if not chan.recv_ready():
+            if chan.exit_status_ready() or chan.eof_received or chan.closed:
+                self._disconnect(machine_id, IOError('journal follower exited'))
+
+            return events
+
+        data = chan.recv(STREAM_CHUNK_SIZE)
+        *lines, self.buffers[machine_id] = (self.buffers[machine_id] + data).split(b'\n')
+
+        if len(self.buffers[machine_id]) > STREAM_LINE_MAX:
+            self.buffers[machine_id] = b''
+
+        for line in lines:
+            try:
+                entry = json.loads(line.decode(errors='replace'))
+            except ValueError:
+                continue
+
+            if not isinstance(entry, dict):
+                continue
+
+            if entry.get('__CURSOR'):
+                self.cursors[machine_id] = entry['__CURSOR']
+
+            event = journal_event(machine_id, entry)
+
+            if event is not None and not self._is_duplicate(machine_id, event):
+                events.append(event)
+
+        return events
+
+    def events(self, timeout=1.0):
+        # batches of events in arrival order, empty batch on idle tick
+        while True:
+            self._connect_due()
+            self._register_connected()
+            events = []
+
+            if self.clients:
+                ready = self.selector.select(timeout)
+            else:
+                time.sleep(timeout)
+                ready = []
+
+            for key, mask in ready:
+                if key.data in self.clients:
+                    events.extend(self._read(key.data, key.fileobj))
+
+            for machine_id, (client, chan) in list(self.clients.items()):
+                transport = client.get_transport()
+
+                if transport is None or not transport.is_active():
+                    self._disconnect(machine_id, IOError('connection closed'))
+
+            yield sorted(events, key=lambda n: n['time'])
+
+    def close(self):
+        for machine_id, (client, chan) in list(self.clients.items()):
+            self.selector.unregister(chan)
+            chan.close()
+            client.close()
+
+        self.clients.clear()
+        self.selector.close()
+
+
+def format_event(event, container=None):
+    return '{a} {b: <12} {c: <12} {d: <10} {e: <10} {f}'.format(
+        a=time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(event['time'])),
+        b=event['machine_id'],
+        c=event['container_id'],
+        d=container['name'] if container else '-',
+        e=event['state'],
+        f=event['reason'],
+    ).rstrip()
+
+
+def watch(remote_uri, project_id=None, machine_id=None, name=None, format_='text', reset=False, verbose=False):
+    if not remote_uri:
+        local_config = load_local_config()
+        remote_uri = local_config['main']['remote_address']
+
+    config = load_cluster_config(remote_uri, [], verbose=verbose)
+    machines = config['machines']
+    machine_ids = sorted(machines, key=lambda n: (machines[n]['host'], n))
+
+    if machine_id:
+        machine_ids = [n for n in machine_ids if n.endswith(machine_id)]
+
+    if project_id:
+        machine_ids = [n for n in machine_ids if n in project_machine_ids(config, project_id)]
+
+    if not machine_ids:
+        print('No machines to watch', file=sys.stderr)
+        sys.exit(1)
+
+    # names for selectors and output
+    ensure_shards(config, machine_ids, verbose=verbose)
+    containers = config['containers']
+
+    def selected(event):
+        container = containers.get(event['container_id'])
+
+        if (project_id or name) and container is None:
+            return False
+
+        if project_id and not container['project_id'].endswith(project_id):
+            return False
+
+        if name and not fnmatch.fnmatch(container['name'], name):
+            return False
+
+        return True
+
+    cursors = {} if reset else load_watch_cursors()
+    stream = EventStream({n: machines[n] for n in machine_ids}, cursors, verbose=verbose)
+    saved = time.time()
+
+    if format_ == 'text':
+        print('{a: <19} {b: <12} {c: <12} {d: <10} {e: <10} {f}'.format(
+            a='TIME', b='MACHINE_ID', c='CONTAINER_ID', d='NAME', e='STATE', f='REASON',
+        ))
+
+    try:
+        for events in stream.events():
+            for event in events:
+                if not selected(event):
+                    continue
+
+                if format_ == 'json':
+                    print(json.dumps(dict(event, name=(containers.get(event['container_id']) or {}).get('name'))))
+                else:
+                    print(format_event(event, containers.get(event['container_id'])))
+
+            sys.stdout.flush()
+
+            # cursors of all machines, also ones filtered out here
+            if time.time() - saved > 5:
+                save_watch_cursors(dict(load_watch_cursors(), **stream.cursors))
+                saved = time.time()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        save_watch_cursors(dict(load_watch_cursors(), **stream.cursors))
+        stream.close()
+
+
+#
+# logs
+#
+def load_log_cursors():
+    filename = 'nspawn.local.logs'
 
-    # override service
-    command = 'printf "[Service]\\nExecStart=\\nExecStart={}\\nRestart=on-failure" >{}'.format(
-        '/usr/bin/systemd-nspawn --quiet --keep-unit --boot --network-veth {} --machine={}'.format(
-            ' '.join('--port={}:{}'.format(k, v) for k, v in container['ports'].items()),
-            container['id'],
-        ),
-        '/etc/systemd/system/systemd-nspawn\@{}.service.d/override.conf'.format(
-            container['id']
-        )
+    if not os.path.exists(filename):
+        return {}
+
+    try:
+        with open(filename, 'r') as f:
+            return json.load(f)
+    except ValueError:
+        return {}
+
+
+def save_log_cursors(cursors):
+    filename = 'nspawn.local.logs'
+
+    with open(filename + '.tmp', 'w') as f:
+        json.dump(dict(load_log_cursors(), **cursors), f, indent=True)
+
+    os.rename(filename + '.tmp', filename)
+
+
+def journal_command(container_id, filters, cursor=None, follow=False):
+    # filtering happens in journalctl, only matching entries cross the wire
+    command = [
+        'journalctl',
+        '--machine={}'.format(container_id),
+        '--no-pager',
+        '--output=json',
+        '--output-fields={}'.format(','.join(LOG_FIELDS)),
+    ]
+
+    if cursor:
+        command.append('--after-cursor={}'.format(cursor))
+    elif filters.get('since'):
+        command.append('--since={}'.format(filters['since']))
+
+    if filters.get('until'):
+        command.append('--until={}'.format(filters['until']))
+
+    if filters.get('priority'):
+        command.append('--priority={}'.format(filters['priority']))
+
+    for unit in filters.get('units') or []:
+        command.append('--unit={}'.format(unit))
+
+    if filters.get('grep'):
+        command.append('--grep={}'.format(filters['grep']))
+
+    if filters.get('lines'):
+        command.append('--lines={}'.format(filters['lines']))
+    elif follow and not cursor and not filters.get('since'):
+        command.append('--lines=0')
+
+    if follow:
+        command.append('--follow')
+
+    command = ' '.join(shlex.quote(n) for n in command)
+
+    # batches are compressed, live entries go as they come
+    if not follow:
+        command = '{} | gzip -1'.format(command)
+
+    return command
+
+
+def journal_entries(data):
+    for line in data.split(b'\n'):
+        try:
+            entry = json.loads(line.decode(errors='replace'))
+        except ValueError:
+            continue
+
+        if isinstance(entry, dict) and '__REALTIME_TIMESTAMP' in entry:
+            entry['__REALTIME_TIMESTAMP'] = int(entry['__REALTIME_TIMESTAMP'])
+            yield entry
+
+
+def journal_message(entry):
+    message = entry.get('MESSAGE')
+
+    # binary messages come as list of bytes
+    if isinstance(message, list):
+        message = bytes(n for n in message if isinstance(n, int)).decode(errors='replace')
+
+    return message or ''
+
+
+def format_log_entry(container, entry, format_='text'):
+    if format_ == 'json':
+        return json.dumps({
+            'time': entry['__REALTIME_TIMESTAMP'] / 1000000.0,
+            'container_id': container['id'],
+            'name': container['name'],
+            'priority': entry.get('PRIORITY'),
+            'identifier': entry.get('SYSLOG_IDENTIFIER') or entry.get('_COMM'),
+            'pid': entry.get('_PID'),
+            'message': journal_message(entry),
+        })
+
+    t = entry['__REALTIME_TIMESTAMP'] / 1000000.0
+    identifier = entry.get('SYSLOG_IDENTIFIER') or entry.get('_COMM') or '-'
+    pid = '[{}]'.format(entry['_PID']) if entry.get('_PID') else ''
+
+    return '{a}.{b:03d} {c: <10} {d}{e}: {f}'.format(
+        a=time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(t)),
+        b=int(t * 1000) % 1000,
+        c=container['name'],
+        d=identifier,
+        e=pid,
+        f=journal_message(entry),
     )
 
-    if verbose: print('{!r}'.format(command))
-    stdin, stdout, stderr = client.exec_command(command)
-    out = stdout.read()
-    err = stderr.read()
-    stdin.close()
 
-    # demon-reload
-    command = 'systemctl daemon-reload'
-    if verbose: print('{!r}'.format(command))
-    stdin, stdout, stderr = client.exec_command(command)
-    out = stdout.read()
-    err = stderr.read()
-    stdin.close()
-    
-    # start service
-    command = 'systemctl start systemd-nspawn@{}.service'.format(container['id'])
-    if verbose: print('{!r}'.format(command))
-    stdin, stdout, stderr = client.exec_command(command)
-    out = stdout.read()
-    err = stderr.read()
-    stdin.close()
+def _logs_machine_thread(lock, results, machine, containers, filters, cursors, verbose=False):
+    machine_uri = '{user}@{host}:{port}'.format(**machine)
 
-    # enable service
-    command = 'systemctl enable systemd-nspawn@{}.service'.format(container['id'])
-    if verbose: print('{!r}'.format(command))
-    stdin, stdout, stderr = client.exec_command(command)
-    out = stdout.read()
-    err = stderr.read()
-    stdin.close()
+    try:
+        client = ssh_client(machine_uri)
 
-    # sync
-    command = 'sync'
-    if verbose: print('{!r}'.format(command))
-    stdin, stdout, stderr = client.exec_command(command)
-    out = stdout.read()
-    err = stderr.read()
-    stdin.close()
+        # one connection, one batch per container
+        try:
+            for container in containers:
+                command = journal_command(container['id'], filters, cursors.get(container['id']))
+                status, out, err = exec_command(client, command, verbose=verbose)
 
-    # close ssh client
-    client.close()
+                if err:
+                    print('WARNING: {}: {}'.format(container['name'], err.decode(errors='replace').strip()), file=sys.stderr)
 
+                data = zlib.decompress(out, 16 + zlib.MAX_WBITS) if out else b''
 
-def stop_container_arch(uri, container, verbose=False):
-    if verbose:
-        print('stop_container_arch: {}'.format(uri))
+                with lock:
+                    results[container['id']] = list(journal_entries(data))
+        finally:
+            client.close()
+    except (IOError, paramiko.SSHException, zlib.error) as e:
+        err = 'WARNING: Could not read logs on {}, skipping'.format(machine_uri)
 
-    # ssh client
-    client = ssh_client(uri)
+        if verbose:
+            print('ERROR: {!r}'.format(e), file=sys.stderr)
 
-    # demon-reload
-    command = 'systemctl daemon-reload'
-    if verbose: print('{!r}'.format(command))
-    stdin, stdout, stderr = client.exec_command(command)
-    out = stdout.read()
-    err = stderr.read()
-    stdin.close()
+        print(err, file=sys.stderr)
 
-    # stop service
-    command = 'systemctl stop systemd-nspawn@{}.service'.format(container['id'])
-    if verbose: print('{!r}'.format(command))
-    stdin, stdout, stderr = client.exec_command(command)
-    out = stdout.read()
-    err = stderr.read()
-    stdin.close()
 
-    # disable service
-    command = 'systemctl disable systemd-nspawn@{}.service'.format(container['id'])
-    if verbose: print('{!r}'.format(command))
-    stdin, stdout, stderr = client.exec_command(command)
-    out = stdout.read()
-    err = stderr.read()
-    stdin.close()
+def fetch_logs(machines, by_machine, filters, cursors, verbose=False):
+    threads = []
+    results = {}
+    lock = threading.Lock()
 
-    # sync
-    command = 'sync'
-    if verbose: print('{!r}'.format(command))
-    stdin, stdout, stderr = client.exec_command(command)
-    out = stdout.read()
-    err = stderr.read()
-    stdin.close()
+    for machine_id, containers in by_machine.items():
+        t = threading.Thread(
+            target=_logs_machine_thread,
+            args=(lock, results, machines[machine_id], containers, filters, cursors),
+            kwargs={'verbose': verbose},
+        )
 
-    # close ssh client
-    client.close()
+        t.daemon = True
+        t.start()
+        threads.append(t)
 
+    for t in join_threads(threads):
+        print('WARNING: Reading logs timed out, output is partial', file=sys.stderr)
 
-def restart_container_arch(uri, container, verbose=False):
-    if verbose:
-        print('restart_container_arch: {}'.format(uri))
+    with lock:
+        return dict(results)
 
-    # ssh client
-    client = ssh_client(uri)
 
-    # demon-reload
-    command = 'systemctl daemon-reload'
-    if verbose: print('{!r}'.format(command))
-    stdin, stdout, stderr = client.exec_command(command)
-    out = stdout.read()
-    err = stderr.read()
-    stdin.close()
+def _follow_connect_thread(connected, machine, containers, filters, cursors, verbose=False):
+    machine_uri = '{user}@{host}:{port}'.format(**machine)
 
-    # start service
-    command = 'systemctl restart systemd-nspawn@{}.service'.format(container['id'])
-    if verbose: print('{!r}'.format(command))
-    stdin, stdout, stderr = client.exec_command(command)
-    out = stdout.read()
-    err = stderr.read()
-    stdin.close()
+    try:
+        client = ssh_client(machine_uri)
+        transport = client.get_transport()
+        transport.set_keepalive(WATCH_KEEPALIVE)
+        channels = []
+
+        # channels of one machine share its connection
+        for container in containers:
+            command = journal_command(container['id'], filters, cursors.get(container['id']), follow=True)
+            chan = transport.open_session()
+            if verbose: print('{!r}'.format(command))
+            chan.exec_command(command)
+            channels.append((container, chan))
+
+        connected.put((client, channels, None))
+    except (IOError, paramiko.SSHException) as e:
+        err = 'WARNING: Could not follow logs on {}, skipping'.format(machine_uri)
+
+        if verbose:
+            print('ERROR: {!r}'.format(e), file=sys.stderr)
+
+        print(err, file=sys.stderr)
+        connected.put((None, [], e))
+
+
+def follow_logs(machines, by_machine, filters, cursors, format_='text', verbose=False):
+    # live entries of all containers from one selector loop
+    selector = selectors.DefaultSelector()
+    connected = queue.Queue()
+    clients = []
+    buffers = {}
+
+    for machine_id, containers in by_machine.items():
+        t = threading.Thread(
+            target=_follow_connect_thread,
+            args=(connected, machines[machine_id], containers, filters, cursors),
+            kwargs={'verbose': verbose},
+        )
+
+        t.daemon = True
+        t.start()
+
+    waiting = len(by_machine)
+
+    try:
+        while waiting or buffers:
+            while True:
+                try:
+                    client, channels, e = connected.get_nowait()
+                except queue.Empty:
+                    break
+
+                waiting -= 1
+
+                if client is not None:
+                    clients.append(client)
+
+                for container, chan in channels:
+                    buffers[chan] = b''
+                    selector.register(chan, selectors.EVENT_READ, container)
+
+            if not buffers:
+                time.sleep(0.1)
+                continue
+
+            entries = []
+
+            for key, mask in selector.select(1.0):
+                chan, container = key.fileobj, key.data
+
+                while chan.recv_stderr_ready():
+                    err = chan.recv_stderr(STREAM_CHUNK_SIZE)
+                    print('WARNING: {}: {}'.format(container['name'], err.decode(errors='replace').strip()), file=sys.stderr)
+
+                if not chan.recv_ready():
+                    if chan.exit_status_ready() or chan.eof_received or chan.closed:
+                        print('WARNING: Stopped following {}'.format(container['name']), file=sys.stderr)
+                        selector.unregister(chan)
+                        del buffers[chan]
+
+                    continue
+
+                *lines, buffers[chan] = (buffers[chan] + chan.recv(STREAM_CHUNK_SIZE)).split(b'\n')
+
+                if len(buffers[chan]) > STREAM_LINE_MAX:
+                    buffers[chan] = b''
+
+                for entry in journal_entries(b'\n'.join(lines)):
+                    entries.append((entry['__REALTIME_TIMESTAMP'], container, entry))
+
+            # entries arriving together are put in time order
+            for t, container, entry in sorted(entries, key=lambda n: n[0]):
+                cursors[container['id']] = entry.get('__CURSOR', cursors.get(container['id']))
+                print(format_log_entry(container, entry, format_))
+
+            sys.stdout.flush()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for client in clients:
+            client.close()
+
+        selector.close()
+
+
+def logs(remote_uri, project_id=None, container_id=None, machine_id=None, name=None, since=None, until=None, priority=None, units=None, grep=None, lines=None, since_last=False, follow=False, format_='text', verbose=False):
+    if not remote_uri:
+        local_config = load_local_config()
+        remote_uri = local_config['main']['remote_address']
+
+    # machine alone means every container on it, of any project
+    if not project_id and not (machine_id and not container_id):
+        local_config = load_local_config()
+        project_id = local_config['main']['project_id']
+
+    config = load_cluster_config(remote_uri, [], verbose=verbose)
+    machines = config['machines']
+
+    if container_id:
+        ensure_shards(config, project_machine_ids(config, project_id), verbose=verbose)
+        containers = [find_container(config, container_id, verbose=verbose)]
+    else:
+        machine_ids = list(machines)
+
+        if machine_id:
+            machine_ids = [n for n in machine_ids if n.endswith(machine_id)]
+
+        if project_id:
+            machine_ids = [n for n in machine_ids if n in project_machine_ids(config, project_id)]
+
+        ensure_shards(config, machine_ids, verbose=verbose)
+
+        containers = [
+            c
+            for c in config['containers'].values()
+            if c['machine_id'] in machine_ids
+            and (not project_id or c['project_id'].endswith(project_id))
+            and (not name or fnmatch.fnmatch(c['name'], name))
+        ]
+
+    if not containers:
+        print('No containers', file=sys.stderr)
+        sys.exit(1)
+
+    by_machine = {}
+
+    for container in containers:
+        by_machine.setdefault(container['machine_id'], []).append(container)
+
+    # only entries after what previous run showed
+    saved = load_log_cursors()
+    cursors = {c['id']: saved[c['id']] for c in containers if since_last and c['id'] in saved}
+
+    filters = {
+        'since': since,
+        'until': until,
+        'priority': priority,
+        'units': units,
+        'grep': grep,
+        'lines': lines,
+    }
+
+    if not since and not lines and not (since_last and cursors) and not follow:
+        filters['lines'] = LOG_LINES
+
+    if not follow or filters['lines'] or since or cursors:
+        results = fetch_logs(machines, by_machine, filters, cursors, verbose=verbose)
+        by_id = {c['id']: c for c in containers}
+
+        # each container journal is in time order, k-way merge into one stream
+        merged = heapq.merge(*[
+            [(e['__REALTIME_TIMESTAMP'], container_id, e) for e in entries]
+            for container_id, entries in results.items()
+        ], key=lambda n: n[:2])
+
+        for t, _container_id, entry in merged:
+            print(format_log_entry(by_id[_container_id], entry, format_))
+
+            if entry.get('__CURSOR'):
+                cursors[_container_id] = entry['__CURSOR']
+
+        sys.stdout.flush()
+
+    if follow:
+        # continue right after what was printed
+        filters = dict(filters, lines=None, since=None)
+        follow_logs(machines, by_machine, filters, cursors, format_, verbose=verbose)
+
+    save_log_cursors(cursors)
+
+
+#
+# top
+#
+def top_command(interval):
+    # shell builtins only, one sleep per interval whatever the container count
+    return ' '.join([
+        'cd /sys/fs/cgroup/machine.slice 2>/dev/null || exit 1;',
+        'while :; do',
+        'read t x </proc/uptime; echo "T $t";',
+        'for d in systemd-nspawn@*.service; do',
+        '[ -d "$d" ] || continue;',
+        'n=${d#*@}; echo "C ${n%.service}";',
+        'while read k v; do [ "$k" = usage_usec ] && echo "U $v"; done <$d/cpu.stat;',
+        'read v <$d/memory.current && echo "M $v";',
+        'read v <$d/pids.current && echo "P $v";',
+        '[ -r $d/io.stat ] && while read l; do echo "I $l"; done <$d/io.stat;',
+        'done;',
+        'echo E;',
+        'sleep {};'.format(interval),
+        'done',
+    ])
+
+
+def parse_top_line(line, batch, current):
+    kind, sep, rest = line.partition(' ')
+
+    if kind == 'C':
+        current = batch[rest] = {'cpu': 0, 'memory': 0, 'pids': 0, 'read': 0, 'write': 0}
+    elif kind == 'U':
+        current['cpu'] = int(rest)
+    elif kind == 'M':
+        current['memory'] = int(rest)
+    elif kind == 'P':
+        current['pids'] = int(rest)
+    elif kind == 'I':
+        # per device, like 8:0 rbytes=1 wbytes=2 rios=3 wios=4 dbytes=0 dios=0
+        for field in rest.split()[1:]:
+            key, sep, value = field.partition('=')
+
+            if key in ('rbytes', 'wbytes'):
+                current[{'rbytes': 'read', 'wbytes': 'write'}[key]] += int(value)
+
+    return current
+
+
+def _top_machine_thread(lock, samples, errors, machine, interval, verbose=False):
+    # one channel for whole session, host pushes batch every interval
+    machine_uri = '{user}@{host}:{port}'.format(**machine)
+
+    try:
+        client = ssh_client(machine_uri)
+        chan = client.get_transport().open_session()
+        command = top_command(interval)
+        if verbose: print('{!r}'.format(command))
+        chan.exec_command(command)
+        buffer = b''
+        batch = {}
+        current = None
+        t = None
+
+        while True:
+            data = chan.recv(STREAM_CHUNK_SIZE)
+
+            if not data:
+                break
+
+            *lines, buffer = (buffer + data).split(b'\n')
+
+            for line in lines:
+                line = line.decode()
+
+                if line.startswith('T '):
+                    # host uptime, rates do not depend on network delay
+                    t = float(line[2:])
+                    batch = {}
+                elif line == 'E':
+                    with lock:
+                        previous = samples.get(machine['id'], (None, None))[1]
+                        samples[machine['id']] = (previous, (t, batch))
+                else:
+                    current = parse_top_line(line, batch, current)
+
+        raise IOError(chan.recv_stderr(STREAM_LINE_MAX).decode() or 'No cgroup stats on {}'.format(machine['host']))
+    except (IOError, paramiko.SSHException, ValueError, TypeError) as e:
+        with lock:
+            errors[machine['id']] = e
+
+
+def top_rows(machines, containers, samples, show_unknown=False):
+    # rates between last two batches of each machine
+    rows = []
+
+    for machine_id, (previous, latest) in samples.items():
+        if previous is None:
+            continue
+
+        t0, before = previous
+        t1, after = latest
+        dt = t1 - t0
+
+        for container_id, b in after.items():
+            container = containers.get(container_id)
+
+            if container is None and not show_unknown:
+                continue
+
+            a = before.get(container_id)
+
+            def rate(key, scale=1.0):
+                # restarted container starts its counters over
+                if a is None or dt <= 0 or b[key] < a[key]:
+                    return None
+
+                return scale * (b[key] - a[key]) / dt
+
+            rows.append({
+                'id': container_id,
+                'name': container['name'] if container else '-',
+                'project_id': container['project_id'] if container else None,
+                'machine_id': machine_id,
+                'host': machines[machine_id]['host'],
+                'cpu': rate('cpu', 100.0 / 1e6),
+                'memory': b['memory'],
+                'pids': b['pids'],
+                'read': rate('read'),
+                'write': rate('write'),
+            })
+
+    return rows
+
+
+def sort_top_rows(rows, sort='cpu'):
+    if sort == 'name':
+        return sorted(rows, key=lambda n: (n['name'], n['id']))
+
+    # unknown rates last
+    key = TOP_SORT[sort]
+    return sorted(rows, key=lambda n: (key(n) is None, -(key(n) or 0), n['name'], n['id']))
+
+
+def print_top(rows, errors, machines, limit=None):
+    print('{a: <12} {b: <16} {c: <16} {d: >7} {e: >9} {f: >6} {g: >9} {h: >9}'.format(
+        a='CONTAINER_ID', b='NAME', c='HOST', d='CPU%', e='MEM', f='PIDS', g='READ/s', h='WRITE/s',
+    ))
+
+    for row in rows[:limit]:
+        print('{a: <12} {b: <16} {c: <16} {d: >7} {e: >9} {f: >6} {g: >9} {h: >9}'.format(
+            a=row['id'],
+            b=row['name'][:16],
+            c=row['host'][:16],
+            d=_format_stat(row['cpu']),
+            e=_format_bytes(row['memory']),
+            f=row['pids'],
+            g=_format_bytes(row['read']),
+            h=_format_bytes(row['write']),
+        ))
+
+    for machine_id, e in sorted(errors.items()):
+        print('WARNING: No stats from machine {}: {}'.format(machines[machine_id]['host'], e), file=sys.stderr)
+
+
+def top(remote_uri, project_id=None, machine_id=None, name=None, interval=TOP_INTERVAL, sort='cpu', limit=None, once=False, format_='table', verbose=False):
+    if not remote_uri:
+        local_config = load_local_config()
+        remote_uri = local_config['main']['remote_address']
+
+    # whole cluster unless narrowed
+    config = load_cluster_config(remote_uri, [], verbose=verbose)
+    machines = config['machines']
+    machine_ids = list(machines)
+
+    if machine_id:
+        machine_ids = [n for n in machine_ids if n.endswith(machine_id)]
+
+    if project_id:
+        machine_ids = [n for n in machine_ids if n in project_machine_ids(config, project_id)]
+
+    if not machine_ids:
+        print('No machines', file=sys.stderr)
+        sys.exit(1)
+
+    ensure_shards(config, machine_ids, verbose=verbose)
+
+    containers = {
+        c['id']: c
+        for c in config['containers'].values()
+        if c['machine_id'] in machine_ids
+        and (not project_id or c['project_id'].endswith(project_id))
+        and (not name or fnmatch.fnmatch(c['name'], name))
+    }
+
+    samples = {}
+    errors = {}
+    lock = threading.Lock()
+
+    for _machine_id in machine_ids:
+        t = threading.Thread(
+            target=_top_machine_thread,
+            args=(lock, samples, errors, machines[_machine_id], interval),
+            kwargs={'verbose': verbose},
+        )
 
-    # enable service
-    command = 'systemctl enable systemd-nspawn@{}.service'.format(container['id'])
-    if verbose: print('{!r}'.format(command))
-    stdin, stdout, stderr = client.exec_command(command)
-    out = stdout.read()
-    err = stderr.read()
-    stdin.close()
+        t.daemon = True
+        t.start()
 
-    # sync
-    command = 'sync'
-    if verbose: print('{!r}'.format(command))
-    stdin, stdout, stderr = client.exec_command(command)
-    out = stdout.read()
-    err = stderr.read()
-    stdin.close()
+    # units nspawn does not know about only when nothing is filtered
+    show_unknown = not project_id and not name
 
-    # close ssh client
-    client.close()
+    if once:
+        # two batches from every reachable machine, or give up at deadline
+        deadline = time.time() + CLUSTER_DEADLINE + interval
 
+        while time.time() < deadline:
+            with lock:
+                pending = [n for n in machine_ids if n not in errors and (samples.get(n) or (None,))[0] is None]
 
-def load_remote_config(uri, filename='nspawn.remote.conf', verbose=False):
-    uri = rebuild_uri(uri)
+            if not pending:
+                break
 
-    if verbose:
-        print('load_remote_config: {}'.format(uri))
+            time.sleep(0.1)
 
-    # ssh client
-    client = ssh_client(uri)
+        with lock:
+            rows = sort_top_rows(top_rows(machines, containers, samples, show_unknown), sort)
+            errors = dict(errors)
 
-    command = 'cat "{}"'.format(filename)
-    stdin, stdout, stderr = client.exec_command(command)
-    out = stdout.read().decode()
-    err = stderr.read().decode()
-    stdin.close()    
-    
-    if err:
-        raise IOError(err)
+        if format_ == 'json':
+            print(json.dumps(rows[:limit], indent=2))
 
-    # close ssh client
-    client.close()
-    
-    config = json.loads(out)
-    return config
+            for machine_id, e in sorted(errors.items()):
+                print('WARNING: No stats from machine {}: {}'.format(machines[machine_id]['host'], e), file=sys.stderr)
+        else:
+            print_top(rows, errors, machines, limit)
 
+        if errors:
+            sys.exit(1)
 
-def save_remote_config(uri, config, filename='nspawn.remote.conf', verbose=False):
-    uri = rebuild_uri(uri)
-    
-    if verbose:
-        print('save_remote_config: {}'.format(uri))
+        return
 
-    # ssh client
-    client = ssh_client(uri)
+    try:
+        while True:
+            time.sleep(interval)
 
-    # save remote config
-    _config = shlex.quote(json.dumps(config, indent=True))
-    command = 'echo {} > "{}"'.format(_config, filename)
-    stdin, stdout, stderr = client.exec_command(command)
-    err = stderr.read()
-    stdin.close()
-    
-    if err:
-        raise IOError(err)
+            with lock:
+                rows = sort_top_rows(top_rows(machines, containers, samples, show_unknown), sort)
+                failed = dict(errors)
 
-    # close ssh client
-    client.close()
+            if format_ == 'json':
+                # one line per interval for scripts
+                print(json.dumps({'time': time.time(), 'containers': rows[:limit]}))
+            else:
+                # redraw in place
+                sys.stdout.write('\033[H\033[2J')
+                print('{} machines, {} containers, every {:g}s, by {}'.format(len(machine_ids) - len(failed), len(rows), interval, sort))
+                print()
+                print_top(rows, failed, machines, limit)
 
+            sys.stdout.flush()
+    except KeyboardInterrupt:
+        pass
 
-def merge_remote_configs(configs):
-    merged_machines = {}
-    merged_projects = {}
-    merged_containers = {}
 
-    for config in configs:
-        # merge machines
-        machines = config.get('machines', {})
-        merged_machines.update(machines)
+#
+# api
+#
+def random_id():
+    m = hashlib.sha1()
+    m.update('{}'.format(random.randint(0, 2 ** 128)).encode())
+    return m.hexdigest()[-12:]
 
-        # merge projects
-        projects = config.get('projects', {})
-        merged_projects.update(projects)
 
-        # merge containers
-        containers = config.get('containers', {})
-        merged_containers.update(containers)
+class Cluster(object):
+    # in-process session: state loaded once, mutations queued and saved in one
+    # consensus transaction, remote actions run in background as futures
+    def __init__(self, remote_uri=None, workers=16, verbose=False):
+        if not remote_uri:
+            local_config = load_local_config()
+            remote_uri = local_config['main']['remote_address']
 
-    config = {
-        'machines': merged_machines,
-        'projects': merged_projects,
-        'containers': merged_containers,
-    }
+        self.remote_uri = remote_uri
+        self.verbose = verbose
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+        self.pending = []
+        self.config = None
+        self.refresh()
 
-    return config
+    def __enter__(self):
+        return self
 
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
 
-def _load_consensus_config_thread(lock, configs, machine_uri, verbose=False):
-    try:
-        config = load_remote_config(machine_uri, verbose=verbose)
-    except IOError as e:
-        err = 'ERROR: Could not load remote config from {}'.format(
-            machine_uri,
-        )
+    def close(self):
+        self.executor.shutdown(wait=True)
 
-        if verbose:
-            print('ERROR: {!r}'.format(e), file=sys.stderr)
+    def refresh(self):
+        self.config = read_cluster_config(self.remote_uri, None, verbose=self.verbose)
 
-        print(err, file=sys.stderr)
-        
-        with lock:
-            answer = input('Skip? [y/n]: ')
+    def _uri(self, machine_id):
+        return '{user}@{host}:{port}'.format(**self.machine(machine_id))
 
-        if answer == 'n':
-            sys.exit(-1)
+    #
+    # reads, copies of last loaded or committed state
+    #
+    def machines(self):
+        machines = self.config['machines']
+        return [dict(machines[n]) for n in sorted(machines, key=lambda n: machines[n]['host'])]
 
-        return
+    def machine(self, machine_id):
+        if machine_id not in self.config['machines']:
+            raise ClusterError('Machine with id {} does not exists'.format(machine_id))
 
-    with lock:
-        configs.append(config)
+        return dict(self.config['machines'][machine_id])
 
+    def projects(self):
+        projects = self.config['projects']
+        return [dict(projects[n]) for n in sorted(projects, key=lambda n: projects[n]['name'])]
 
-def load_consensus_config(uri, filename='nspawn.remote.conf', verbose=False):
-    # load remote config of boostrap/main node
-    try:
-        config = load_remote_config(uri, verbose=verbose)
-    except IOError as e:
-        print('ERROR: Could not load remote config.')
-        sys.exit(-1)
+    def project(self, project_id):
+        if project_id not in self.config['projects']:
+            raise ClusterError('Project with id {} does not exists'.format(project_id))
 
-    # get all remote configs and merge them
-    machines = config.get('machines', {})
-    configs = []
+        return dict(self.config['projects'][project_id])
 
-    """for machine_id, machine in machines.items():
-        machine_uri = '{user}@{host}:{port}'.format(**machine)
+    def containers(self, project_id=None, machine_id=None, name=None):
+        return [
+            dict(c)
+            for c in sorted(self.config['containers'].values(), key=lambda n: (n['name'], n['id']))
+            if (not project_id or c['project_id'] == project_id)
+            and (not machine_id or c['machine_id'] == machine_id)
+            and (not name or fnmatch.fnmatch(c['name'], name))
+        ]
 
-        try:
-            config = load_remote_config(machine_uri, verbose=verbose)
-        except IOError as e:
-            err = 'ERROR: Could not load remote config from {}'.format(
-                machine_uri,
-            )
+    def container(self, container_id):
+        if container_id not in self.config['containers']:
+            raise ClusterError('Container with id {} does not exists'.format(container_id))
 
-            if verbose:
-                print('ERROR: {!r}'.format(e), file=sys.stderr)
+        return dict(self.config['containers'][container_id])
 
-            print(err, file=sys.stderr)
-            answer = input('Skip? [y/n]: ')
+    #
+    # queued mutations, validated again on commit against fresh state
+    #
+    def add_machine(self, uri, port_ranges=None, labels=None, weight=None):
+        user, host, port = parse_uri(uri)
+        machine_id = random_id()
 
-            if answer == 'n':
-                sys.exit(-1)
+        def mutate(config):
+            if any(m['host'] == host for m in config['machines'].values()):
+                raise ClusterError('Machine with host {} already exists'.format(host))
 
-        configs.append(config)"""
+            machine = {'id': machine_id, 'user': user, 'host': host, 'port': port}
 
-    threads = []
-    lock = threading.Lock()
+            if port_ranges:
+                machine['port_ranges'] = [list(n) for n in port_ranges]
 
-    for machine_id, machine in machines.items():
-        machine_uri = '{user}@{host}:{port}'.format(**machine)
-        
-        t = threading.Thread(
-            target=_load_consensus_config_thread,
-            args=(lock, configs, machine_uri),
-            kwargs={'verbose': verbose},
-        )
+            if labels:
+                machine['labels'] = dict(labels)
 
-        t.start()
-        threads.append(t)
+            if weight is not None:
+                machine['weight'] = weight
 
-    for t in threads:
-        t.join()
+            config['machines'][machine_id] = machine
+            return machine
 
-    config = merge_remote_configs(configs)
-    return config
+        self.pending.append((mutate, [], None))
+        return machine_id
 
+    def remove_machine(self, machine_id):
+        def mutate(config):
+            if machine_id not in config['machines']:
+                raise ClusterError('Machine with id {} does not exists'.format(machine_id))
 
-def _save_consensus_config_thread(lock, config, machine_uri, verbose=False):
-    try:    
-        save_remote_config(machine_uri, config, verbose=verbose)
-    except IOError as e:
-        err = 'ERROR: Could not save remote config on {}'.format(
-            machine_uri,
-        )
+            if any(c['machine_id'] == machine_id for c in config['containers'].values()):
+                raise ClusterError('Machine {} still hosts containers'.format(machine_id))
 
-        if verbose:
-            print('ERROR: {!r}'.format(e), file=sys.stderr)
+            return config['machines'].pop(machine_id)
 
-        print(err, file=sys.stderr)
+        self.pending.append((mutate, [machine_id], None))
 
-        with lock:
-            answer = input('Skip? [y/n]: ')
+    def add_project(self, name, port_ranges=None, placement=None):
+        project_id = random_id()
+        placement = parse_placement(**(placement or {}))
 
-        if answer == 'n':
-            sys.exit(-1)
+        def mutate(config):
+            projects = config['projects']
 
+            if any(p['name'] == name for p in projects.values()):
+                raise ClusterError('Project with name {} already exists'.format(name))
 
-def save_consensus_config(config, filename='nspawn.remote.conf', verbose=False):
-    machines = config.get('machines', {})
-    
-    """for machine_id, machine in machines.items():
-        machine_uri = '{user}@{host}:{port}'.format(**machine)
+            for start, end in port_ranges or ():
+                for project in projects.values():
+                    for r_start, r_end in project.get('port_ranges', []):
+                        if start <= r_end and r_start <= end:
+                            raise ClusterError('Port range {}-{} overlaps project {}'.format(start, end, project['name']))
 
-        try:    
-            save_remote_config(machine_uri, config, verbose=verbose)
-        except IOError as e:
-            err = 'ERROR: Could not save remote config on {}'.format(
-                machine_uri,
-            )
+            project = {'id': project_id, 'name': name}
 
-            if verbose:
-                print('ERROR: {!r}'.format(e), file=sys.stderr)
+            if port_ranges:
+                project['port_ranges'] = [list(n) for n in port_ranges]
 
-            print(err, file=sys.stderr)
-            answer = input('Skip? [y/n]: ')
+            if placement:
+                project['placement'] = placement
 
-            if answer == 'n':
-                sys.exit(-1)"""
+            projects[project_id] = project
+            return project
 
-    threads = []
-    lock = threading.Lock()
+        self.pending.append((mutate, [], None))
+        return project_id
 
-    for machine_id, machine in machines.items():
-        machine_uri = '{user}@{host}:{port}'.format(**machine)
+    def remove_project(self, project_id):
+        def mutate(config):
+            if project_id not in config['projects']:
+                raise ClusterError('Project with id {} does not exists'.format(project_id))
 
-        t = threading.Thread(
-            target=_save_consensus_config_thread,
-            args=(lock, config, machine_uri),
-            kwargs={'verbose': verbose},
-        )
+            return config['projects'].pop(project_id)
 
-        t.start()
-        threads.append(t)
+        self.pending.append((mutate, [], None))
 
-    for t in threads:
-        t.join()
+    def add_container(self, project_id, name, ports='22', distro='arch', machine_id=None, limits=None, network=None, storage='copy', pinned=False, group=None, placement=None, bootstrap=True, start=False):
+        # placement happens on commit, bootstrap is a future returned by commit
+        requested_ports = parse_ports(ports) if ports else []
+        placement = parse_placement(**(placement or {}))
+        limits = {k: v for k, v in parse_limits(limits or {}).items() if v is not None}
+        container_id = random_id()
+        listening_ports_map = {}
 
+        def mutate(config):
+            if project_id not in config['projects']:
+                raise ClusterError('Project with id {} does not exists'.format(project_id))
 
-def find_available_machine(config, container):
-    machines = config['machines']
-    containers = config['containers']
-    
-    if containers:
-        # find least occupied machine
-        counter = Counter()
-        machines_ids = machines.keys()
-        counter.update(machines_ids)
-        machines_ids = [c['machine_id'] for c in containers.values()]
-        counter.update(machines_ids)
-        machine_id = counter.most_common()[-1][0]
-        machine = machines[machine_id]
-    else:
-        # from sorted list of machines by host pick first
-        machines_values = sorted(machines.values(), key=lambda n: n['host'])
-        machine = machines_values[0]
+            if machine_id and machine_id not in config['machines']:
+                raise ClusterError('Machine with id {} does not exists'.format(machine_id))
 
-    return machine
+            # already saved by attempt which lost index race
+            if container_id in config['containers']:
+                return config['containers'][container_id]
 
+            container = {
+                'id': container_id,
+                'project_id': project_id,
+                'name': name,
+                'distro': distro,
+                'image_id': None,
+                'image': None,
+            }
 
-def find_available_machine_port(config, machine, dest_port):
-    # find containers for a given machine
-    containers = {
-        c_id: c
-        for c_id, c in config['containers'].items()
-        if c['machine_id'] == machine['id']
-    }
+            if limits:
+                container['limits'] = dict(limits)
 
-    # map ports used on that machine
-    containers_ports_map = {}
+            if network:
+                container['network'] = dict(network)
 
-    for container_id, container in containers.items():
-        for c_src_port, c_dest_port in container['ports'].items():
-            c_src_port = int(c_src_port)
-            containers_ports_map[c_src_port] = c_dest_port
+            if storage != 'copy':
+                container['storage'] = {'mode': storage}
 
-    # find available port on that machine
-    port = dest_port
+            if pinned:
+                container['pinned'] = True
 
-    if port < 10000:
-        port += 10000
+            if group:
+                container['group'] = group
 
-    while port in containers_ports_map:
-        port += 1
+            if placement:
+                container['placement'] = dict(placement)
 
-    return port
+            place_container(config, container, requested_ports, machine_id, listening_ports_map, self.verbose)
+            config['containers'][container_id] = container
+            return container
 
+        def after(container):
+            return self.executor.submit(self._bootstrap, container, start)
 
-def find_available_machine_ports(config, machine, requested_ports):
-    available_ports_map = {}
+        self.pending.append((mutate, [machine_id] if machine_id else [], after if bootstrap else None))
+        return container_id
 
-    for src_port, dest_port in requested_ports:
-        if not src_port:
-            src_port = find_available_machine_port(config, machine, dest_port)
+    def update_container(self, container_id, limits=None, pinned=None):
+        # limits take effect on host when unit is restarted or via apply_limits
+        limits = parse_limits(limits or {})
+        machine_id = self.container(container_id)['machine_id']
 
-        src_port = int(src_port)
-        available_ports_map[src_port] = dest_port
+        def mutate(config):
+            container = config['containers'].get(container_id)
 
-    return available_ports_map
+            if container is None:
+                raise ClusterError('Container with id {} does not exists'.format(container_id))
 
+            container_limits = container.setdefault('limits', {})
 
-#
-# config
-#
-def config_config(section, property_, value=None):
-    config = load_local_config()
+            for key, value in limits.items():
+                if value is None:
+                    container_limits.pop(key, None)
+                else:
+                    container_limits[key] = value
 
-    if section not in config:
-        config[section] = {}
+            if not container_limits:
+                del container['limits']
 
-    if value:
-        config[section][property_] = value    
-        save_local_config(config)
-    else:
-        value = config[section][property_]
-        print(value)
+            if pinned:
+                container['pinned'] = True
+            elif pinned is not None:
+                container.pop('pinned', None)
 
+            return container
 
-#
-# machine
-#
-def machine_list(remote_uri, verbose=False):
-    if not remote_uri:
-        local_config = load_local_config()
-        remote_uri = local_config['main']['remote_address']
+        def after(container):
+            return self.executor.submit(self._update_limits, container, set(limits))
 
-    remote_config = load_consensus_config(remote_uri, verbose=verbose)
-    machine_items = remote_config.get('machines', {}).items()
-    machine_items = sorted(
-        list(machine_items),
-        key=lambda n: (n[1]['host'], n[1]['port'])
-    )
-    print('{a: <12} {b: <67}'.format(a='MACHINE_ID', b='ADDRESS'))
+        self.pending.append((mutate, [machine_id], after if limits else None))
 
-    for machine_id, machine in machine_items:
-        print('{a: <12} {b: <67}'.format(
-            a=machine['id'],
-            b='{}@{}:{}'.format(
-                machine['user'],
-                machine['host'],
-                machine['port'],
-            ),
-        ))
+    def remove_container(self, container_id, destroy=True):
+        machine_id = self.container(container_id)['machine_id']
 
+        def mutate(config):
+            container = config['containers'].pop(container_id, None)
 
-def machine_add(remote_uri, uri, verbose=False):
-    if not remote_uri:
-        local_config = load_local_config()
-        remote_uri = local_config['main']['remote_address']
+            if container is None:
+                raise ClusterError('Container with id {} does not exists'.format(container_id))
 
-    remote_user, remote_host, remote_port = parse_uri(remote_uri)
-    user, host, port = parse_uri(uri)
-    config = load_consensus_config(remote_uri, verbose=verbose)
-    machines = config['machines']
+            return container
 
-    # check if host already exists
-    for machine_id, machine in machines.items():
-        if host == machine['host']:
-            msg = 'Machine with host {} already exists'.format(host)
-            print(msg, file=sys.stderr)
-            sys.exit(1)
+        def after(container):
+            return self.executor.submit(self._destroy, container)
 
-    # generate random ID
-    m = hashlib.sha1()
-    m.update('{}'.format(random.randint(0, 2 ** 128)).encode())
-    machine_id = m.hexdigest()[-12:]
+        self.pending.append((mutate, [machine_id], after if destroy else None))
 
-    machine = {
-        'id': machine_id,
-        'user': user,
-        'host': host,
-        'port': port,
-    }
+    def rollback(self):
+        self.pending = []
 
-    machines[machine_id] = machine
-    save_consensus_config(config, verbose=verbose)
-    print('{} {}@{}:{}'.format(machine_id, user, host, port))
+    def commit(self):
+        # all queued mutations in one load, mutate and save; on conflict they
+        # are all replayed on fresh state, nothing is saved if one fails
+        if not self.pending:
+            return []
 
+        pending = self.pending
+        machine_ids = sorted(set(n for mutate, ids, after in pending for n in ids))
 
-def machine_remove(remote_uri, machine_id, verbose=False):
-    if not remote_uri:
-        local_config = load_local_config()
-        remote_uri = local_config['main']['remote_address']
+        def mutate_all(config):
+            return [mutate(config) for mutate, ids, after in pending]
 
-    remote_user, remote_host, remote_port = parse_uri(remote_uri)
-    config = load_consensus_config(remote_uri, verbose=verbose)
-    machines = config['machines']
+        config, results = transaction(self.remote_uri, mutate_all, machine_ids, verbose=self.verbose)
+        self.pending = []
 
-    # make sure user wants to delete machine
-    answer = input('Are you sure you want to remove machine? [y/n]: ')
+        # committed shards replace loaded ones, others kept as they were
+        containers = {
+            k: v
+            for k, v in self.config['containers'].items()
+            if v['machine_id'] not in config['shards'] and v['machine_id'] in config['machines']
+        }
 
-    if answer != 'y':
-        sys.exit(-1)
+        containers.update(config['containers'])
+        self.config = dict(config, containers=containers, shards=dict(self.config['shards'], **config['shards']))
 
-    if machine_id not in machines:
-        msg = 'Machine with id {} does not exists'.format(machine_id)
-        print(msg, file=sys.stderr)
-        sys.exit(1)
+        # follow-up remote work of committed mutations
+        return [after(result) for (mutate, ids, after), result in zip(pending, results) if after is not None]
 
-    del machines[machine_id]
-    save_consensus_config(config, verbose=verbose)
-    print('{}'.format(machine_id))
+    #
+    # remote actions, returned as futures so callers can overlap them
+    #
+    def _container_uri(self, container):
+        if container['distro'] != 'arch':
+            raise NotImplementedError
 
+        return self._uri(container['machine_id'])
 
-#
-# project
-#
-def project_list(remote_uri, verbose=False):
-    if not remote_uri:
-        local_config = load_local_config()
-        remote_uri = local_config['main']['remote_address']
+    def _bootstrap(self, container, start=False):
+        uri = self._container_uri(container)
+        output = OutputMux().stream(container['id'], echo=self.verbose)
 
-    remote_config = load_consensus_config(remote_uri, verbose=verbose)
-    project_items = remote_config.get('projects', {}).items()
-    project_items = list(project_items)
-    project_items = sorted(project_items, key=lambda n: n[1]['name'])
-    print('{a: <12} {b: <67}'.format(a='PROJECT_ID', b='NAME'))
+        with lease(uri, 'container-{}'.format(container['id']), verbose=self.verbose):
+            create_container_arch_install(uri, container, start, self.verbose, output)
 
-    for project_id, project in project_items:
-        print('{a: <12} {b: <67}'.format(
-            a=project['id'],
-            b='{}'.format(project['name']),
-        ))
+        return container
 
+    def _destroy(self, container):
+        uri = self._container_uri(container)
 
-def project_add(remote_uri, project_name, verbose=False):
-    if not remote_uri:
-        local_config = load_local_config()
-        remote_uri = local_config['main']['remote_address']
+        with lease(uri, 'container-{}'.format(container['id']), verbose=self.verbose):
+            destroy_container_arch(uri, container, self.verbose)
 
-    remote_user, remote_host, remote_port = parse_uri(remote_uri)
-    config = load_consensus_config(remote_uri, verbose=verbose)
-    projects = config['projects']
+        return container
 
-    # check if project name already exists
-    for project_id, project in projects.items():
-        if project_name == project['name']:
-            msg = 'Project with name {} already exists'.format(project_name)
-            print(msg, file=sys.stderr)
-            sys.exit(1)
+    def _update_limits(self, container, changed):
+        uri = self._container_uri(container)
 
-    # generate random ID
-    m = hashlib.sha1()
-    m.update('{}'.format(random.randint(0, 2 ** 128)).encode())
-    project_id = m.hexdigest()[-12:]
+        with lease(uri, 'container-{}'.format(container['id']), verbose=self.verbose):
+            update_container_limits_arch(uri, container, changed, verbose=self.verbose)
 
-    project = {
-        'id': project_id,
-        'name': project_name,
-    }
+        return container
 
-    projects[project_id] = project
-    save_consensus_config(config, verbose=verbose)
-    print('{} {}'.format(project_id, project_name))
+    def _container_action(self, container_id, action):
+        container = self.container(container_id)
 
+        def run():
+            uri = self._container_uri(container)
 
-def project_remove(remote_uri, project_id, verbose=False):
-    if not remote_uri:
-        local_config = load_local_config()
-        remote_uri = local_config['main']['remote_address']
+            with lease(uri, 'container-{}'.format(container_id), verbose=self.verbose):
+                action(uri, container, verbose=self.verbose)
 
-    remote_user, remote_host, remote_port = parse_uri(remote_uri)
-    config = load_consensus_config(remote_uri, verbose=verbose)
-    projects = config['projects']
+            return container
 
-    # make sure user wants to delete project
-    answer = input('Are you sure you want to remove project? [y/n]: ')
+        return self.executor.submit(run)
 
-    if answer != 'y':
-        sys.exit(-1)
+    def bootstrap_container(self, container_id, start=False):
+        return self.executor.submit(self._bootstrap, self.container(container_id), start)
 
-    if project_id not in projects:
-        msg = 'Project with id {} does not exists'.format(project_id)
-        print(msg, file=sys.stderr)
-        sys.exit(1)
+    def destroy_container(self, container_id):
+        return self.executor.submit(self._destroy, self.container(container_id))
 
-    del projects[project_id]
-    save_consensus_config(config, verbose=verbose)
-    print('{}'.format(project_id))
+    def start_container(self, container_id):
+        return self._container_action(container_id, start_container_arch)
+
+    def stop_container(self, container_id):
+        return self._container_action(container_id, stop_container_arch)
+
+    def restart_container(self, container_id):
+        return self._container_action(container_id, restart_container_arch)
+
+    def container_status(self, machine_id):
+        # running containers of machine with their addresses
+        return self.executor.submit(get_machine_running_containers, self._uri(machine_id), self.verbose)
+
+    def machine_stats(self, machine_id):
+        return self.executor.submit(get_machine_stats, self._uri(machine_id), self.verbose)
 
 
 #
-# container
+# batch
 #
-def container_list(remote_uri, project_id, verbose=False):
-    if not remote_uri:
-        local_config = load_local_config()
-        remote_uri = local_config['main']['remote_address']
+def parse_batch_line(line, parser, refs):
+    # CLI syntax or JSON object, both into op name and argument dict
+    line = line.strip()
 
-    if not project_id:
-        local_config = load_local_config()
-        project_id = local_config['main']['project_id']
+    if not line or line.startswith('#'):
+        return None, None
 
-    remote_config = load_consensus_config(remote_uri, verbose=verbose)
-    container_items = remote_config.get('containers', {}).items()
-    container_items = [
-        n
-        for n in container_items
-        if n[1]['project_id'].endswith(project_id)
-    ]
-    container_items = sorted(
-        container_items,
-        key=lambda n: (n[1]['name'], n[1]['host']),
-    )
-    
-    print('{a: <12} {b: <10} {c: <15} {d: <33} {e: <6}'.format(
-        a='CONTAINER_ID',
-        b='NAME',
-        c='ADDRESS',
-        d='PORTS',
-        e='STATUS',
-    ))
+    # $N is id produced by N-th operation of batch
+    def ref(m):
+        n = int(m.group(1))
 
-    for container_id, container in container_items:
-        status = 'x'
-        
-        ports_str = ','.join(
-            '{}:{}'.format(k, v)
-            for k, v in sorted(
-                list(container['ports'].items()),
-                key=lambda n: n[1],
-            )
-        )
+        if n not in refs:
+            raise ValueError('Operation ${} produced no id'.format(n))
 
-        print('{a: <12} {b: <10} {c: <15} {d: <33} {e: <6}'.format(
-            a=container_id,
-            b=container['name'][:10],
-            c=container['host'],
-            d=ports_str[:33],
-            e=status,
-        ))
+        return refs[n]
 
+    line = re.sub(r'\$(\d+)', ref, line)
 
-def container_add(remote_uri, project_id, name, ports_str, distro, image_id, image, machine_id=None, start=False, verbose=False):
-    if not remote_uri:
-        local_config = load_local_config()
-        remote_uri = local_config['main']['remote_address']
-    
-    if not project_id:
-        local_config = load_local_config()
-        project_id = local_config['main']['project_id']
+    if line.startswith('{'):
+        params = json.loads(line)
 
-    remote_user, remote_host, remote_port = parse_uri(remote_uri)
-    config = load_consensus_config(remote_uri, verbose=verbose)
-    containers = config['containers']
-    machines = config['machines']
+        if not isinstance(params, dict) or 'op' not in params:
+            raise ValueError('JSON operation needs "op"')
 
-    # parse ports
-    requested_ports = parse_ports(ports_str)
+        return params.pop('op'), params
 
-    # check if project id exists
-    projects = config['projects']
-    
-    if project_id not in projects:
-        msg = 'Project with id {} does not exists'.format(project_id)
-        print(msg, file=sys.stderr)
-        sys.exit(1)
+    argv = shlex.split(line)
 
-    # generate random ID
-    m = hashlib.sha1()
-    m.update('{}'.format(random.randint(0, 2 ** 128)).encode())
-    container_id = m.hexdigest()[-12:]
+    if argv[:1] == ['nspawn']:
+        argv = argv[1:]
 
-    # init container
-    container = {
-        'id': container_id,
-        'project_id': project_id,
-        'name': name,
-        'distro': distro,
-        'image_id': image_id,
-        'image': image,
-    }
+    if argv == ['commit']:
+        return 'commit', {}
 
-    # find suitable machine where to host container
-    if machine_id:
-        machine = machines[machine_id]
+    try:
+        params = vars(parser.parse_args(argv))
+    except SystemExit:
+        raise ValueError('Invalid command: {}'.format(line))
+
+    op = [params.pop('subparser') or '']
+    op.append(params.pop('{}_subparser'.format(op[0]), None) or '')
+    return ' '.join(op).strip(), params
+
+
+def queue_batch_op(cluster, op, params):
+    # queue mutation, returns produced ids, remote actions run after commit
+    # and whether commit itself returns a follow-up future for it
+    params = {k: v for k, v in params.items() if v is not None}
+
+    if op == 'project add':
+        port_ranges = parse_port_ranges(params['port_range']) if params.get('port_range') else None
+        placement = {key: params.get(key) for key in PLACEMENT_KEYS}
+        return [cluster.add_project(params['name'], port_ranges, placement)], [], False
+    elif op == 'project remove':
+        cluster.remove_project(params['id'])
+        return [params['id']], [], False
+    elif op == 'machine add':
+        if params.get('provision'):
+            raise ValueError('Provision is not supported in batch, use machine provision')
+
+        port_ranges = parse_port_ranges(params['port_range']) if params.get('port_range') else None
+        return [cluster.add_machine(params['address'], port_ranges, parse_labels(params.get('label')), params.get('weight'))], [], False
+    elif op == 'machine remove':
+        cluster.remove_machine(params['id'])
+        return [params['id']], [], False
+    elif op == 'container add':
+        if params.get('image_id') or params.get('image'):
+            raise ValueError('Image based containers are not supported in batch')
+
+        project_id = params.get('project_id') or load_local_config()['main']['project_id']
+        count = params.get('count', 1)
+        network = parse_network(params.get('network', 'veth'), params.get('interface'), params.get('address'), params.get('gateway'))
+        placement = {key: params.get(key) for key in PLACEMENT_KEYS}
+        container_ids = []
+
+        for i in range(count):
+            container_ids.append(cluster.add_container(
+                project_id,
+                params['name'] if count == 1 else '{}-{}'.format(params['name'], i + 1),
+                ports=params.get('ports', '22'),
+                distro=params.get('distro', 'arch'),
+                machine_id=params.get('machine_id'),
+                limits={key: params.get(key) for key, property_, pattern in RESOURCE_LIMITS},
+                network=network,
+                storage=params.get('storage', 'copy'),
+                pinned=params.get('pin', False),
+                group=params.get('group'),
+                placement=placement,
+                bootstrap=False,
+            ))
+
+        return container_ids, [(n, 'bootstrap', params.get('start', False)) for n in container_ids], False
+    elif op == 'container remove':
+        if params.get('force'):
+            raise ValueError('Forced remove is not supported in batch')
+
+        cluster.remove_container(params['id'])
+        return [params['id']], [], True
+    elif op == 'container update':
+        pinned = {'yes': True, 'no': False}.get(params.get('pinned'), params.get('pinned'))
+        limits = {key: params.get(key) for key, property_, pattern in RESOURCE_LIMITS}
+        cluster.update_container(params['id'], limits, pinned)
+        return [params['id']], [], bool(parse_limits(limits))
+    elif op in ('container start', 'container stop', 'container restart'):
+        if params.get('rolling'):
+            raise ValueError('Rolling restart is not supported in batch')
+
+        return [params['id']], [(params['id'], op.split()[1], None)], False
     else:
-        machine = find_available_machine(config, container)
-    
-    container['machine_id'] = machine['id']
-    container['host'] = machine['host']
+        raise ValueError('Operation {!r} is not supported in batch'.format(op))
 
-    # find available ports
-    ports = find_available_machine_ports(config, machine, requested_ports)
-    container['ports'] = ports
 
-    # create systemd-nspawn container on machine
-    machine_uri = '{user}@{host}:{port}'.format(**machine)
-    containers[container_id] = container
+def _batch_chain(cluster, steps):
+    # one container's remote steps in order, containers run side by side
+    for entry, action, arg in steps:
+        try:
+            if action == 'bootstrap':
+                future = cluster.bootstrap_container(entry['container_id'], arg)
+            else:
+                future = getattr(cluster, '{}_container'.format(action))(entry['container_id'])
 
-    # save not yet bootstrapped container
-    save_consensus_config(config, verbose=verbose)
+            future.result()
+        except (IOError, paramiko.SSHException, NotImplementedError, ValueError) as e:
+            entry['ok'] = False
+            entry['error'] = '{}: {}'.format(action, e)
 
-    # bootstrap distro
-    if container['distro'] == 'arch':
-        if container['image_id']:
-            raise NotImplementedError
-        elif container['image']:
-            raise NotImplementedError
-        else:
-            create_container_arch_install(machine_uri, container, start, verbose)
-    else:
-        raise NotImplementedError
+            # later steps of same container make no sense now
+            for _entry, _action, _arg in steps:
+                if _entry is not entry and _entry['ok'] and 'error' not in _entry:
+                    _entry['ok'] = False
+                    _entry['error'] = 'skipped, earlier step of container failed'
 
-    # output on success
-    print('{} {} {}'.format(
-        container_id,
-        machine['host'],
-        ','.join('{}:{}'.format(k, v) for k, v in ports.items())
-    ))
+            return
 
 
-def container_remove(remote_uri, project_id, container_id, force=False, verbose=False):
-    if not remote_uri:
-        local_config = load_local_config()
-        remote_uri = local_config['main']['remote_address']
+def run_batch_segment(cluster, segment, workers):
+    # one consensus save for all queued mutations, then remote steps
+    if any(not entry['ok'] for entry, actions in segment):
+        cluster.rollback()
 
-    if not project_id:
-        local_config = load_local_config()
-        project_id = local_config['main']['project_id']
+        for entry, actions in segment:
+            if entry['ok']:
+                entry['ok'] = False
+                entry['error'] = 'skipped, segment not committed'
 
-    remote_user, remote_host, remote_port = parse_uri(remote_uri)
-    config = load_consensus_config(remote_uri, verbose=verbose)
-    containers = config['containers']
-    machines = config['machines']
+        return False
 
-    # make sure user wants to delete container
-    answer = input('Are you sure you want to remove container? [y/n]: ')
+    try:
+        futures = cluster.commit()
+    except (IOError, ValueError) as e:
+        cluster.rollback()
 
-    if answer != 'y':
-        sys.exit(-1)
+        for entry, actions in segment:
+            entry['ok'] = False
+            entry['error'] = 'commit: {}'.format(e)
 
-    if force:
-        # try to remove container on each machine
-        for machine_id, machine in machines.items():
-            container = {
-                'id': container_id,
-                'project_id': project_id,
-                'machine_id': machine_id,
-            }
+        return False
 
-            uri = '{user}@{host}:{port}'.format(**machine)
-            destroy_container_arch(uri, container, verbose)
+    # destroys and limit updates follow commit in order of their operations
+    followups = [entry for entry, actions in segment if entry.pop('followup', False)]
 
-        del containers[container_id]
-        save_consensus_config(config, verbose=verbose)
-        print('{}'.format(container_id))
-        return
+    for entry, future in zip(followups, futures):
+        try:
+            future.result()
+        except (IOError, paramiko.SSHException, NotImplementedError) as e:
+            entry['ok'] = False
+            entry['error'] = str(e)
 
-    # check if project id exists
-    projects = config['projects']
+    for entry, actions in segment:
+        if entry['ids'] and entry['op'] in ('container add', 'project add', 'machine add'):
+            try:
+                getter = getattr(cluster, entry['op'].split()[0])
+                entry['records'] = [getter(n) for n in entry['ids']]
+            except ClusterError:
+                pass
 
-    if project_id not in projects:
-        msg = 'Project with id {} does not exists'.format(project_id)
-        print(msg, file=sys.stderr)
-        sys.exit(-1)
+    chains = {}
 
-    project = projects[project_id]
+    for entry, actions in segment:
+        for container_id, action, arg in actions:
+            chains.setdefault(container_id, []).append((dict(entry, container_id=container_id), action, arg))
 
-    if container_id not in containers:
-        msg = 'Container with id {} does not exists'.format(container_id)
-        print(msg, file=sys.stderr)
-        sys.exit(-1)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        done = {executor.submit(_batch_chain, cluster, steps): steps for steps in chains.values()}
+        concurrent.futures.wait(done)
 
-    container = containers[container_id]
+    # copies carried per container state, fold back into operations
+    for steps in chains.values():
+        for step_entry, action, arg in steps:
+            for entry, actions in segment:
+                if entry['n'] == step_entry['n'] and not step_entry['ok']:
+                    entry['ok'] = False
+                    entry['error'] = step_entry['error']
 
-    # machine
-    machine_id = container['machine_id']
-    machine = machines[machine_id]
+    return all(entry['ok'] for entry, actions in segment)
 
-    # create systemd-nspawn container on machine
-    uri = '{user}@{host}:{port}'.format(**machine)
 
-    if container['distro'] == 'arch':
-        if container['image_id']:
-            raise NotImplementedError
-        elif container['image']:
-            raise NotImplementedError
-        else:
-            try:
-                destroy_container_arch(uri, container, verbose)
-            except Exception as e:
-                msg = e
-                print(msg, file=sys.stderr)
+def batch(remote_uri, filename=None, workers=16, keep_going=False, verbose=False):
+    try:
+        cluster = Cluster(remote_uri, workers=workers, verbose=verbose)
+    except ClusterError as e:
+        print('ERROR: {}'.format(e), file=sys.stderr)
+        sys.exit(-1)
 
-                # make sure user wants to delete container
-                answer = input('There was an error, are you sure you want to remove container? [y/n]: ')
+    parser = build_parser()
+    f = sys.stdin if not filename or filename == '-' else open(filename, 'r')
+    refs = {}
+    segment = []
+    ok = True
 
-                if answer != 'y':
-                    sys.exit(-1)
-    else:
-        raise NotImplementedError
-    
-    del containers[container_id]
-    save_consensus_config(config, verbose=verbose)
-    print('{}'.format(container_id))
+    def flush():
+        committed = run_batch_segment(cluster, segment, workers)
 
+        for entry, actions in segment:
+            print(json.dumps({k: v for k, v in entry.items() if k != 'followup' and (k != 'ids' or v)}), flush=True)
 
-def container_start(remote_uri, project_id, container_id, verbose=False):
-    if not remote_uri:
-        local_config = load_local_config()
-        remote_uri = local_config['main']['remote_address']
+        del segment[:]
+        return committed
 
-    if not project_id:
-        local_config = load_local_config()
-        project_id = local_config['main']['project_id']
+    try:
+        for n, line in enumerate(f, 1):
+            entry = {'n': n, 'op': None, 'ok': True, 'ids': []}
 
-    config = load_consensus_config(remote_uri, verbose=verbose)
-    containers = config['containers']
-    machines = config['machines']
-    container = containers[container_id]
-    machine_id = container['machine_id']
-    machine = machines[machine_id]
-    machine_uri = '{user}@{host}:{port}'.format(**machine)
+            try:
+                op, params = parse_batch_line(line, parser, refs)
 
-    if container['distro'] == 'arch':
-        start_container_arch(machine_uri, container, verbose=verbose)
-    else:
-        raise NotImplementedError
+                if op is None:
+                    continue
 
+                entry['op'] = op
 
-def container_stop(remote_uri, project_id, container_id, verbose=False):
-    if not remote_uri:
-        local_config = load_local_config()
-        remote_uri = local_config['main']['remote_address']
+                if op == 'commit':
+                    ok = flush() and ok
 
-    if not project_id:
-        local_config = load_local_config()
-        project_id = local_config['main']['project_id']
+                    if not ok and not keep_going:
+                        break
 
-    config = load_consensus_config(remote_uri, verbose=verbose)
-    containers = config['containers']
-    machines = config['machines']
-    container = containers[container_id]
-    machine_id = container['machine_id']
-    machine = machines[machine_id]
-    machine_uri = '{user}@{host}:{port}'.format(**machine)
-    
-    if container['distro'] == 'arch':
-        stop_container_arch(machine_uri, container, verbose=verbose)
-    else:
-        raise NotImplementedError
+                    continue
 
+                ids, actions, entry['followup'] = queue_batch_op(cluster, op, params)
+                entry['ids'] = ids
+                refs[n] = ids[0] if ids else None
+                segment.append((entry, actions))
+            except (ClusterError, ValueError, KeyError) as e:
+                entry['ok'] = False
+                entry['error'] = str(e) or type(e).__name__
+                segment.append((entry, []))
+        else:
+            if segment:
+                ok = flush() and ok
+    finally:
+        if f is not sys.stdin:
+            f.close()
 
-def container_restart(remote_uri, project_id, container_id, verbose=False):
-    if not remote_uri:
-        local_config = load_local_config()
-        remote_uri = local_config['main']['remote_address']
+        cluster.close()
 
-    if not project_id:
-        local_config = load_local_config()
-        project_id = local_config['main']['project_id']
+    if not ok:
+        sys.exit(1)
 
-    config = load_consensus_config(remote_uri, verbose=verbose)
-    containers = config['containers']
-    machines = config['machines']
-    container = containers[container_id]
-    machine_id = container['machine_id']
-    machine = machines[machine_id]
-    machine_uri = '{user}@{host}:{port}'.format(**machine)
-    
-    if container['distro'] == 'arch':
-        restart_container_arch(machine_uri, container, verbose=verbose)
-    else:
-        raise NotImplementedError
 
+def add_limit_arguments(parser):
+    parser.add_argument('--cpu-quota', help='CPU time share, e.g. 150%% for 1.5 CPUs')
+    parser.add_argument('--cpu-weight', help='CPU weight 1-10000 or idle')
+    parser.add_argument('--memory-max', help='Hard memory limit, e.g. 2G')
+    parser.add_argument('--memory-high', help='Memory throttling threshold, e.g. 1536M')
+    parser.add_argument('--io-weight', help='IO weight 1-10000')
+    parser.add_argument('--io-read-bandwidth', action='append', help='"DEVICE RATE" read cap, repeatable')
+    parser.add_argument('--io-write-bandwidth', action='append', help='"DEVICE RATE" write cap, repeatable')
+    parser.add_argument('--tasks-max', help='Max number of tasks')
+    parser.add_argument('--cpus', help='Pin to CPUs, e.g. 0-3,6')
+    parser.add_argument('--numa-nodes', help='Pin memory to NUMA nodes, e.g. 0')
 
-def container_migrate(remote_uri, project_id, container_id, verbose=False):
-    if not remote_uri:
-        local_config = load_local_config()
-        remote_uri = local_config['main']['remote_address']
 
-    if not project_id:
-        local_config = load_local_config()
-        project_id = local_config['main']['project_id']
+def limits_from_args(args):
+    return {key: getattr(args, key) for key, property_, pattern in RESOURCE_LIMITS}
 
-    config = load_consensus_config(remote_uri, verbose=verbose)
-    containers = config['containers']
-    machines = config['machines']
-    container = containers[container_id]
-    machine_id = container['machine_id']
-    machine = machines[machine_id]
-    machine_uri = '{user}@{host}:{port}'.format(**machine)
-    
-    # FIXME: implement
 
-    raise NotImplementedError
+def add_placement_arguments(parser):
+    parser.add_argument('--max-per-machine', type=int, help='Max replicas on one machine')
+    parser.add_argument('--spread', action='append', help='Spread replicas over machine LABEL[:MAX_SKEW], repeatable')
+    parser.add_argument('--anti-affinity', action='append', help='Never share machine with GROUP, repeatable')
+    parser.add_argument('--affinity', action='append', help='Keep on machine with GROUP, repeatable')
+    parser.add_argument('--strategy', choices=PLACEMENT_STRATEGIES, help='Least loaded machine or rendezvous hash of container ID')
+    parser.add_argument('--max-load', type=float, help='With hash, machine takes at most FACTOR times its weighted share')
 
 
-if __name__ == '__main__':
+def placement_from_args(args):
+    return {key: getattr(args, key) for key in PLACEMENT_KEYS}
+
+
+def build_parser():
     parser = argparse.ArgumentParser(description='systemd-nspawn deployment')
     parser_subparsers = parser.add_subparsers(dest='subparser', metavar='main')
     parser.add_argument('--remote-address', '-r', help='Remote address')
@@ -1300,10 +8717,58 @@ if __name__ == '__main__':
     
     # machine list
     machine_list_parser = machine_subparsers.add_parser('list', help='List machines')
+    machine_list_parser.add_argument('--stats', '-s', action='store_true', help='Show last collected stats')
+
+    # machine stats
+    machine_stats_parser = machine_subparsers.add_parser('stats', help='Collect and show machine stats')
+    machine_stats_parser.add_argument('--id', '-I', help='Machine ID')
+    machine_stats_parser.add_argument('--count', '-c', type=int, default=1, help='Number of samples')
+    machine_stats_parser.add_argument('--interval', '-i', type=float, default=5.0, help='Seconds between samples')
+    machine_stats_parser.add_argument('--window', '-w', type=float, default=STATS_WINDOW, help='Seconds of history for rates and percentiles')
+    machine_stats_parser.add_argument('--format', '-f', default='table', choices=['table', 'json'], help='Output format')
+    machine_stats_parser.add_argument('--verbose', '-v', action='store_true', help='Verbose')
 
     # machine add
     machine_add_parser = machine_subparsers.add_parser('add', help='Add machine')
     machine_add_parser.add_argument('--address', '-a', help='[USER="root"@]HOST[:PORT=22]')
+    machine_add_parser.add_argument('--port-range', '-p', help='Host ports for containers START-END[,START-END,...]')
+    machine_add_parser.add_argument('--label', '-l', action='append', help='KEY=VALUE like rack=r1 or zone=a, repeatable')
+    machine_add_parser.add_argument('--weight', '-w', type=float, help='Share of hash placed containers, default 1')
+    machine_add_parser.add_argument('--provision', action='store_true', help='Prepare host after adding')
+    machine_add_parser.add_argument('--admin-user', help='User for host prep, default machine user')
+    machine_add_parser.add_argument('--verbose', '-v', action='store_true', help='Verbose')
+
+    # machine provision
+    machine_provision_parser = machine_subparsers.add_parser('provision', help='Prepare hosts, skips what is already done')
+    machine_provision_parser.add_argument('--id', '-I', help='Machine ID')
+    machine_provision_parser.add_argument('--all', '-A', action='store_true', help='All machines')
+    machine_provision_parser.add_argument('--admin-user', help='User for host prep, default machine user')
+    machine_provision_parser.add_argument('--parallel', '-c', type=int, default=32, help='Concurrent hosts')
+    machine_provision_parser.add_argument('--progress', action='store_true', help='Periodic progress table')
+    machine_provision_parser.add_argument('--recheck', action='store_true', help='Probe all steps, ignore cached completion')
+    machine_provision_parser.add_argument('--verbose', '-v', action='store_true', help='Verbose')
+
+    # machine base
+    machine_base_parser = machine_subparsers.add_parser('base', help='List, upgrade and prune shared base layers')
+    machine_base_parser.add_argument('--id', '-I', help='Machine ID')
+    machine_base_parser.add_argument('--upgrade', '-u', action='store_true', help='Create upgraded base and make it current')
+    machine_base_parser.add_argument('--prune', action='store_true', help='Remove bases no container uses')
+    machine_base_parser.add_argument('--verbose', '-v', action='store_true', help='Verbose')
+
+    # machine weight
+    machine_weight_parser = machine_subparsers.add_parser('weight', help='Set weight for hash placement')
+    machine_weight_parser.add_argument('--id', '-I', help='Machine ID, default all')
+    machine_weight_parser.add_argument('--weight', '-w', type=float, help='Weight, default CPUs from collected stats')
+    machine_weight_parser.add_argument('--verbose', '-v', action='store_true', help='Verbose')
+
+    # machine drain
+    machine_drain_parser = machine_subparsers.add_parser('drain', help='Move all containers off machine')
+    machine_drain_parser.add_argument('--id', '-I', help='Machine ID')
+    machine_drain_parser.add_argument('--dry-run', '-n', action='store_true', help='Only show moves')
+    machine_drain_parser.add_argument('--parallel', '-c', type=int, default=2, help='Concurrent moves')
+    machine_drain_parser.add_argument('--direct', action='store_true', help='Stream rootfs machine to machine over ssh')
+    machine_drain_parser.add_argument('--cancel', action='store_true', help='Accept new containers again')
+    machine_drain_parser.add_argument('--verbose', '-v', action='store_true', help='Verbose')
 
     # machine remove
     machine_remove_parser = machine_subparsers.add_parser('remove', help='Remove machine')
@@ -1320,11 +8785,59 @@ if __name__ == '__main__':
     project_add_parser = project_subparsers.add_parser('add', help='Add project')
     project_add_parser.add_argument('--id', '-I', default=None, help='Project ID')
     project_add_parser.add_argument('--name', '-n', help='Name')
+    project_add_parser.add_argument('--port-range', '-p', help='Reserved host ports START-END[,START-END,...]')
+    add_placement_arguments(project_add_parser)
 
     # project remove
     project_remove_parser = project_subparsers.add_parser('remove', help='Remove project')
     project_remove_parser.add_argument('--id', '-I', help='Project ID')
 
+    # apply
+    apply_parser = parser_subparsers.add_parser('apply', help='Reconcile cluster with desired state')
+    apply_parser.add_argument('--file', '-f', required=True, help='Desired state JSON')
+    apply_parser.add_argument('--dry-run', '-n', action='store_true', help='Only show plan')
+    apply_parser.add_argument('--per-machine', '-c', type=int, default=2, help='Concurrent actions per machine')
+    apply_parser.add_argument('--yes', '-y', action='store_true', help='Do not ask before removing containers')
+    apply_parser.add_argument('--verbose', '-v', action='store_true', help='Verbose')
+
+    # watch
+    watch_parser = parser_subparsers.add_parser('watch', help='Stream container state changes of cluster')
+    watch_parser.add_argument('--project-id', '-P', help='Project ID')
+    watch_parser.add_argument('--machine-id', '-M', help='Machine ID')
+    watch_parser.add_argument('--name', '-n', help='Name glob pattern')
+    watch_parser.add_argument('--format', '-f', default='text', choices=['text', 'json'], help='Output format')
+    watch_parser.add_argument('--reset', action='store_true', help='Start from now, forget saved cursors')
+    watch_parser.add_argument('--verbose', '-v', action='store_true', help='Verbose')
+
+    # top
+    top_parser = parser_subparsers.add_parser('top', help='Live resource usage of containers across cluster')
+    top_parser.add_argument('--project-id', '-P', help='Project ID, default all')
+    top_parser.add_argument('--machine-id', '-M', help='Machine ID')
+    top_parser.add_argument('--name', '-n', help='Name glob pattern')
+    top_parser.add_argument('--interval', '-i', type=float, default=TOP_INTERVAL, help='Seconds between samples')
+    top_parser.add_argument('--sort', '-s', default='cpu', choices=sorted(TOP_SORT) + ['name'], help='Sort by')
+    top_parser.add_argument('--limit', '-l', type=int, help='Show at most N containers')
+    top_parser.add_argument('--once', action='store_true', help='Print one sample and exit')
+    top_parser.add_argument('--format', '-f', default='table', choices=['table', 'json'], help='Output format')
+    top_parser.add_argument('--verbose', '-v', action='store_true', help='Verbose')
+
+    # logs
+    logs_parser = parser_subparsers.add_parser('logs', help='Logs of container, project or machine')
+    logs_parser.add_argument('--project-id', '-P', help='Project ID')
+    logs_parser.add_argument('--id', '-I', help='Container ID')
+    logs_parser.add_argument('--machine-id', '-M', help='Machine ID, alone means all its containers')
+    logs_parser.add_argument('--name', '-n', help='Name glob pattern')
+    logs_parser.add_argument('--since', '-S', help='Entries since, journalctl time')
+    logs_parser.add_argument('--until', '-U', help='Entries until, journalctl time')
+    logs_parser.add_argument('--priority', '-p', help='Priority or range, like err or warning..emerg')
+    logs_parser.add_argument('--unit', '-u', action='append', help='Unit inside container, repeatable')
+    logs_parser.add_argument('--grep', '-g', help='Message pattern')
+    logs_parser.add_argument('--lines', '-l', type=int, help='Last entries per container, default {}'.format(LOG_LINES))
+    logs_parser.add_argument('--since-last', action='store_true', help='Only entries after previous logs run')
+    logs_parser.add_argument('--follow', '-F', action='store_true', help='Stream new entries')
+    logs_parser.add_argument('--format', '-f', default='text', choices=['text', 'json'], help='Output format')
+    logs_parser.add_argument('--verbose', '-v', action='store_true', help='Verbose')
+
     # container 
     container_parser = parser_subparsers.add_parser('container')
     container_subparsers = container_parser.add_subparsers(dest='container_subparser', metavar='container')
@@ -1332,6 +8845,14 @@ if __name__ == '__main__':
 
     # container list
     container_list_parser = container_subparsers.add_parser('list', help='List of containers at remote host')
+    container_list_parser.add_argument('--machine-id', '-M', help='Machine ID')
+    container_list_parser.add_argument('--name', '-n', help='Name glob pattern')
+    container_list_parser.add_argument('--status', '-s', choices=['running', 'stopped'], help='Status')
+    container_list_parser.add_argument('--limit', '-l', type=int, help='Max number of containers')
+    container_list_parser.add_argument('--offset', '-o', type=int, default=0, help='Skip number of containers')
+    container_list_parser.add_argument('--cursor', '-c', help='Continue after cursor of previous page')
+    container_list_parser.add_argument('--format', '-f', default='table', choices=['table', 'json', 'jsonl'], help='Output format')
+    container_list_parser.add_argument('--verbose', '-v', action='store_true', help='Verbose')
 
     # container add
     container_add_parser = container_subparsers.add_parser('add', help='Add container')
@@ -1342,6 +8863,17 @@ if __name__ == '__main__':
     container_add_parser.add_argument('--image', '-i', help='[UNSUPPORTED] Image name')
     container_add_parser.add_argument('--machine-id', '-M', help='Machine ID where to create container')
     container_add_parser.add_argument('--start', '-s', action='store_true', help='Start container')
+    container_add_parser.add_argument('--count', '-c', type=int, default=1, help='Number of containers, named NAME-1..NAME-N')
+    container_add_parser.add_argument('--progress', action='store_true', help='Show periodic progress of bootstraps')
+    container_add_parser.add_argument('--network', '-N', default='veth', choices=NETWORK_MODES, help='Network mode, only veth forwards host ports')
+    container_add_parser.add_argument('--interface', help='Host bridge for bridge mode, parent interface for macvlan and ipvlan')
+    container_add_parser.add_argument('--address', help='Static ADDRESS/PREFIX for bridge, macvlan and ipvlan, default DHCP')
+    container_add_parser.add_argument('--gateway', help='Gateway for static address')
+    container_add_parser.add_argument('--pin', action='store_true', help='Keep container on its machine during rebalance')
+    container_add_parser.add_argument('--storage', '-S', default='copy', choices=['copy', 'overlay'], help='Full rootfs copy or layer over shared base, overlay containers are not moved between machines')
+    container_add_parser.add_argument('--group', '-G', help='Replica group for spread and affinity, default project')
+    add_placement_arguments(container_add_parser)
+    add_limit_arguments(container_add_parser)
     container_add_parser.add_argument('--verbose', '-v', action='store_true', help='Verbose')
 
     # container remove
@@ -1360,11 +8892,131 @@ if __name__ == '__main__':
     container_stop_parser.add_argument('--id', '-I', help='Container ID')
     container_stop_parser.add_argument('--verbose', '-v', action='store_true', help='Verbose')
 
+    # container update
+    container_update_parser = container_subparsers.add_parser('update', help='Update container resource limits, "none" clears')
+    container_update_parser.add_argument('--id', '-I', help='Container ID')
+    container_update_parser.add_argument('--pinned', choices=['yes', 'no'], help='Keep container on its machine during rebalance')
+    add_limit_arguments(container_update_parser)
+    container_update_parser.add_argument('--verbose', '-v', action='store_true', help='Verbose')
+
+    # container rebase
+    container_rebase_parser = container_subparsers.add_parser('rebase', help='Move overlay container onto current base')
+    container_rebase_parser.add_argument('--id', '-I', help='Container ID')
+    container_rebase_parser.add_argument('--verbose', '-v', action='store_true', help='Verbose')
+
+    # container usage
+    container_usage_parser = container_subparsers.add_parser('usage', help='Disk usage of containers')
+    container_usage_parser.add_argument('--machine-id', '-M', help='Machine ID')
+    container_usage_parser.add_argument('--verbose', '-v', action='store_true', help='Verbose')
+
     # container restart
     container_restart_parser = container_subparsers.add_parser('restart', help='Restart container')
     container_restart_parser.add_argument('--id', '-I', help='Container ID')
+    container_restart_parser.add_argument('--project', '-p', dest='restart_project_id', help='Project ID')
+    container_restart_parser.add_argument('--rolling', action='store_true', help='Restart all containers of project one window at a time')
+    container_restart_parser.add_argument('--machine-id', '-M', help='Machine ID')
+    container_restart_parser.add_argument('--name', '-n', help='Name glob pattern')
+    container_restart_parser.add_argument('--max-unavailable', '-u', default='1', help='Containers restarted at once, N or N%%')
+    container_restart_parser.add_argument('--gate', '-g', default='unit', choices=['unit', 'tcp', 'exec'], help='Health gate before moving on')
+    container_restart_parser.add_argument('--port', type=int, help='Container port for tcp gate, reached via forwarded host port')
+    container_restart_parser.add_argument('--command', help='Shell command for exec gate')
+    container_restart_parser.add_argument('--timeout', '-t', type=float, default=120.0, help='Seconds to wait for health gate')
+    container_restart_parser.add_argument('--max-failures', type=int, default=1, help='Abort after this many failed containers')
+    container_restart_parser.add_argument('--rollback', action='store_true', help='Restore previous unit of restarted containers on abort')
     container_restart_parser.add_argument('--verbose', '-v', action='store_true', help='Verbose')
 
+    # container migrate
+    container_migrate_parser = container_subparsers.add_parser('migrate', help='Move container to another machine')
+    container_migrate_parser.add_argument('--id', '-I', help='Container ID')
+    container_migrate_parser.add_argument('--machine-id', '-M', help='Target machine ID, default least loaded')
+    container_migrate_parser.add_argument('--direct', action='store_true', help='Stream rootfs machine to machine over ssh')
+    container_migrate_parser.add_argument('--verbose', '-v', action='store_true', help='Verbose')
+
+    # container backup
+    container_backup_parser = container_subparsers.add_parser('backup', help='Incremental backup to backup machine')
+    container_backup_parser.add_argument('--id', '-I', help='Container ID, default all of project')
+    container_backup_parser.add_argument('--machine-id', '-M', help='Machine ID')
+    container_backup_parser.add_argument('--name', '-n', help='Name glob pattern')
+    container_backup_parser.add_argument('--to', help='Backup machine ID, remembered for later runs')
+    container_backup_parser.add_argument('--parallel', '-c', type=int, default=4, help='Concurrent backups')
+    container_backup_parser.add_argument('--limit', '-l', type=int, help='Bandwidth limit per backup, KiB/s')
+    container_backup_parser.add_argument('--keep', '-k', type=int, default=BACKUP_KEEP, help='Backups kept per container, 0 keeps all')
+    container_backup_parser.add_argument('--list', action='store_true', help='List backups')
+    container_backup_parser.add_argument('--verbose', '-v', action='store_true', help='Verbose')
+
+    # container restore
+    container_restore_parser = container_subparsers.add_parser('restore', help='Restore container from backup on any machine')
+    container_restore_parser.add_argument('--id', '-I', required=True, help='Container ID')
+    container_restore_parser.add_argument('--backup', '-b', help='Backup name, default newest')
+    container_restore_parser.add_argument('--machine-id', '-M', help='Target machine ID, default by placement')
+    container_restore_parser.add_argument('--name', '-n', help='Name, default original')
+    container_restore_parser.add_argument('--start', '-s', action='store_true', help='Start after restore')
+    container_restore_parser.add_argument('--limit', '-l', type=int, help='Bandwidth limit, KiB/s')
+    container_restore_parser.add_argument('--verbose', '-v', action='store_true', help='Verbose')
+
+    # container exec
+    container_exec_parser = container_subparsers.add_parser('exec', help='Run command in all containers of project')
+    container_exec_parser.add_argument('--project', '-p', dest='exec_project_id', help='Project ID')
+    container_exec_parser.add_argument('--machine-id', '-M', help='Machine ID')
+    container_exec_parser.add_argument('--name', '-n', help='Name glob pattern')
+    container_exec_parser.add_argument('--method', '-m', default='systemd-run', choices=['systemd-run', 'machinectl'], help='How to enter container')
+    container_exec_parser.add_argument('--per-machine', '-c', type=int, default=8, help='Concurrent channels per machine')
+    container_exec_parser.add_argument('--timeout', '-t', type=float, help='Per container timeout in seconds')
+    container_exec_parser.add_argument('--verbose', '-v', action='store_true', help='Verbose')
+    container_exec_parser.add_argument('command', nargs=argparse.REMAINDER, help='-- COMMAND [ARG...]')
+
+    # cluster
+    cluster_parser = parser_subparsers.add_parser('cluster')
+    cluster_subparsers = cluster_parser.add_subparsers(dest='cluster_subparser', metavar='cluster')
+
+    # cluster export
+    cluster_export_parser = cluster_subparsers.add_parser('export', help='Export merged cluster config')
+    cluster_export_parser.add_argument('--format', '-f', default='json', choices=['json', 'v2'], help='Output format')
+    cluster_export_parser.add_argument('--output', '-o', help='Output file, default stdout')
+    cluster_export_parser.add_argument('--verbose', '-v', action='store_true', help='Verbose')
+
+    # cluster rebalance
+    cluster_rebalance_parser = cluster_subparsers.add_parser('rebalance', help='Even out containers across machines')
+    cluster_rebalance_parser.add_argument('--metric', '-m', default='count', choices=['count', 'memory', 'hash'], help='Balance container count, collected memory usage or move hash placed containers to their machine')
+    cluster_rebalance_parser.add_argument('--tolerance', '-t', type=float, default=0.1, help='Allowed deviation from mean, fraction')
+    cluster_rebalance_parser.add_argument('--dry-run', '-n', action='store_true', help='Only show moves')
+    cluster_rebalance_parser.add_argument('--parallel', '-c', type=int, default=2, help='Concurrent moves')
+    cluster_rebalance_parser.add_argument('--direct', action='store_true', help='Stream rootfs machine to machine over ssh')
+    cluster_rebalance_parser.add_argument('--verbose', '-v', action='store_true', help='Verbose')
+
+    # batch
+    batch_parser = parser_subparsers.add_parser('batch', help='Run many operations in one session, one line each')
+    batch_parser.add_argument('--file', '-f', help='Operations file, default stdin')
+    batch_parser.add_argument('--workers', '-c', type=int, default=16, help='Concurrent remote steps')
+    batch_parser.add_argument('--keep-going', '-k', action='store_true', help='Continue after failed commit')
+    batch_parser.add_argument('--verbose', '-v', action='store_true', help='Verbose')
+
+    # cache
+    cache_parser = parser_subparsers.add_parser('cache', help='Cluster package cache for pacstrap')
+    cache_subparsers = cache_parser.add_subparsers(dest='cache_subparser', metavar='cache')
+
+    # cache enable
+    cache_enable_parser = cache_subparsers.add_parser('enable', help='Serve package cache from machine and point all machines at it')
+    cache_enable_parser.add_argument('--id', '-I', help='Machine ID, default current cache machine')
+    cache_enable_parser.add_argument('--port', '-p', type=int, help='Cache port, default {}'.format(CACHE_PORT))
+    cache_enable_parser.add_argument('--upstream', '-u', help='Mirror http(s)://HOST[/PATH] or file:///DIR, default {}'.format(CACHE_UPSTREAM))
+    cache_enable_parser.add_argument('--verbose', '-v', action='store_true', help='Verbose')
+
+    # cache disable
+    cache_disable_parser = cache_subparsers.add_parser('disable', help='Stop cache, machines use their mirrors again')
+    cache_disable_parser.add_argument('--verbose', '-v', action='store_true', help='Verbose')
+
+    # cache stats
+    cache_stats_parser = cache_subparsers.add_parser('stats', help='Show cache hit rate')
+    cache_stats_parser.add_argument('--format', '-f', default='table', choices=['table', 'json'], help='Output format')
+    cache_stats_parser.add_argument('--verbose', '-v', action='store_true', help='Verbose')
+
+    return parser
+
+
+if __name__ == '__main__':
+    parser = build_parser()
+
     # parse args
     args = parser.parse_args()
     # print(args)
@@ -1373,21 +9025,76 @@ if __name__ == '__main__':
         config_config(args.section, args.property, args.value)
     elif args.subparser == 'machine':
         if args.machine_subparser == 'list':
-            machine_list(args.remote_address)
+            machine_list(args.remote_address, args.stats)
+        elif args.machine_subparser == 'stats':
+            machine_stats(
+                args.remote_address,
+                args.id,
+                args.count,
+                args.interval,
+                args.window,
+                args.format,
+                args.verbose,
+            )
         elif args.machine_subparser == 'add':
-            machine_add(args.remote_address, args.address)
+            machine_add(
+                args.remote_address,
+                args.address,
+                args.port_range,
+                args.provision,
+                args.admin_user,
+                args.label,
+                args.weight,
+                args.verbose,
+            )
+        elif args.machine_subparser == 'provision':
+            machine_provision(
+                args.remote_address,
+                args.id,
+                args.all,
+                args.admin_user,
+                args.parallel,
+                args.progress,
+                args.recheck,
+                args.verbose,
+            )
+        elif args.machine_subparser == 'base':
+            machine_base(args.remote_address, args.id, args.upgrade, args.prune, args.verbose)
+        elif args.machine_subparser == 'weight':
+            machine_set_weight(args.remote_address, args.id, args.weight, args.verbose)
+        elif args.machine_subparser == 'drain':
+            machine_drain(
+                args.remote_address,
+                args.id,
+                args.dry_run,
+                args.parallel,
+                args.direct,
+                args.cancel,
+                args.verbose,
+            )
         elif args.machine_subparser == 'remove':
             machine_remove(args.remote_address, args.id)
     elif args.subparser == 'project':
         if args.project_subparser == 'list':
             project_list(args.remote_address)
         elif args.project_subparser == 'add':
-            project_add(args.remote_address, args.name)
+            project_add(args.remote_address, args.name, args.port_range, placement_from_args(args))
         elif args.project_subparser == 'remove':
             project_remove(args.remote_address, args.id)
     elif args.subparser == 'container':
         if args.container_subparser == 'list':
-            container_list(args.remote_address, args.project_id)
+            container_list(
+                args.remote_address,
+                args.project_id,
+                args.machine_id,
+                args.name,
+                args.status,
+                args.limit,
+                args.offset,
+                args.cursor,
+                args.format,
+                args.verbose,
+            )
         elif args.container_subparser == 'add':
             container_add(
                 args.remote_address,
@@ -1399,6 +9106,17 @@ if __name__ == '__main__':
                 args.image,
                 args.machine_id,
                 args.start,
+                args.count,
+                args.progress,
+                limits_from_args(args),
+                args.network,
+                args.interface,
+                args.address,
+                args.gateway,
+                args.storage,
+                args.pin,
+                args.group,
+                placement_from_args(args),
                 args.verbose,
             )
         elif args.container_subparser == 'remove':
@@ -1413,7 +9131,144 @@ if __name__ == '__main__':
             container_start(args.remote_address, args.project_id, args.id, args.verbose)
         elif args.container_subparser == 'stop':
             container_stop(args.remote_address, args.project_id, args.id, args.verbose)
+        elif args.container_subparser == 'restart' and args.rolling:
+            container_rolling_restart(
+                args.remote_address,
+                args.restart_project_id or args.project_id,
+                args.machine_id,
+                args.name,
+                args.max_unavailable,
+                args.gate,
+                args.port,
+                args.command,
+                args.timeout,
+                args.max_failures,
+                args.rollback,
+                args.verbose,
+            )
         elif args.container_subparser == 'restart':
-            container_restart(args.remote_address, args.project_id, args.id, args.verbose)
+            container_restart(args.remote_address, args.restart_project_id or args.project_id, args.id, args.verbose)
+        elif args.container_subparser == 'rebase':
+            container_rebase(args.remote_address, args.project_id, args.id, args.verbose)
+        elif args.container_subparser == 'usage':
+            container_usage(args.remote_address, args.project_id, args.machine_id, args.verbose)
+        elif args.container_subparser == 'update':
+            container_update(
+                args.remote_address,
+                args.project_id,
+                args.id,
+                limits_from_args(args),
+                None if args.pinned is None else args.pinned == 'yes',
+                args.verbose,
+            )
         elif args.container_subparser == 'migrate':
-            container_migrate(args.remote_address, args.project_id, args.id, args.verbose)
+            container_migrate(
+                args.remote_address,
+                args.project_id,
+                args.id,
+                args.machine_id,
+                args.direct,
+                args.verbose,
+            )
+        elif args.container_subparser == 'backup':
+            container_backup(
+                args.remote_address,
+                args.project_id,
+                args.id,
+                args.machine_id,
+                args.name,
+                args.to,
+                args.parallel,
+                args.limit,
+                args.keep,
+                args.list,
+                args.verbose,
+            )
+        elif args.container_subparser == 'restore':
+            container_restore(
+                args.remote_address,
+                args.id,
+                args.backup,
+                args.machine_id,
+                args.name,
+                args.start,
+                args.limit,
+                args.verbose,
+            )
+        elif args.container_subparser == 'exec':
+            container_exec(
+                args.remote_address,
+                args.exec_project_id or args.project_id,
+                args.command,
+                args.machine_id,
+                args.name,
+                args.method,
+                args.per_machine,
+                args.timeout,
+                args.verbose,
+            )
+    elif args.subparser == 'apply':
+        apply(args.remote_address, args.file, args.dry_run, args.per_machine, args.yes, args.verbose)
+    elif args.subparser == 'batch':
+        batch(args.remote_address, args.file, args.workers, args.keep_going, args.verbose)
+    elif args.subparser == 'cache':
+        if args.cache_subparser == 'enable':
+            cache_enable(args.remote_address, args.id, args.port, args.upstream, args.verbose)
+        elif args.cache_subparser == 'disable':
+            cache_disable(args.remote_address, args.verbose)
+        elif args.cache_subparser == 'stats':
+            cache_stats(args.remote_address, args.format, args.verbose)
+    elif args.subparser == 'logs':
+        logs(
+            args.remote_address,
+            args.project_id,
+            args.id,
+            args.machine_id,
+            args.name,
+            args.since,
+            args.until,
+            args.priority,
+            args.unit,
+            args.grep,
+            args.lines,
+            args.since_last,
+            args.follow,
+            args.format,
+            args.verbose,
+        )
+    elif args.subparser == 'top':
+        top(
+            args.remote_address,
+            args.project_id,
+            args.machine_id,
+            args.name,
+            args.interval,
+            args.sort,
+            args.limit,
+            args.once,
+            args.format,
+            args.verbose,
+        )
+    elif args.subparser == 'watch':
+        watch(
+            args.remote_address,
+            args.project_id,
+            args.machine_id,
+            args.name,
+            args.format,
+            args.reset,
+            args.verbose,
+        )
+    elif args.subparser == 'cluster':
+        if args.cluster_subparser == 'export':
+            cluster_export(args.remote_address, args.format, args.output, args.verbose)
+        elif args.cluster_subparser == 'rebalance':
+            cluster_rebalance(
+                args.remote_address,
+                args.metric,
+                args.tolerance,
+                args.dry_run,
+                args.parallel,
+                args.direct,
+                args.verbose,
+            )
@@ -0,0 +1,917 @@
+import contextlib
+import io
+import json
+import subprocess
+import sys
+import threading
+
+import pytest
+
+import nspawn
+
+
+def make_config(layout):
+    # layout: {machine_id: [(name, project_id), ...]}, shards not loaded
+    config = {'machines': {}, 'projects': {}, 'containers': {}, 'summaries': {}, 'shards': {}}
+
+    for i, (machine_id, containers) in enumerate(sorted(layout.items())):
+        config['machines'][machine_id] = {
+            'id': machine_id,
+            'user': 'root',
+            'host': 'h{}'.format(i),
+            'port': 22,
+        }
+
+        projects = {}
+
+        for name, project_id in containers:
+            projects[project_id] = projects.get(project_id, 0) + 1
+
+        config['summaries'][machine_id] = {'containers': len(containers), 'projects': projects}
+
+    return config
+
+
+@pytest.fixture
+def shards(monkeypatch):
+    # shard contents by host, served instead of ssh
+    data = {}
+
+    def iter_remote_config(uri, filename, missing_ok=False, verbose=False):
+        user, host, port = nspawn.parse_uri(uri)
+        yield ('head', {'generation': 0}, None)
+
+        for container in data.get(host, []):
+            yield ('container', container['id'], container)
+
+    monkeypatch.setattr(nspawn, 'iter_remote_config', iter_remote_config)
+    return data
+
+
+@pytest.fixture
+def cluster(shards):
+    layout = {
+        'm0': [('a0', 'p1'), ('a1', 'p1'), ('a2', 'p1')],
+        'm1': [('b0', 'p1'), ('b1', 'p1')],
+        'm2': [('c0', 'p1'), ('c1', 'p2'), ('c2', 'p1')],
+    }
+
+    config = make_config(layout)
+
+    for machine_id, containers in layout.items():
+        host = config['machines'][machine_id]['host']
+        shards[host] = [
+            {'id': '{}-{}'.format(machine_id, name), 'name': name, 'project_id': project_id, 'machine_id': machine_id}
+            for name, project_id in containers
+        ]
+
+    return config
+
+
+def names(config, **kwargs):
+    return [c['name'] for m, c in nspawn.iter_containers(config, {'project_id': 'p1'}, **kwargs)]
+
+
+def test_iter_containers_all(cluster):
+    assert names(cluster) == ['a0', 'a1', 'a2', 'b0', 'b1', 'c0', 'c2']
+
+
+def test_iter_containers_limit(cluster):
+    assert names(cluster, limit=4) == ['a0', 'a1', 'a2', 'b0']
+
+
+def test_iter_containers_offset_limit(cluster):
+    assert names(cluster, offset=3, limit=3) == ['b0', 'b1', 'c0']
+
+
+def test_iter_containers_offset_without_limit(cluster):
+    # whole first machine is skipped by its summary
+    assert names(cluster, offset=3) == ['b0', 'b1', 'c0', 'c2']
+    assert names(cluster, offset=4) == ['b1', 'c0', 'c2']
+
+
+def test_iter_containers_offset_past_end(cluster):
+    assert names(cluster, offset=10) == []
+
+
+def test_iter_containers_cursor(cluster):
+    rows = list(nspawn.iter_containers(cluster, {'project_id': 'p1'}, limit=2))
+    machine_id, container = rows[-1]
+    cursor = nspawn.encode_list_cursor(cluster['machines'][machine_id], container)
+    assert names(cluster, cursor=cursor, limit=3) == ['a2', 'b0', 'b1']
+
+    rows = list(nspawn.iter_containers(cluster, {'project_id': 'p1'}, limit=3))
+    machine_id, container = rows[-1]
+    cursor = nspawn.encode_list_cursor(cluster['machines'][machine_id], container)
+    assert names(cluster, cursor=cursor) == ['b0', 'b1', 'c0', 'c2']
+
+
+def port_config(ports):
+    config = make_config({'m0': []})
+    config['containers'] = {
+        'c{}'.format(i): {'id': 'c{}'.format(i), 'name': 'c{}'.format(i), 'project_id': 'p1', 'machine_id': 'm0', 'ports': p}
+        for i, p in enumerate(ports)
+    }
+
+    return config
+
+
+def test_explicit_port_outside_ranges_conflicts():
+    config = port_config([{'8080': 80}])
+
+    with pytest.raises(nspawn.PortAllocationError):
+        nspawn.find_available_machine_ports(config, config['machines']['m0'], [(8080, 80)])
+
+
+def test_explicit_port_inside_ranges_conflicts():
+    config = port_config([{'10022': 22}])
+
+    with pytest.raises(nspawn.PortAllocationError):
+        nspawn.find_available_machine_ports(config, config['machines']['m0'], [(10022, 22)])
+
+
+def test_explicit_port_repeated_in_request():
+    config = port_config([])
+
+    with pytest.raises(nspawn.PortAllocationError):
+        nspawn.find_available_machine_ports(config, config['machines']['m0'], [(8080, 80), (8080, 81)])
+
+
+def test_explicit_port_listening_on_host():
+    config = port_config([])
+
+    with pytest.raises(nspawn.PortAllocationError):
+        nspawn.find_available_machine_ports(config, config['machines']['m0'], [(8080, 80)], listening_ports={8080})
+
+
+def test_free_ports_skip_used():
+    config = port_config([{'8080': 80, '10022': 22}])
+    ports = nspawn.find_available_machine_ports(config, config['machines']['m0'], [(8081, 80), (None, 22)])
+    assert ports[8081] == 80
+    assert 10022 not in ports
+    assert len(ports) == 2
+
+
+@pytest.fixture
+def stats(monkeypatch):
+    # latest sample per machine, no ssh and no local stats file
+    samples = {}
+    monkeypatch.setattr(nspawn, 'load_stats', lambda: samples)
+    monkeypatch.setattr(nspawn, 'fresh_stats', lambda sample, max_age=None: sample)
+    monkeypatch.setattr(nspawn, 'get_machine_listening_ports', lambda uri, verbose=False: set())
+    return samples
+
+
+def rebalance_config(layout):
+    config = make_config(layout)
+    config['shards'] = {n: {} for n in layout}
+    port = 10000
+
+    for machine_id, containers in layout.items():
+        for name, project_id in containers:
+            port += 1
+            config['containers'][name] = {
+                'id': name,
+                'name': name,
+                'project_id': project_id,
+                'machine_id': machine_id,
+                'ports': {str(port): 22},
+            }
+
+    return config
+
+
+def moved_to(moves):
+    return sorted((container['id'], target_id) for container, source_id, target_id in moves)
+
+
+def test_rebalance_count_onto_empty_machine(stats):
+    config = rebalance_config({'a': [('c{}'.format(i), 'p1') for i in range(4)], 'b': []})
+    moves, problems = nspawn.plan_rebalance(config, 'count')
+    assert len(moves) == 2
+    assert all(target_id == 'b' for container, source_id, target_id in moves)
+    assert problems == []
+
+
+def test_rebalance_balanced_cluster(stats):
+    config = rebalance_config({'a': [('c0', 'p1'), ('c1', 'p1')], 'b': [('c2', 'p1'), ('c3', 'p1')]})
+    moves, problems = nspawn.plan_rebalance(config, 'count')
+    assert moves == []
+
+
+def test_rebalance_memory_onto_empty_machine(stats):
+    gib = 1024 ** 3
+    stats['a'] = {'mem_total': 16 * gib, 'mem_available': 8 * gib}
+    stats['b'] = {'mem_total': 16 * gib, 'mem_available': 15 * gib}
+    config = rebalance_config({'a': [('c{}'.format(i), 'p1') for i in range(4)], 'b': []})
+    moves, problems = nspawn.plan_rebalance(config, 'memory')
+    assert len(moves) == 2
+    assert all(target_id == 'b' for container, source_id, target_id in moves)
+    assert problems == []
+
+
+def test_rebalance_memory_without_stats_falls_back_to_count(stats):
+    gib = 1024 ** 3
+    stats['a'] = {'mem_total': 16 * gib, 'mem_available': 8 * gib}
+    config = rebalance_config({'a': [('c{}'.format(i), 'p1') for i in range(4)], 'b': []})
+    moves, problems = nspawn.plan_rebalance(config, 'memory')
+    assert len(moves) == 2
+    assert any('balancing by count' in n for n in problems)
+
+
+def test_rebalance_skips_pinned(stats):
+    config = rebalance_config({'a': [('c{}'.format(i), 'p1') for i in range(4)], 'b': []})
+
+    for container in config['containers'].values():
+        container['pinned'] = True
+
+    moves, problems = nspawn.plan_rebalance(config, 'count')
+    assert moves == []
+    assert problems
+
+
+def test_drain_moves_everything(stats):
+    config = rebalance_config({'a': [('c0', 'p1'), ('c1', 'p1')], 'b': [], 'c': [('c2', 'p1')]})
+    moves, problems = nspawn.plan_rebalance(config, 'count', drain_id='a')
+    assert sorted(container['id'] for container, source_id, target_id in moves) == ['c0', 'c1']
+    assert all(source_id == 'a' and target_id != 'a' for container, source_id, target_id in moves)
+    assert problems == []
+
+
+def apply_plan(tmp_path, state):
+    spec = tmp_path / 'desired.json'
+    spec.write_text(json.dumps({'containers': [{'project': 'web', 'name': 'w', 'state': state}]}))
+    digest, project_names, desired = nspawn.load_desired_state(str(spec))
+    config = make_config({'m0': []})
+    config['projects'] = {'p1': {'id': 'p1', 'name': 'web'}}
+    config['containers'] = {'w0': {
+        'id': 'w0', 'name': 'w', 'project_id': 'p1', 'machine_id': 'm0',
+        'distro': 'arch', 'ports': {'10001': 22},
+    }}
+    # container known to config but missing on disk
+    live = {'m0': (set(), set())}
+    return nspawn.plan_apply(config, live, project_names, desired)
+
+
+@pytest.mark.parametrize('state', ['running', 'stopped'])
+def test_apply_recreate_keeps_desired_state(tmp_path, state):
+    plan = apply_plan(tmp_path, state)
+    creates = [a for a in plan['actions'] if a['op'] == 'create']
+    assert len(creates) == 1
+    assert creates[0]['detail'] == 'missing on disk'
+    assert creates[0]['start'] is (state == 'running')
+
+
+@pytest.mark.parametrize('upstream, origin, path', [
+    ('https://geo.mirror.pkgbuild.com', 'https://geo.mirror.pkgbuild.com', ''),
+    ('https://mirror.example.org/archlinux/', 'https://mirror.example.org', '/archlinux'),
+    ('http://10.0.0.1:8080/arch', 'http://10.0.0.1:8080', '/arch'),
+])
+def test_cache_upstream_split(upstream, origin, path):
+    assert nspawn.split_cache_upstream(upstream) == (origin, path)
+
+
+def test_cache_upstream_invalid():
+    with pytest.raises(ValueError):
+        nspawn.split_cache_upstream('mirror.example.org/archlinux')
+
+
+def test_cache_nginx_upstream_path():
+    conf = nspawn.render_cache_nginx(8090, 'https://mirror.example.org/archlinux')
+    # no URI part in proxy_pass, nginx rejects it inside regex location
+    assert 'proxy_pass https://mirror.example.org;' in conf
+    assert 'proxy_pass https://mirror.example.org/' not in conf
+    assert conf.count('rewrite ^ /archlinux$uri break;') == 2
+
+
+def test_cache_nginx_local_directory():
+    conf = nspawn.render_cache_nginx(8090, 'file:///srv/mirror')
+    assert 'root /srv/mirror;' in conf
+    # stand-in fetches stay out of hit rate
+    stand_in = conf[conf.index('listen 127.0.0.1:8091;'):conf.index('listen 8090;')]
+    assert 'access_log off;' in stand_in
+    assert 'proxy_pass http://127.0.0.1:8091;' in conf
+    assert 'rewrite' not in conf
+
+
+@pytest.mark.parametrize('key', ['image_id', 'image'])
+def test_batch_rejects_image_containers(key):
+    with pytest.raises(ValueError, match='Image based containers'):
+        nspawn.queue_batch_op(None, 'container add', {'name': 'w', key: 'x'})
+
+
+def test_restic_key_stays_off_command_line():
+    backup = {'user': 'root', 'host': 'bk', 'port': 22, 'backup': {'path': '/var/lib/nspawn-backup'}}
+    local = nspawn.restic_command(backup, 'snapshots --json', local=True)
+    remote = nspawn.restic_command(backup, 'backup /var/lib/machines/x')
+    # backup machine reads key file, others get it through stdin
+    assert '--password-file /var/lib/nspawn-backup/restic.key' in local
+    assert 'RESTIC_PASSWORD' not in local
+    assert remote.startswith('read -r RESTIC_PASSWORD && export RESTIC_PASSWORD && ')
+    assert 'password-file' not in remote
+
+
+def test_transaction_retry_loads_saved_shards(monkeypatch):
+    reads = []
+    saves = []
+
+    def read_cluster_config(uri, machine_ids=None, verbose=False):
+        reads.append(machine_ids)
+        config = make_config({'m0': [], 'm1': []})
+
+        # shard saved by first attempt before its index write lost
+        for machine_id in machine_ids or ():
+            config['shards'][machine_id] = {'generation': 1, 'hash': None}
+            config['containers']['x'] = {'id': 'x', 'machine_id': machine_id}
+
+        return config
+
+    def save_consensus_config(config, remote_uri=None, verbose=False):
+        saves.append(dict(config['containers']))
+
+        if len(saves) == 1:
+            raise nspawn.ConfigConflictError('index changed')
+
+    def mutate(config):
+        # placement loads shard of chosen machine
+        if 'x' not in config['containers']:
+            config['shards']['m1'] = {'generation': 0, 'hash': None}
+            config['containers']['x'] = {'id': 'x', 'machine_id': 'm1'}
+
+        return config['containers']['x']
+
+    monkeypatch.setattr(nspawn, 'read_cluster_config', read_cluster_config)
+    monkeypatch.setattr(nspawn, 'save_consensus_config', save_consensus_config)
+    monkeypatch.setattr(nspawn.time, 'sleep', lambda n: None)
+    config, container = nspawn.transaction('root@h0:22', mutate, machine_ids=[])
+    assert reads == [[], ['m1']]
+    assert container['machine_id'] == 'm1'
+
+
+@pytest.fixture
+def breakers(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(nspawn, '_breakers', None)
+    probes = []
+    monkeypatch.setattr(nspawn, '_probe_host', lambda key: probes.append(key) or probes[-1] == 'up:22')
+    return probes
+
+
+def test_breaker_opens_and_probes_inline(breakers):
+    for i in range(nspawn.BREAKER_THRESHOLD):
+        nspawn.breaker_failure('down:22')
+
+    assert not nspawn.breaker_allow('down:22')
+    assert breakers == ['down:22']
+
+    # probe is rate limited, not repeated on every call
+    assert not nspawn.breaker_allow('down:22')
+    assert breakers == ['down:22']
+
+
+def test_breaker_single_trial_after_probe(breakers):
+    for i in range(nspawn.BREAKER_THRESHOLD):
+        nspawn.breaker_failure('up:22')
+
+    assert nspawn.breaker_allow('up:22')
+    assert not nspawn.breaker_allow('up:22')
+    nspawn.breaker_success('up:22')
+    assert nspawn.breaker_allow('up:22')
+
+
+def test_breaker_save_merges_other_invocations(breakers):
+    nspawn.breaker_failure('a:22')
+
+    # another invocation saved its own host meanwhile
+    with open('nspawn.local.breakers') as f:
+        saved = json.load(f)
+
+    saved['b:22'] = {'state': 'open', 'failures': 3, 'opened': 1}
+
+    with open('nspawn.local.breakers', 'w') as f:
+        json.dump(saved, f)
+
+    nspawn.breaker_failure('a:22')
+
+    with open('nspawn.local.breakers') as f:
+        saved = json.load(f)
+
+    assert saved['a:22']['failures'] == 2
+    assert saved['b:22']['failures'] == 3
+
+
+def plan_action(key, machine_id='m0', deps=()):
+    return {'key': key, 'op': 'start', 'container_id': key, 'label': key, 'machine_id': machine_id, 'detail': '', 'deps': list(deps)}
+
+
+def test_run_plan_exit_in_worker_fails_action():
+    actions = [plan_action('a'), plan_action('b', deps=['a']), plan_action('c', machine_id='m1')]
+
+    def execute(action):
+        if action['key'] == 'a':
+            sys.exit(1)
+
+    finished, failed = nspawn.run_plan(actions, execute)
+    assert failed == {'a', 'b'}
+    assert finished == {'c'}
+
+
+def test_rebalance_skips_overlay(stats):
+    config = rebalance_config({'a': [('c{}'.format(i), 'p1') for i in range(4)], 'b': []})
+
+    for container in config['containers'].values():
+        container['storage'] = {'mode': 'overlay'}
+
+    assert nspawn.plan_rebalance(config, 'count')[0] == []
+    moves, problems = nspawn.plan_rebalance(config, 'count', drain_id='a')
+    assert moves == []
+    assert all('overlay' in n for n in problems)
+
+
+@pytest.fixture
+def migration(monkeypatch):
+    calls = []
+    monkeypatch.setattr(nspawn, 'get_machine_listening_ports', lambda uri, verbose=False: set())
+    monkeypatch.setattr(nspawn, 'lease', lambda *a, **k: contextlib.nullcontext())
+    monkeypatch.setattr(nspawn, 'is_container_active', lambda uri, container, verbose=False: True)
+
+    for name in ('stop_container_arch', 'start_container_arch', 'copy_container_arch', 'discard_container_copy'):
+        monkeypatch.setattr(nspawn, name, lambda *a, name=name, **k: calls.append((name, a[0])))
+
+    return calls
+
+
+def test_migrate_rolls_back_on_config_conflict(migration, monkeypatch):
+    def transaction(*a, **k):
+        raise nspawn.ConfigConflictError('too many concurrent updates')
+
+    monkeypatch.setattr(nspawn, 'transaction', transaction)
+    source = {'id': 'm0', 'user': 'root', 'host': 'h0', 'port': 22}
+    target = {'id': 'm1', 'user': 'root', 'host': 'h1', 'port': 22}
+    container = {'id': 'c0', 'distro': 'arch', 'machine_id': 'm0', 'ports': {'10001': 22}}
+
+    with pytest.raises(nspawn.ConfigConflictError):
+        nspawn.migrate_container('root@h0:22', container, source, target)
+
+    assert ('discard_container_copy', 'root@h1:22') in migration
+    assert migration[-1] == ('start_container_arch', 'root@h0:22')
+
+
+def test_migrate_refuses_overlay(migration):
+    source = {'id': 'm0', 'user': 'root', 'host': 'h0', 'port': 22}
+    target = {'id': 'm1', 'user': 'root', 'host': 'h1', 'port': 22}
+    container = {'id': 'c0', 'distro': 'arch', 'machine_id': 'm0', 'storage': {'mode': 'overlay'}}
+
+    with pytest.raises(IOError, match='Overlay'):
+        nspawn.migrate_container('root@h0:22', container, source, target)
+
+    assert migration == []
+
+
+def test_save_shards_refuses_unloaded_machine():
+    config = make_config({'m0': [], 'm1': []})
+    config['shards'] = {'m0': {'generation': 0, 'hash': nspawn.shard_hash({})}}
+    config['containers']['x'] = {'id': 'x', 'project_id': 'p1', 'machine_id': 'm1'}
+
+    with pytest.raises(nspawn.ClusterError):
+        nspawn.save_shards(config)
+
+
+def test_place_container_fails_without_shard(monkeypatch):
+    monkeypatch.setattr(nspawn, 'ensure_shards', lambda config, machine_ids=None, verbose=False: config)
+    config = make_config({'m0': []})
+    container = {'id': 'x', 'project_id': 'p1'}
+
+    with pytest.raises(nspawn.ClusterError):
+        nspawn.place_container(config, container, [], 'm0')
+
+
+@pytest.fixture
+def restore(monkeypatch):
+    config = make_config({'m0': [], 'm1': []})
+    config['projects'] = {'p1': {'id': 'p1', 'name': 'web'}}
+    config['machines']['m1']['backup'] = {'path': '/var/lib/nspawn-backup'}
+    record = {'id': 'c0', 'name': 'w', 'project_id': 'p1', 'machine_id': 'm0', 'distro': 'arch', 'ports': {'10001': 22}}
+    calls = []
+
+    def transaction(remote_uri, mutate, machine_ids=None, verbose=False):
+        calls.append(machine_ids)
+        return config, mutate(config)
+
+    monkeypatch.setattr(nspawn, 'load_cluster_config', lambda *a, **k: config)
+    monkeypatch.setattr(nspawn, 'ssh_client', lambda uri: io.BytesIO())
+    monkeypatch.setattr(nspawn, 'exec_command', lambda *a, **k: (0, json.dumps(record).encode(), b''))
+    monkeypatch.setattr(nspawn, 'list_backups', lambda *a, **k: [{'container_id': 'c0', 'name': 'x', 'mode': 'btrfs', 'time': 0}])
+    monkeypatch.setattr(nspawn, 'consensus_transaction', transaction)
+    monkeypatch.setattr(nspawn, 'ensure_shards', lambda config, machine_ids=None, verbose=False: config['shards'].update({n: {} for n in machine_ids}))
+    return calls
+
+
+def test_restore_placement_error_exits_cleanly(restore, monkeypatch, capsys):
+    def place_container(*a, **k):
+        raise nspawn.PlacementError('No machine matches placement constraints')
+
+    monkeypatch.setattr(nspawn, 'place_container', place_container)
+
+    with pytest.raises(SystemExit) as e:
+        nspawn.container_restore('root@h0:22', 'c0', machine_id='m1')
+
+    assert e.value.code == 1
+    assert 'No machine matches' in capsys.readouterr().err
+    assert restore == [['m1']]
+
+
+def test_usage_short_project_id(shards, monkeypatch):
+    # full project id in records, short suffix given on command line
+    config = make_config({'m0': [('a0', '7f3c2e9ab1p1'), ('a1', '7f3c2e9ab1p2')]})
+    shards['h0'] = [
+        {'id': 'a0', 'name': 'a0', 'project_id': '7f3c2e9ab1p1', 'machine_id': 'm0'},
+        {'id': 'a1', 'name': 'a1', 'project_id': '7f3c2e9ab1p2', 'machine_id': 'm0'},
+    ]
+
+    seen = []
+    monkeypatch.setattr(nspawn, 'load_cluster_config', lambda *a, **k: config)
+    monkeypatch.setattr(nspawn, '_usage_machine_thread', lambda lock, results, machine, containers, verbose=False: seen.extend(c['id'] for c in containers))
+    nspawn.container_usage('root@h0:22', 'b1p1')
+    assert seen == ['a0']
+
+
+class LocalClient(object):
+    # runs remote commands with local sh in a directory standing in for machine
+    def __init__(self, cwd):
+        self.cwd = cwd
+
+    def exec_command(self, command, timeout=None):
+        p = subprocess.run(['sh', '-c', command], cwd=self.cwd, capture_output=True)
+        return None, io.BytesIO(p.stdout), io.BytesIO(p.stderr), p.returncode
+
+    def close(self):
+        pass
+
+
+@pytest.fixture
+def local_machine(tmp_path, monkeypatch):
+    client = LocalClient(str(tmp_path))
+
+    def exec_command(client, command, input_data=None, timeout=None, verbose=False):
+        stdin, stdout, stderr, status = client.exec_command(command)
+        return status, stdout.read(), stderr.read()
+
+    monkeypatch.setattr(nspawn, 'ssh_client', lambda uri: client)
+    monkeypatch.setattr(nspawn, 'exec_command', exec_command)
+    return tmp_path
+
+
+def test_lease_held_by_other_owner(local_machine):
+    nspawn.acquire_lease('root@h0:22', 'container-x', owner='a')
+
+    with pytest.raises(nspawn.LeaseError, match='held by a'):
+        nspawn.acquire_lease('root@h0:22', 'container-x', owner='b', wait=0)
+
+    # same owner renews, other one gets it after release
+    nspawn.acquire_lease('root@h0:22', 'container-x', owner='a', wait=0)
+    nspawn.release_lease('root@h0:22', 'container-x', owner='a')
+    nspawn.acquire_lease('root@h0:22', 'container-x', owner='b', wait=0)
+
+
+def test_lease_expired_is_taken_over(local_machine):
+    nspawn.acquire_lease('root@h0:22', 'container-x', owner='a', ttl=-10)
+    nspawn.acquire_lease('root@h0:22', 'container-x', owner='b', wait=0)
+    assert (local_machine / 'nspawn.leases' / 'container-x').read_text().split()[0] == 'b'
+
+
+def test_release_keeps_lease_of_other_owner(local_machine):
+    nspawn.acquire_lease('root@h0:22', 'container-x', owner='a')
+    nspawn.release_lease('root@h0:22', 'container-x', owner='b')
+
+    with pytest.raises(nspawn.LeaseError):
+        nspawn.acquire_lease('root@h0:22', 'container-x', owner='b', wait=0)
+
+
+@pytest.fixture
+def remote_index(monkeypatch):
+    # index generation on main node, bumped by concurrent writers
+    state = {'generation': 5, 'conflicts': 0, 'reads': 0}
+
+    def read_cluster_config(uri, machine_ids=None, verbose=False):
+        state['reads'] += 1
+        config = make_config({'m0': []})
+        config['generation'] = state['generation']
+        return config
+
+    def save_consensus_config(config, remote_uri=None, verbose=False):
+        if state['conflicts']:
+            state['conflicts'] -= 1
+            state['generation'] += 1
+            raise nspawn.ConfigConflictError('generation changed')
+
+        assert config['generation'] == state['generation']
+        state['generation'] += 1
+
+    monkeypatch.setattr(nspawn, 'read_cluster_config', read_cluster_config)
+    monkeypatch.setattr(nspawn, 'save_consensus_config', save_consensus_config)
+    monkeypatch.setattr(nspawn.time, 'sleep', lambda n: None)
+    return state
+
+
+def test_transaction_replays_mutation_on_conflict(remote_index):
+    remote_index['conflicts'] = 2
+    seen = []
+
+    def mutate(config):
+        seen.append(config['generation'])
+        config['projects']['p1'] = {'id': 'p1', 'name': 'web'}
+        return 'p1'
+
+    config, result = nspawn.transaction('root@h0:22', mutate, machine_ids=[])
+    assert result == 'p1'
+    assert seen == [5, 6, 7]
+    assert remote_index['generation'] == 8
+
+
+def test_transaction_gives_up(remote_index):
+    remote_index['conflicts'] = 100
+
+    with pytest.raises(nspawn.ConfigConflictError):
+        nspawn.transaction('root@h0:22', lambda config: None, machine_ids=[], retries=3)
+
+    assert remote_index['reads'] == 3
+
+
+def test_consensus_transaction_exits_on_conflict(remote_index):
+    remote_index['conflicts'] = 100
+
+    with pytest.raises(SystemExit) as e:
+        nspawn.consensus_transaction('root@h0:22', lambda config: None, machine_ids=[], retries=2)
+
+    assert e.value.code == 1
+
+
+def sample_config():
+    config = make_config({'m0': [('a0', 'p1')], 'm1': []})
+    config['generation'] = 7
+    config['projects'] = {'p1': {'id': 'p1', 'name': 'web'}}
+    config['containers'] = {
+        'a0': {'id': 'a0', 'name': 'a0', 'project_id': 'p1', 'machine_id': 'm0', 'ports': {'10001': 22}},
+        'a1': {'id': 'a1', 'name': 'a1', 'project_id': 'p1', 'machine_id': 'm1', 'pinned': True},
+    }
+    return config
+
+
+@pytest.mark.parametrize('codec', ['zlib', 'lzma'])
+def test_config_v2_round_trip(codec):
+    config = sample_config()
+    data = nspawn.dump_config(config, 'v2', codec)
+    assert data.startswith(nspawn.CONFIG_MAGIC)
+
+    loaded = nspawn.load_config(data)
+    assert loaded['generation'] == 7
+    assert loaded['containers'] == config['containers']
+    assert loaded['machines'] == config['machines']
+    assert loaded['projects'] == config['projects']
+
+
+def test_config_v2_streams_in_small_chunks():
+    data = nspawn.dump_config(sample_config())
+    events = list(nspawn.iter_config(data[i:i + 5] for i in range(0, len(data), 5)))
+    assert events[0][0] == 'head'
+    assert sorted(e[1] for e in events[1:]) == ['a0', 'a1']
+
+
+def test_config_v1_json_still_loads():
+    config = sample_config()
+    loaded = nspawn.load_config(nspawn.dump_config(config, 'json'))
+    assert loaded['containers'] == config['containers']
+
+
+def test_config_v2_corruption_detected():
+    data = bytearray(nspawn.dump_config(sample_config()))
+    data[-3] ^= 0xff
+
+    with pytest.raises(IOError):
+        nspawn.load_config(bytes(data))
+
+
+def test_fold_config_newer_generation_wins():
+    old = sample_config()
+    new = sample_config()
+    new['generation'] = 8
+    new['containers']['a0'] = dict(new['containers']['a0'], name='renamed')
+    merged = {'generation': 0, 'machines': {}, 'projects': {}, 'containers': {}}
+    generations = {}
+
+    # arrival order does not matter
+    nspawn.fold_config(merged, generations, nspawn.iter_config([nspawn.dump_config(new)]))
+    nspawn.fold_config(merged, generations, nspawn.iter_config([nspawn.dump_config(old)]))
+    assert merged['generation'] == 8
+    assert merged['containers']['a0']['name'] == 'renamed'
+
+
+def test_line_writer_joins_chunks_into_prefixed_lines():
+    out = io.StringIO()
+    err = io.StringIO()
+    write = nspawn.line_writer('[c0] ', threading.Lock(), out, err)
+    write('stdout', b'downloading ')
+    write('stdout', b'core\ninstalling')
+    write('stderr', b'warning: x\n')
+    assert out.getvalue() == '[c0] downloading core\n'
+
+    # partial line is flushed at end of stream
+    write('stdout', None)
+    assert out.getvalue() == '[c0] downloading core\n[c0] installing\n'
+    assert err.getvalue() == '[c0] warning: x\n'
+
+
+def test_line_writer_bounds_partial_line(monkeypatch):
+    monkeypatch.setattr(nspawn, 'STREAM_LINE_MAX', 8)
+    out = io.StringIO()
+    write = nspawn.line_writer('', threading.Lock(), out, out)
+    write('stdout', b'0123456789')
+    assert out.getvalue() == '0123456789\n'
+
+
+def test_output_mux_interleaves_whole_lines():
+    out = io.StringIO()
+    mux = nspawn.OutputMux(out=out)
+    a = mux.stream('a')
+    b = mux.stream('b')
+    a('stdout', b'one ')
+    b('stdout', b'two\n')
+    a('stdout', b'done\n')
+    mux.done('a', 0)
+    assert out.getvalue() == '[b] two\n[a] one done\n'
+    assert mux.stats['a']['lines'] == 1
+    assert mux.stats['a']['last'] == 'one done'
+    assert mux.stats['a']['status'] == 0
+
+
+def test_output_mux_progress_does_not_echo():
+    out = io.StringIO()
+    mux = nspawn.OutputMux(progress=True, out=out)
+    write = mux.stream('a')
+    write('stdout', b'line\n')
+    assert out.getvalue() == ''
+    assert mux.stats['a']['bytes'] == 5
+
+
+def journal_entry(message_id, cursor, unit='systemd-nspawn@c0.service', **fields):
+    return dict(fields, MESSAGE_ID=message_id, UNIT=unit, __CURSOR=cursor, __REALTIME_TIMESTAMP='1700000000500000')
+
+
+STARTED = '39f53479d3a045ac8e11786248231fbf'
+EXITED = '98e322203f7a4ed290d09fe03c09fe15'
+
+
+def test_journal_event_states():
+    event = nspawn.journal_event('m0', journal_entry(STARTED, 's1', JOB_RESULT='done'))
+    assert event == {'time': 1700000000.5, 'machine_id': 'm0', 'container_id': 'c0', 'state': 'started', 'reason': '', 'cursor': 's1'}
+
+    event = nspawn.journal_event('m0', journal_entry(EXITED, 's2', EXIT_CODE='exited', EXIT_STATUS='1'))
+    assert (event['state'], event['reason']) == ('exited', 'exited=1')
+
+    # job failure comes on started message
+    event = nspawn.journal_event('m0', journal_entry(STARTED, 's3', JOB_RESULT='timeout'))
+    assert (event['state'], event['reason']) == ('failed', 'timeout')
+
+
+def test_journal_event_ignores_other_messages():
+    assert nspawn.journal_event('m0', journal_entry(STARTED, 's1', unit='sshd.service')) is None
+    assert nspawn.journal_event('m0', journal_entry('0' * 32, 's1')) is None
+
+
+def test_event_stream_drops_duplicates():
+    stream = nspawn.EventStream({'m0': {}, 'm1': {}})
+    started = nspawn.journal_event('m0', journal_entry(STARTED, 's1'))
+    assert not stream._is_duplicate('m0', started)
+
+    # replayed after reconnect, and same transition under new cursor
+    assert stream._is_duplicate('m0', started)
+    assert stream._is_duplicate('m0', dict(started, cursor='s2'))
+
+    # other machine and new transition pass
+    assert not stream._is_duplicate('m1', dict(started, machine_id='m1'))
+    assert not stream._is_duplicate('m0', nspawn.journal_event('m0', journal_entry(EXITED, 's3', EXIT_CODE='exited', EXIT_STATUS='0')))
+
+
+class JournalChannel(object):
+    def __init__(self, chunks):
+        self.chunks = list(chunks)
+        self.closed = False
+        self.eof_received = False
+
+    def recv_stderr_ready(self):
+        return False
+
+    def recv_ready(self):
+        return bool(self.chunks)
+
+    def recv(self, n):
+        return self.chunks.pop(0)
+
+    def exit_status_ready(self):
+        return False
+
+
+def test_event_stream_split_lines_and_cursor():
+    stream = nspawn.EventStream({'m0': {}})
+    stream.buffers['m0'] = b''
+    line = json.dumps(journal_entry(STARTED, 's1')).encode() + b'\n'
+    chan = JournalChannel([line[:20], line[20:] + b'{"__CURSOR": "s2", "MESSAGE'])
+
+    assert stream._read('m0', chan) == []
+    events = stream._read('m0', chan)
+    assert [e['cursor'] for e in events] == ['s1']
+
+    # cursor of last complete entry is where follower resumes
+    assert stream.cursors['m0'] == 's1'
+    assert '--after-cursor=s1' in nspawn.journal_follow_command(stream.cursors['m0'])
+
+
+def test_journal_command_filters_and_resume():
+    command = nspawn.journal_command('c0', {'since': '1h ago', 'priority': 'err', 'units': ['sshd.service']}, cursor='s9')
+    assert '--after-cursor=s9' in command
+    assert '--since' not in command
+    assert '--priority=err' in command
+    assert '--unit=sshd.service' in command
+    assert command.endswith('| gzip -1')
+    assert '--follow' in nspawn.journal_command('c0', {}, follow=True)
+
+
+def test_journal_entries_skip_garbage():
+    data = b'{"__REALTIME_TIMESTAMP": "5", "MESSAGE": [104, 105]}\nnot json\n{"x": 1}\n'
+    entries = list(nspawn.journal_entries(data))
+    assert len(entries) == 1
+    assert entries[0]['__REALTIME_TIMESTAMP'] == 5
+    assert nspawn.journal_message(entries[0]) == 'hi'
+
+
+def test_logs_merge_in_time_order_and_save_cursors(shards, tmp_path, monkeypatch, capsys):
+    monkeypatch.chdir(tmp_path)
+    config = make_config({'m0': [('a0', 'p1')], 'm1': [('b0', 'p1')]})
+    shards['h0'] = [{'id': 'a0', 'name': 'a0', 'project_id': 'p1', 'machine_id': 'm0'}]
+    shards['h1'] = [{'id': 'b0', 'name': 'b0', 'project_id': 'p1', 'machine_id': 'm1'}]
+
+    def entry(t, message, cursor):
+        return {'__REALTIME_TIMESTAMP': t, 'MESSAGE': message, '__CURSOR': cursor}
+
+    results = {
+        'a0': [entry(1, 'a first', 'a1'), entry(4, 'a last', 'a4')],
+        'b0': [entry(2, 'b first', 'b2'), entry(3, 'b last', 'b3')],
+    }
+
+    monkeypatch.setattr(nspawn, 'load_cluster_config', lambda *a, **k: config)
+    monkeypatch.setattr(nspawn, 'fetch_logs', lambda *a, **k: results)
+    nspawn.logs('root@h0:22', project_id='p1', format_='json')
+
+    messages = [json.loads(n)['message'] for n in capsys.readouterr().out.splitlines()]
+    assert messages == ['a first', 'b first', 'b last', 'a last']
+    assert nspawn.load_log_cursors() == {'a0': 'a4', 'b0': 'b3'}
+
+
+@pytest.fixture
+def session(remote_index, monkeypatch):
+    saved = []
+    save = nspawn.save_consensus_config
+
+    def save_consensus_config(config, remote_uri=None, verbose=False):
+        save(config, remote_uri, verbose)
+        saved.append(config)
+
+    monkeypatch.setattr(nspawn, 'save_consensus_config', save_consensus_config)
+    cluster = nspawn.Cluster('root@h0:22')
+    yield cluster, saved
+    cluster.close()
+
+
+def test_cluster_commit_saves_queued_mutations_once(session):
+    cluster, saved = session
+    web = cluster.add_project('web')
+    db = cluster.add_project('db')
+    assert cluster.commit() == []
+    assert len(saved) == 1
+    assert sorted(p['id'] for p in cluster.projects()) == sorted([web, db])
+
+
+def test_cluster_commit_failing_mutation_saves_nothing(session):
+    cluster, saved = session
+    cluster.add_project('web')
+    cluster.remove_project('missing')
+
+    with pytest.raises(nspawn.ClusterError):
+        cluster.commit()
+
+    assert saved == []
+    assert cluster.projects() == []
+
+    cluster.rollback()
+    assert cluster.commit() == []
+    assert saved == []
+
+
+def test_cluster_commit_replays_on_conflict(session, remote_index):
+    cluster, saved = session
+    remote_index['conflicts'] = 1
+    project_id = cluster.add_project('web')
+    cluster.commit()
+    assert remote_index['reads'] == 3
+    assert [p['id'] for p in cluster.projects()] == [project_id]